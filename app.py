@@ -1,14 +1,25 @@
 import streamlit as st
 from PIL import Image
 import numpy as np
-import json
+import os
+import tempfile
 from datetime import datetime
-from disease_info import get_disease_info, parse_disease_name
-from model import PlantDiseaseModel
-from disease_info import get_disease_info
-from database import SessionLocal, init_db
+from disease_info import label_for_class
+from model_registry import ModelManager
+from database import init_db, request_scope, get_request_db, DB_STATS_ENABLED
 from auth import create_user, authenticate_user, get_user_by_id
-from detection_utils import save_detection, get_user_detections, get_user_stats
+from detection_utils import save_detection, save_detections, get_user_stats, get_detections_by_ids, result_from_detection, detection_top_k
+from embedding_index import get_detection_index, get_reference_index, load_reference_paths
+from image_hash import NearDuplicateIndex, phash
+from tiling import heatmap_overlay
+from blob_store import BlobStore
+from job_queue import (JOB_PRIORITIES, JOB_INLINE_LIMIT, ACTIVE_STATUSES, submit_job, list_user_jobs,
+                       cancel_job, retry_job, job_items)
+from archive_utils import ARCHIVE_TYPES, process_archive, count_archive_images
+from export_utils import export_detections
+from search import search_detections
+from metrics import METRICS_ENABLED, CACHE, stage_timer, record_error, start_metrics_server
+from profiling import maybe_profile
 
 # --- Streamlit Page Config ---
 st.set_page_config(
@@ -20,12 +31,21 @@ st.set_page_config(
 # --- Initialize Database ---
 init_db()
 
-# --- Load & Cache Model ---
+# --- Metrics Exporter (opt-in via METRICS_ENABLED=1) ---
 @st.cache_resource
+def start_metrics_exporter():
+    return start_metrics_server()
+
+if METRICS_ENABLED:
+    start_metrics_exporter()
+
+# --- Load & Serve Model (hot-swapped when the registry's active version changes) ---
+@st.cache_resource
+def get_model_manager():
+    return ModelManager()
+
 def load_model():
-    plant_model = PlantDiseaseModel()
-    plant_model.initialize_model()
-    return plant_model
+    return get_model_manager().get()
 
 # --- Session State Initialization ---
 def init_session_state():
@@ -53,20 +73,17 @@ def login_page():
             submit = st.form_submit_button("Login", use_container_width=True)
             if submit:
                 if username and password:
-                    db = SessionLocal()
-                    try:
-                        user, error = authenticate_user(db, username, password)
-                        if user:
-                            st.session_state['logged_in'] = True
-                            st.session_state['user_id'] = user.id
-                            st.session_state['username'] = user.username
-                            st.session_state['full_name'] = user.full_name
-                            st.success("Login successful!")
-                            st.rerun()
-                        else:
-                            st.error(error)
-                    finally:
-                        db.close()
+                    db = get_request_db()
+                    user, error = authenticate_user(db, username, password)
+                    if user:
+                        st.session_state['logged_in'] = True
+                        st.session_state['user_id'] = user.id
+                        st.session_state['username'] = user.username
+                        st.session_state['full_name'] = user.full_name
+                        st.success("Login successful!")
+                        st.rerun()
+                    else:
+                        st.error(error)
                 else:
                     st.error("Please enter both username and password")
 
@@ -99,17 +116,14 @@ def register_page():
                 elif len(password) < 6:
                     st.error("Password must be at least 6 characters")
                 else:
-                    db = SessionLocal()
-                    try:
-                        user, error = create_user(db, username, email, password, full_name)
-                        if user:
-                            st.success("Registration successful! Please login.")
-                            st.session_state['show_register'] = False
-                            st.rerun()
-                        else:
-                            st.error(error)
-                    finally:
-                        db.close()
+                    db = get_request_db()
+                    user, error = create_user(db, username, email, password, full_name)
+                    if user:
+                        st.success("Registration successful! Please login.")
+                        st.session_state['show_register'] = False
+                        st.rerun()
+                    else:
+                        st.error(error)
 
         st.markdown("---")
         if st.button("Back to Login", use_container_width=True):
@@ -140,114 +154,450 @@ def detection_page():
         batch_image_detection()
 
 # --- Single Image Detection ---
+# Below this the result is flagged to the user (independent of TTA_THRESHOLD)
+LOW_CONFIDENCE_THRESHOLD = 0.3
+
 def single_image_detection():
     col1, col2 = st.columns([1,1])
     with col1:
         st.subheader("📤 Upload Image")
         uploaded_file = st.file_uploader("Choose an image", type=['jpg','jpeg','png'], key="single_upload")
         if uploaded_file is not None:
-            image = Image.open(uploaded_file)
+            with stage_timer("decode"):
+                image = Image.open(uploaded_file)
+                image.load()
             st.image(image, caption="Uploaded Image", use_container_width=True)
             notes = st.text_area("Add notes (optional)", key="single_notes")
+            crop = st.selectbox(
+                "🌱 Crop", ["Detect automatically"] + list(load_model().crops), key="single_crop",
+                help="If you know the crop, only its diseases are considered."
+            )
+            refine = st.checkbox("🎯 Re-check low-confidence results with test-time augmentation", value=True, key="single_tta")
+            reuse = st.checkbox("♻️ Reuse the earlier result for near-duplicate photos", value=True, key="single_reuse")
+            tiled = st.checkbox(
+                "🔬 High-resolution analysis (overlapping tiles)", value=False, key="single_tiled",
+                help="Slower. Scans the full-resolution photo tile by tile so small lesions on whole-plant photos aren't lost."
+            )
             if st.button("🔍 Analyze Image", type="primary", key="single_analyze"):
                 with st.spinner("Analyzing image..."):
                     try:
                         model = load_model()
-                        result = model.predict(image)
-                        db = SessionLocal()
-                        try:
-                            save_detection(db=db,
-                                user_id=st.session_state['user_id'],
-                                image_name=uploaded_file.name,
-                                predicted_class=result['predicted_class'],
-                                confidence=result['confidence'],
-                                top_3_predictions=result['top_3_predictions'],
-                                notes=notes if notes else None
-                            )
-                        finally:
-                            db.close()
+                        db = get_request_db()
+                        result, detection_id = analyze_upload(
+                            model, db, image, uploaded_file.name, refine, reuse, notes=notes if notes else None,
+                            tiled=tiled, data=uploaded_file.getvalue(),
+                            crop=None if crop == "Detect automatically" else crop
+                        )
+                        st.session_state['prediction_heatmap'] = (
+                            heatmap_overlay(image, result['heatmap']) if result.get('heatmap') is not None else None
+                        )
                         st.session_state['prediction_result'] = result
+                        st.session_state['prediction_detection_id'] = detection_id
                         st.session_state['analyzed'] = True
                         st.rerun()
                     except Exception as e:
+                        record_error("single", e)
                         st.error(f"Error analyzing image: {str(e)}")
         else:
             st.info("Upload an image to start.")
 
     with col2:
         st.subheader("📊 Analysis Results")
-        if 'analyzed' in st.session_state and st.session_state['analyzed']:
+        if st.session_state.get('analyzed') and st.session_state['prediction_result']['is_ood']:
+            st.warning(
+                "🚫 **Image not recognized as a supported crop leaf.** "
+                "Please upload a close-up photo of a single Tomato, Potato or Pepper leaf. "
+                "This result was not saved to your history."
+            )
+        elif 'analyzed' in st.session_state and st.session_state['analyzed']:
             result = st.session_state['prediction_result']
-            predicted_class = result['predicted_class']
+            labels = load_model().labels
+            label = labels[result['class_index']]
             confidence = result['confidence']
-            crop, disease = parse_disease_name(predicted_class)
+            crop, disease = label.crop, label.disease
             st.success("**Analysis Complete!**")
-            if confidence < 0.3:
+            if confidence < LOW_CONFIDENCE_THRESHOLD:
                 st.warning("⚠️ Low confidence detection")
+            if result.get('tta'):
+                st.caption(f"🎯 Refined with test-time augmentation (first pass: {result['first_pass_confidence']*100:.1f}%)")
+            if result.get('duplicate_of'):
+                st.info(duplicate_message(result))
+            if result.get('tile_count'):
+                st.caption(f"🔬 Merged from {result['tile_count']} overlapping tiles")
             st.metric("Detected Condition", disease, delta=f"{confidence*100:.1f}% confidence")
             st.metric("Crop Type", crop)
             st.markdown("#### Top 3 Predictions:")
             for i, pred in enumerate(result['top_3_predictions'],1):
-                _, pred_disease = parse_disease_name(pred['class'])
+                pred_disease = labels[pred['index']].disease
                 st.progress(pred['confidence'], text=f"{i}. {pred_disease} - {pred['confidence']*100:.1f}%")
+            if st.session_state.get('prediction_heatmap') is not None:
+                st.image(st.session_state['prediction_heatmap'], caption="Disease heatmap (red = likely diseased)",
+                         use_container_width=True)
         else:
             st.info("Upload an image and click 'Analyze Image' to see results")
 
-    if 'analyzed' in st.session_state and st.session_state['analyzed']:
-        display_disease_information(st.session_state['prediction_result']['predicted_class'])
+    if st.session_state.get('analyzed') and not st.session_state['prediction_result']['is_ood']:
+        label = load_model().labels[st.session_state['prediction_result']['class_index']]
+        display_disease_information(label.info)
+        display_similar_cases(st.session_state['prediction_result'], st.session_state.get('prediction_detection_id'))
 
 # --- Batch Image Detection ---
 def batch_image_detection():
+    upload_mode = st.radio("Upload type", ["🖼️ Image files", "🗜️ ZIP/TAR archive"], horizontal=True, key="batch_mode")
+    if upload_mode == "🗜️ ZIP/TAR archive":
+        archive_batch_detection()
+        return
+
     st.subheader("📦 Upload Multiple Images")
     uploaded_files = st.file_uploader("Choose multiple images", type=['jpg','jpeg','png'], accept_multiple_files=True, key="batch_upload")
     if uploaded_files:
         st.info(f"{len(uploaded_files)} images uploaded")
-        if st.button("🔍 Analyze All Images", type="primary", key="batch_analyze"):
+        refine = st.checkbox("🎯 Re-check low-confidence results with test-time augmentation", value=True, key="batch_tta")
+        background = st.checkbox(
+            "⏳ Run in the background (keeps going if you leave or reload the page)",
+            value=len(uploaded_files) > JOB_INLINE_LIMIT, key="batch_background"
+        )
+        if background:
+            priority = st.radio("Priority", list(JOB_PRIORITIES), index=1, horizontal=True, key="batch_priority")
+            if st.button("📨 Submit Background Job", type="primary", key="batch_submit"):
+                submit_background_job(uploaded_files, refine, JOB_PRIORITIES[priority])
+        else:
+            reuse = st.checkbox("♻️ Reuse the earlier result for near-duplicate photos", value=True, key="batch_reuse")
+        if not background and st.button("🔍 Analyze All Images", type="primary", key="batch_analyze"):
             model = load_model()
-            db = SessionLocal()
+            db = get_request_db()
             progress_bar = st.progress(0)
             status_text = st.empty()
             results = []
-            try:
+            with maybe_profile("batch"):
                 for idx, uploaded_file in enumerate(uploaded_files):
                     status_text.text(f"Processing {idx+1}/{len(uploaded_files)}: {uploaded_file.name}")
                     try:
-                        image = Image.open(uploaded_file)
-                        result = model.predict(image)
-                        save_detection(db=db,
-                            user_id=st.session_state['user_id'],
-                            image_name=uploaded_file.name,
-                            predicted_class=result['predicted_class'],
-                            confidence=result['confidence'],
-                            top_3_predictions=result['top_3_predictions']
-                        )
+                        with stage_timer("decode"):
+                            image = Image.open(uploaded_file)
+                            image.load()
+                        result, _ = analyze_upload(model, db, image, uploaded_file.name, refine, reuse,
+                                                   data=uploaded_file.getvalue())
                         results.append({'filename': uploaded_file.name, 'result': result, 'success': True})
                     except Exception as e:
+                        record_error("batch", e)
+                        db.rollback()
                         results.append({'filename': uploaded_file.name, 'error': str(e), 'success': False})
                     progress_bar.progress((idx+1)/len(uploaded_files))
-                status_text.text("✅ Batch processing complete!")
-                st.markdown("### Batch Results")
-                for idx, res in enumerate(results,1):
-                    with st.expander(f"{idx}. {res['filename']}", expanded=False):
-                        if res['success']:
-                            result = res['result']
-                            crop, disease = parse_disease_name(result['predicted_class'])
-                            col1, col2, col3 = st.columns(3)
-                            with col1:
-                                st.metric("Crop", crop)
-                            with col2:
-                                st.metric("Disease", disease)
-                            with col3:
-                                st.metric("Confidence", f"{result['confidence']*100:.1f}%")
+            status_text.text("✅ Batch processing complete!")
+            st.markdown("### Batch Results")
+            for idx, res in enumerate(results,1):
+                with st.expander(f"{idx}. {res['filename']}", expanded=False):
+                    if res['success'] and res['result']['is_ood']:
+                        st.warning("🚫 Not recognized as a supported crop leaf (not saved)")
+                    elif res['success']:
+                        result = res['result']
+                        label = model.labels[result['class_index']]
+                        crop, disease = label.crop, label.disease
+                        col1, col2, col3 = st.columns(3)
+                        with col1:
+                            st.metric("Crop", crop)
+                        with col2:
+                            st.metric("Disease", disease)
+                        with col3:
+                            st.metric("Confidence", f"{result['confidence']*100:.1f}%")
+                        if result.get('duplicate_of'):
+                            st.caption(duplicate_message(result))
+                    else:
+                        st.error(f"Error: {res['error']}")
+
+    background_jobs_section()
+
+# --- Background Jobs ---
+JOB_STATUS_LABELS = {
+    'queued': "🕒 Queued", 'running': "⚙️ Running", 'succeeded': "✅ Done",
+    'failed': "❌ Failed", 'cancelled': "🚫 Cancelled",
+}
+
+def submit_background_job(uploaded_files, refine, priority):
+    """Store the uploads in the blob store and queue them for a worker"""
+    store = load_blob_store()
+    items = [{'name': f.name, 'sha256': store.put(f.getvalue())} for f in uploaded_files]
+    job = submit_job(get_request_db(), st.session_state['user_id'], items,
+                     {'tta': 'auto' if refine else 'off'}, priority)
+    st.success(f"📨 Job #{job.id} queued with {len(items)} images. Results are saved to your history as they finish.")
+
+@st.fragment(run_every=3)
+def background_jobs_section():
+    user_id = st.session_state['user_id']
+    with request_scope():
+        db = get_request_db()
+        jobs = list_user_jobs(db, user_id, limit=10)
+        if not jobs:
+            return
+        st.markdown("### ⏳ Background Jobs")
+        if any(job.status == 'queued' for job in jobs):
+            st.caption("Jobs are run by worker processes: `python job_queue.py worker`")
+        for job in jobs:
+            col1, col2 = st.columns([4,1])
+            with col1:
+                st.progress(
+                    job.progress_done / max(job.progress_total, 1),
+                    text=f"Job #{job.id} · {JOB_STATUS_LABELS.get(job.status, job.status)} · "
+                         f"{job.progress_done}/{job.progress_total} images · {job.created_at.strftime('%Y-%m-%d %H:%M')}"
+                )
+                if job.error and job.status != 'succeeded':
+                    st.caption(f"Last error: {job.error}")
+            with col2:
+                if job.status in ACTIVE_STATUSES and not job.cancel_requested:
+                    if st.button("✖️ Cancel", key=f"cancel_job_{job.id}"):
+                        cancel_job(db, job.id, user_id)
+                        st.rerun(scope="fragment")
+                elif job.status in ('failed', 'cancelled'):
+                    if st.button("🔁 Retry", key=f"retry_job_{job.id}"):
+                        retry_job(db, job.id, user_id)
+                        st.rerun(scope="fragment")
+            if job.progress_done:
+                with st.expander(f"Results of job #{job.id}", expanded=False):
+                    for item in job_items(db, job):
+                        if item.get('error'):
+                            st.write(f"- {item['name']}: ❌ {item['error']}")
+                        elif item.get('is_ood'):
+                            st.write(f"- {item['name']}: 🚫 not a supported crop leaf (not saved)")
                         else:
-                            st.error(f"Error: {res['error']}")
-            finally:
-                db.close()
+                            label = label_for_class(item['predicted_class'])
+                            st.write(f"- {item['name']}: **{label.crop} – {label.disease}** ({item['confidence']*100:.1f}%)")
+
+# --- Archive Batch Detection ---
+def archive_batch_detection():
+    st.subheader("🗜️ Upload an Archive of Field Images")
+    archive = st.file_uploader("Choose a ZIP or TAR archive", type=ARCHIVE_TYPES, key="archive_upload")
+    if archive is None:
+        return
+
+    if st.button("🔍 Analyze Archive", type="primary", key="archive_analyze"):
+        model = load_model()
+        db = get_request_db()
+        total = count_archive_images(archive, archive.name)
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+
+        def save_batch(pairs):
+            try:
+                detection_ids = save_detections(db, st.session_state['user_id'], pairs)
+            except Exception:
+                db.rollback()  # keep the shared session usable for the next batch
+                raise
+            # The detections are committed; an index failure must not mark them failed
+            try:
+                index_embeddings([(i, result) for i, (_, result) in zip(detection_ids, pairs)])
+            except Exception as e:
+                record_error("embedding_index", e)
+
+        def on_batch(done, summary):
+            if total:
+                progress_bar.progress(min(done / total, 1.0))
+            status_text.text(f"Processed {done}{f'/{total}' if total else ''} images ({summary['failed']} failed)")
+
+        previous = st.session_state.pop('archive_results', None)
+        if previous and os.path.exists(previous[0]):
+            os.remove(previous[0])
+        fd, csv_path = tempfile.mkstemp(prefix="archive_results_", suffix=".csv")
+        try:
+            with maybe_profile("batch"), os.fdopen(fd, 'w', newline='', encoding='utf-8') as csv_file:
+                summary = process_archive(model, archive, archive.name, csv_file,
+                                          on_batch=on_batch, save_batch=save_batch,
+                                          blob_store=load_blob_store())
+        except Exception as e:
+            record_error("archive", e)
+            db.rollback()
+            st.error(f"Error reading archive: {str(e)}")
+            return
+        progress_bar.progress(1.0)
+        status_text.text(
+            f"✅ Archive complete: {summary['processed']} analyzed, "
+            f"{summary['rejected']} rejected as unsupported, {summary['failed']} failed"
+        )
+        st.session_state['archive_results'] = (csv_path, archive.name, summary)
+
+    archive_results = st.session_state.get('archive_results')
+    if archive_results and os.path.exists(archive_results[0]):
+        csv_path, name, summary = archive_results
+        st.markdown("### Archive Results")
+        for cls, count in sorted(summary['by_class'].items(), key=lambda x: x[1], reverse=True):
+            label = label_for_class(cls)
+            st.write(f"- **{label.crop} – {label.disease}**: {count} image(s)")
+        with open(csv_path, 'rb') as f:
+            st.download_button(
+                "⬇️ Download annotated results (CSV)",
+                data=f,
+                file_name=f"{os.path.splitext(name)[0]}_results.csv",
+                mime="text/csv",
+                use_container_width=True
+            )
+
+# --- Stored Photos ---
+@st.cache_resource
+def load_blob_store():
+    return BlobStore()
+
+def display_stored_photo(detection):
+    """Thumbnail and original download for a history row, read only when asked for"""
+    if not detection.image_sha256:
+        return
+    if not st.checkbox("🖼️ Show photo", key=f"photo_{detection.id}"):
+        return
+    store = load_blob_store()
+    thumbnail = store.read_thumbnail(detection.image_sha256)
+    if thumbnail is None:
+        st.caption("Photo no longer available")
+        return
+    st.image(thumbnail, width=256)
+    try:
+        original = store.read(detection.image_sha256)
+    except FileNotFoundError:
+        return
+    st.download_button("⬇️ Original", data=original, file_name=detection.image_name or f"{detection.id}.jpg",
+                       key=f"original_{detection.id}")
+
+# --- Near-Duplicate Uploads ---
+@st.cache_resource
+def load_duplicate_index():
+    return NearDuplicateIndex()
+
+def find_near_duplicate(db, image_hash):
+    """(detection, distance) of the user's closest earlier near-identical photo, or None"""
+    user_id = st.session_state['user_id']
+    matches = load_duplicate_index().find(db, user_id, image_hash)
+    if not matches:
+        return None
+    # Deleted detections may still be in the index; take the closest one that exists
+    detections = {d.id: d for d in get_detections_by_ids(db, user_id, [i for _, i in matches])}
+    for distance, detection_id in matches:
+        if detection_id in detections:
+            return detections[detection_id], distance
+    return None
+
+def analyze_upload(model, db, image, image_name, refine, reuse, notes=None, tiled=False, data=None, crop=None):
+    """Predict (or reuse a near-duplicate's result) and save; returns (result, detection_id).
+
+    data: the uploaded bytes, kept in the blob store with a thumbnail when the result is saved.
+    crop: the crop the user says is in the photo, if any.
+    """
+    with stage_timer("preprocess"):
+        processed = model.preprocess_image(image)
+    image_hash = phash(processed)
+    duplicate = find_near_duplicate(db, image_hash)
+    duplicate_of = None
+    if duplicate is not None:
+        detection, distance = duplicate
+        duplicate_of = {
+            'id': detection.id,
+            'image_name': detection.image_name,
+            'date': detection.detection_date.strftime('%Y-%m-%d'),
+            'distance': distance,
+        }
+        # A tiled analysis is never replaced by an earlier whole-image result, nor a crop hint by another crop
+        crop_matches = crop is None or (detection.crop_type or "").lower() == crop.lower()
+        result = result_from_detection(detection) if reuse and not tiled and crop_matches else None
+        if result is not None:
+            CACHE.inc(cache="near_duplicate", result="hit")
+            result['duplicate_of'] = dict(duplicate_of, reused=True)
+            if notes:
+                # No new entry is saved, so the notes go on the earlier one
+                detection.notes = f"{detection.notes}\n{notes}" if detection.notes else notes
+                db.commit()
+                result['duplicate_of']['notes_added'] = True
+            return result, detection.id
+    CACHE.inc(cache="near_duplicate", result="miss")
+
+    if tiled:
+        result = model.predict_tiled(image, crop=crop)
+    else:
+        result = model.predict(image, tta='auto' if refine else 'off', processed=processed,
+                               image_hash=image_hash, crop=crop)
+    result['duplicate_of'] = duplicate_of
+    detection_id = None
+    if not result['is_ood']:
+        image_sha256 = load_blob_store().put(data, image) if data is not None else None
+        detection = save_detection(db=db,
+            user_id=st.session_state['user_id'],
+            image_name=image_name,
+            predicted_class=result['predicted_class'],
+            confidence=result['confidence'],
+            top_3_predictions=result['top_3_predictions'],
+            notes=notes,
+            image_hash=result['image_hash'],
+            model_version=result['model_version'],
+            probabilities=result['all_predictions'],
+            image_sha256=image_sha256
+        )
+        detection_id = detection.id
+        index_embeddings([(detection_id, result)])
+    return result, detection_id
+
+def duplicate_message(result):
+    dup = result['duplicate_of']
+    source = f"**{dup['image_name']}** from {dup['date']} ({dup['distance']}/64 hash bits differ)"
+    if dup.get('reused'):
+        notes = " Your notes were added to that entry." if dup.get('notes_added') else ""
+        return f"♻️ Near-duplicate of {source} — showing the earlier result; no new history entry was saved.{notes}"
+    return f"♻️ Near-duplicate of {source} — analyzed again and saved."
+
+# --- Similar Cases ---
+@st.cache_resource
+def load_similarity_indexes(version):
+    """Indexes for one model version: embeddings from different versions aren't comparable"""
+    return (get_detection_index(version=version), get_reference_index(version=version),
+            load_reference_paths(version=version))
+
+def index_embeddings(pairs):
+    """Add (detection_id, result) embeddings to the similar-case index"""
+    detection_index = load_similarity_indexes(pairs[0][1].get('model_version'))[0]
+    try:
+        detection_index.add(
+            np.stack([result['embedding'] for _, result in pairs]),
+            [detection_id for detection_id, _ in pairs],
+            [st.session_state['user_id']] * len(pairs)
+        )
+    except ValueError as e:
+        # e.g. a model with a different embedding size; similar cases just won't include these
+        record_error("embedding_index", e)
+
+def display_similar_cases(result, detection_id):
+    if 'embedding' not in result:
+        return
+    detection_index, reference_index, reference_paths = load_similarity_indexes(result.get('model_version'))
+    embedding = result['embedding']
+    user_id = st.session_state['user_id']
+
+    past = []
+    if detection_index.dim == len(embedding):
+        exclude = (detection_id,) if detection_id is not None else ()
+        past = detection_index.search(embedding, k=3, owner_id=user_id, exclude_ids=exclude)
+    references = []
+    if reference_paths and reference_index.dim == len(embedding):
+        references = reference_index.search(embedding, k=3)
+    if not past and not references:
+        return
+
+    st.markdown("---")
+    st.subheader("🔁 Similar Previously Diagnosed Leaves")
+    if past:
+        scores = {item_id: score for item_id, _, score in past}
+        for detection in get_detections_by_ids(get_request_db(), user_id, [item_id for item_id, _, _ in past]):
+            st.write(
+                f"- **{detection.crop_type} – {detection.disease_name}** "
+                f"({detection.image_name}, {detection.detection_date.strftime('%Y-%m-%d')}) · "
+                f"{scores[detection.id]*100:.0f}% similar"
+            )
+    if references:
+        st.markdown("**Reference dataset images:**")
+        cols = st.columns(len(references))
+        for col, (row, _, score) in zip(cols, references):
+            path = reference_paths[row]
+            label = label_for_class(os.path.basename(os.path.dirname(path)))
+            with col:
+                st.image(path, caption=f"{label.crop} – {label.disease} · {score*100:.0f}% similar", use_container_width=True)
 
 # --- Disease Info Display ---
-def display_disease_information(predicted_class):
+def display_disease_information(disease_info):
     st.markdown("---")
-    disease_info = get_disease_info(predicted_class)
     st.subheader(f"📋 Disease Information: {disease_info['name']}")
     tab1, tab2, tab3, tab4 = st.tabs(["🔬 Overview", "🩺 Symptoms", "💊 Treatment", "🛡️ Prevention"])
     with tab1:
@@ -278,63 +628,158 @@ def dashboard_page():
         if st.button("Logout", use_container_width=True):
             st.session_state.clear()
             st.rerun()
-    db = SessionLocal()
-    try:
-        stats = get_user_stats(db, st.session_state['user_id'])
-        detections = get_user_detections(db, st.session_state['user_id'], limit=50)
+    db = get_request_db()
+    stats = get_user_stats(db, st.session_state['user_id'])
 
-        st.markdown("### 📈 Your Statistics")
-        col1, col2, col3, col4 = st.columns(4)
-        with col1: st.metric("Total Scans", stats['total_scans'])
-        with col2: st.metric("Healthy Plants", stats['healthy_count'])
-        with col3: st.metric("Diseased Plants", stats['diseased_count'])
-        health_rate = (stats['healthy_count'] / stats['total_scans'] * 100) if stats['total_scans'] > 0 else 0
-        with col4: st.metric("Health Rate", f"{health_rate:.1f}%")
+    st.markdown("### 📈 Your Statistics")
+    col1, col2, col3, col4 = st.columns(4)
+    with col1: st.metric("Total Scans", stats['total_scans'])
+    with col2: st.metric("Healthy Plants", stats['healthy_count'])
+    with col3: st.metric("Diseased Plants", stats['diseased_count'])
+    health_rate = (stats['healthy_count'] / stats['total_scans'] * 100) if stats['total_scans'] > 0 else 0
+    with col4: st.metric("Health Rate", f"{health_rate:.1f}%")
 
-        st.markdown("---")
+    st.markdown("---")
 
-        if stats['crops_analyzed']:
-            st.markdown("### 🌾 Crops Analyzed")
-            for crop, count in stats['crops_analyzed'].items():
-                st.metric(crop, count)
+    if stats['crops_analyzed']:
+        st.markdown("### 🌾 Crops Analyzed")
+        for crop, count in stats['crops_analyzed'].items():
+            st.metric(crop, count)
 
-        if stats['diseases_detected']:
-            st.markdown("### 🦠 Diseases Detected")
-            for disease, count in sorted(stats['diseases_detected'].items(), key=lambda x: x[1], reverse=True)[:5]:
-                st.write(f"- **{disease}**: {count} occurrence(s)")
+    if stats['diseases_detected']:
+        st.markdown("### 🦠 Diseases Detected")
+        for disease, count in sorted(stats['diseases_detected'].items(), key=lambda x: x[1], reverse=True)[:5]:
+            st.write(f"- **{disease}**: {count} occurrence(s)")
 
-        st.markdown("---")
+    st.markdown("---")
+    history_export_section(db)
+
+    st.markdown("---")
+    if stats['total_scans']:
+        history_search_section(db)
+    else:
         st.markdown("### 📜 Detection History")
+        st.info("No detection history yet. Start analyzing images to build your history!")
 
-        if detections:
-            for detection in detections:
-                with st.expander(f"🔍 {detection.disease_name} - {detection.detection_date.strftime('%Y-%m-%d %H:%M')}", expanded=False):
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.write(f"**Crop:** {detection.crop_type}")
-                        st.write(f"**Confidence:** {detection.confidence*100:.1f}%")
-                    with col2:
-                        st.write(f"**Image:** {detection.image_name}")
-                        st.write(f"**Date:** {detection.detection_date.strftime('%Y-%m-%d %H:%M')}")
-                    with col3:
-                        if detection.notes:
-                            st.write(f"**Notes:** {detection.notes}")
-                    if detection.top_3_predictions:
-                        st.markdown("**Top 3 Predictions:**")
-                        try:
-                            top_3 = json.loads(detection.top_3_predictions)
-                            for i, pred in enumerate(top_3,1):
-                                _, disease = parse_disease_name(pred['class'])
-                                st.write(f"{i}. {disease} ({pred['confidence']*100:.1f}%)")
-                        except:
-                            pass
-        else:
-            st.info("No detection history yet. Start analyzing images to build your history!")
-    finally:
-        db.close()
+# --- History Search ---
+HISTORY_PAGE_SIZE = 50
+
+def history_search_section(db):
+    st.markdown("### 📜 Detection History")
+    query = st.text_input("🔎 Search notes and image names", key="history_query",
+                          placeholder="e.g. yellow spots, IMG_0042")
+    col_conf, col_dates = st.columns(2)
+    with col_conf:
+        min_conf, max_conf = st.slider("Confidence (%)", 0, 100, (0, 100), key="history_confidence")
+    with col_dates:
+        dates = st.date_input("Date range", value=(), key="history_dates")
+    date_from, date_to = (tuple(dates) + (None, None))[:2]
+
+    # Facet selections come from the previous rerun, so the counts can label the options
+    crops = st.session_state.get('history_crops', [])
+    diseases = st.session_state.get('history_diseases', [])
+    results = search_detections(
+        db, st.session_state['user_id'], query, crops, diseases,
+        min_confidence=min_conf / 100 if min_conf > 0 else None,
+        max_confidence=max_conf / 100 if max_conf < 100 else None,
+        date_from=date_from, date_to=date_to,
+        limit=st.session_state.get('history_limit', HISTORY_PAGE_SIZE)
+    )
+    facets = results['facets']
+    col_crop, col_disease = st.columns(2)
+    with col_crop:
+        st.multiselect("Crop", facet_options(facets['crop_type'], crops), key="history_crops",
+                       format_func=lambda v: f"{v} ({facets['crop_type'].get(v, 0)})")
+    with col_disease:
+        st.multiselect("Disease", facet_options(facets['disease_name'], diseases), key="history_diseases",
+                       format_func=lambda v: f"{v} ({facets['disease_name'].get(v, 0)})")
+
+    st.caption(f"{results['total']} matching scan(s)")
+    for detection in results['rows']:
+        display_history_entry(detection)
+    if results['total'] > len(results['rows']):
+        if st.button(f"Show more ({results['total'] - len(results['rows'])} remaining)"):
+            st.session_state['history_limit'] = len(results['rows']) + HISTORY_PAGE_SIZE
+            st.rerun()
+
+def facet_options(counts, selected):
+    """Facet values by count, keeping current selections even when nothing matches them"""
+    options = [value for value in counts if value is not None]
+    return options + [value for value in selected if value not in counts]
+
+def display_history_entry(detection):
+    with st.expander(f"🔍 {detection.disease_name} - {detection.detection_date.strftime('%Y-%m-%d %H:%M')}", expanded=False):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.write(f"**Crop:** {detection.crop_type}")
+            st.write(f"**Confidence:** {detection.confidence*100:.1f}%")
+        with col2:
+            st.write(f"**Image:** {detection.image_name}")
+            st.write(f"**Date:** {detection.detection_date.strftime('%Y-%m-%d %H:%M')}")
+        with col3:
+            if detection.notes:
+                st.write(f"**Notes:** {detection.notes}")
+        top_3 = detection_top_k(detection, 3)
+        if top_3:
+            st.markdown("**Top 3 Predictions:**")
+            for i, pred in enumerate(top_3,1):
+                disease = label_for_class(pred['class']).disease
+                st.write(f"{i}. {disease} ({pred['confidence']*100:.1f}%)")
+        display_stored_photo(detection)
+
+# --- History Export ---
+EXPORT_MIME_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+# st.download_button holds the whole file in the app process, so bigger exports go through the CLI
+EXPORT_DOWNLOAD_MAX_MB = float(os.getenv('EXPORT_DOWNLOAD_MAX_MB', 100))
+
+def history_export_section(db):
+    st.markdown("### 📥 Export Full History")
+    col_fmt, col_btn = st.columns([1,1])
+    with col_fmt:
+        fmt = st.selectbox("Format", list(EXPORT_MIME_TYPES), key="export_format", label_visibility="collapsed")
+    with col_btn:
+        if st.button("Prepare Export", use_container_width=True):
+            previous = st.session_state.pop('export_file', None)
+            if previous and os.path.exists(previous[0]):
+                os.remove(previous[0])
+            # Rows are streamed straight to disk; the finished file is served only up to EXPORT_DOWNLOAD_MAX_MB
+            fd, path = tempfile.mkstemp(prefix="history_", suffix=f".{fmt}")
+            os.close(fd)
+            try:
+                count = export_detections(db, st.session_state['user_id'], path, fmt)
+                size_mb = os.path.getsize(path) / 2**20
+                if size_mb > EXPORT_DOWNLOAD_MAX_MB:
+                    os.remove(path)
+                    st.warning(
+                        f"⚠️ This export is {size_mb:.0f} MB, more than the {EXPORT_DOWNLOAD_MAX_MB:.0f} MB the app "
+                        f"can serve. Ask an administrator to run "
+                        f"`python export_utils.py --user {st.session_state['username']} --format {fmt}`."
+                    )
+                else:
+                    st.session_state['export_file'] = (path, fmt, count)
+            except Exception as e:
+                os.remove(path)
+                st.error(f"Export failed: {str(e)}")
+
+    export_file = st.session_state.get('export_file')
+    if export_file and os.path.exists(export_file[0]):
+        path, fmt, count = export_file
+        with open(path, 'rb') as f:
+            st.download_button(
+                f"⬇️ Download {count} detections ({fmt.upper()})",
+                data=f,
+                file_name=f"detection_history.{fmt}",
+                mime=EXPORT_MIME_TYPES[fmt],
+                use_container_width=True
+            )
 
 # --- Main Application ---
 def main():
+    with request_scope() as db_scope:
+        render_app()
+        st.session_state['last_db_stats'] = db_scope.stats()
+
+def render_app():
     init_session_state()
     if not st.session_state['logged_in']:
         if st.session_state['show_register']:
@@ -360,6 +805,16 @@ def main():
             - 🌽 Corn/Maize (4 classes)
             - 🥔 Potato (3 classes)
             """)
+        if DB_STATS_ENABLED and 'last_db_stats' in st.session_state:
+            db_stats = st.session_state['last_db_stats']
+            st.sidebar.caption(
+                f"🗄️ Last rerun: {db_stats['checkouts']} connection checkout(s), "
+                f"{db_stats['connections_opened']} new, {db_stats['queries']} queries"
+            )
+        model_status = get_model_manager().status()
+        if model_status['version']:
+            st.sidebar.caption(f"🧠 Model version: {model_status['version']}"
+                               + (f" (loading {model_status['loading']}…)" if model_status['loading'] else ""))
         if page == "🔍 Detect Disease":
             detection_page()
         else:
@@ -0,0 +1,182 @@
+"""Streaming classification of image archives (ZIP / TAR / TAR.GZ).
+
+Archive members are decoded lazily, classified in fixed-size batches,
+persisted per batch and released, so peak memory is bounded by the batch
+size rather than the archive size. An annotated results CSV is written
+incrementally alongside.
+"""
+import csv
+import io
+import os
+import tarfile
+import zipfile
+
+from PIL import Image
+
+from metrics import stage_timer, record_error
+
+ARCHIVE_TYPES = ['zip', 'tar', 'gz', 'tgz']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 16))
+# Skip members that claim to be larger than this when uncompressed
+MAX_MEMBER_BYTES = int(os.getenv('ARCHIVE_MAX_MEMBER_MB', 50)) * 1024 * 1024
+
+REJECTED_OOD = "Rejected: not a supported crop leaf"
+
+RESULT_COLUMNS = [
+    'filename', 'predicted_class', 'crop', 'disease', 'confidence',
+    'top2_class', 'top2_confidence', 'top3_class', 'top3_confidence', 'error'
+]
+
+
+def _is_image_member(name):
+    base = os.path.basename(name)
+    return (
+        name.lower().endswith(IMAGE_EXTENSIONS)
+        and not base.startswith('.')
+        and '__MACOSX/' not in name
+    )
+
+
+def _decode(fileobj):
+    """(image, raw bytes) for one member"""
+    with stage_timer("decode"):
+        data = fileobj.read()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return (image.convert('RGB') if image.mode != 'RGB' else image), data
+
+
+def iter_archive_images(fileobj, filename):
+    """Yield (member_name, image, raw_bytes, error) for each image member, one at a time"""
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not _is_image_member(info.filename):
+                    continue
+                if info.file_size > MAX_MEMBER_BYTES:
+                    yield info.filename, None, None, "File too large"
+                    continue
+                try:
+                    with zf.open(info) as member:
+                        yield (info.filename, *_decode(member), None)
+                except Exception as e:
+                    record_error("archive_decode", e)
+                    yield info.filename, None, None, str(e)
+    else:
+        # 'r|*' reads the tar as a forward-only stream (any compression)
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+            for member in tf:
+                if not member.isfile() or not _is_image_member(member.name):
+                    continue
+                if member.size > MAX_MEMBER_BYTES:
+                    yield member.name, None, None, "File too large"
+                    continue
+                try:
+                    yield (member.name, *_decode(tf.extractfile(member)), None)
+                except Exception as e:
+                    record_error("archive_decode", e)
+                    yield member.name, None, None, str(e)
+
+
+def count_archive_images(fileobj, filename):
+    """Number of image members if cheaply known (ZIP central directory), else None"""
+    if not filename.lower().endswith('.zip'):
+        return None
+    with zipfile.ZipFile(fileobj) as zf:
+        total = sum(1 for i in zf.infolist() if not i.is_dir() and _is_image_member(i.filename))
+    fileobj.seek(0)
+    return total
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _result_row(name, result=None, labels=None, error=None):
+    row = dict.fromkeys(RESULT_COLUMNS)
+    row['filename'] = name
+    if error is not None:
+        row['error'] = error
+        return row
+    label = labels[result['class_index']]
+    row.update(
+        predicted_class=result['predicted_class'],
+        crop=label.crop,
+        disease=label.disease,
+        confidence=round(result['confidence'], 4),
+    )
+    for i, pred in enumerate(result['top_3_predictions'][1:3], 2):
+        row[f'top{i}_class'] = pred['class']
+        row[f'top{i}_confidence'] = round(pred['confidence'], 4)
+    return row
+
+
+def process_archive(model, fileobj, filename, csv_file, on_batch=None, save_batch=None,
+                    batch_size=ARCHIVE_BATCH_SIZE, blob_store=None):
+    """Classify every image in an archive in streaming batches.
+
+    csv_file: open text file that receives one annotated row per member.
+    save_batch(pairs): called with [(member_name, result), ...] to persist a batch; if it
+    raises, only that batch's rows are marked failed, so it must leave its session usable.
+    on_batch(done, summary): progress callback after each batch.
+    blob_store: if given, accepted images are stored and result['image_sha256'] is set.
+    Returns a summary dict of counts.
+    """
+    writer = csv.DictWriter(csv_file, fieldnames=RESULT_COLUMNS)
+    writer.writeheader()
+    summary = {'processed': 0, 'rejected': 0, 'failed': 0, 'by_class': {}}
+
+    for batch in iter_batches(iter_archive_images(fileobj, filename), batch_size):
+        good = [(name, image, data) for name, image, data, error in batch if error is None]
+        rows = [_result_row(name, error=error) for name, _, _, error in batch if error is not None]
+        summary['failed'] += len(rows)
+
+        results = None
+        if good:
+            try:
+                results = model.predict_batch([image for _, image, _ in good], batch_size=batch_size)
+            except Exception as e:
+                record_error("archive_batch", e)
+                rows.extend(_result_row(name, error=str(e)) for name, _, _ in good)
+                summary['failed'] += len(good)
+
+        if results is not None:
+            pairs = [(name, r) for (name, _, _), r in zip(good, results) if not r['is_ood']]
+            rejected = [name for (name, _, _), r in zip(good, results) if r['is_ood']]
+            rows.extend(_result_row(name, error=REJECTED_OOD) for name in rejected)
+            summary['rejected'] += len(rejected)
+            # Saving fails separately from prediction; save_batch rolls back its own session
+            try:
+                if blob_store is not None:
+                    for (_, image, data), r in zip(good, results):
+                        if not r['is_ood']:
+                            r['image_sha256'] = blob_store.put(data, image)
+                if save_batch is not None and pairs:
+                    save_batch(pairs)
+            except Exception as e:
+                record_error("archive_save", e)
+                rows.extend(_result_row(name, error=f"not saved: {e}") for name, _ in pairs)
+                summary['failed'] += len(pairs)
+            else:
+                for name, result in pairs:
+                    rows.append(_result_row(name, result, model.labels))
+                    cls = result['predicted_class']
+                    summary['by_class'][cls] = summary['by_class'].get(cls, 0) + 1
+                summary['processed'] += len(pairs)
+
+        writer.writerows(rows)
+        csv_file.flush()
+        # Drop decoded images before the next batch is read
+        del good, batch
+        if on_batch is not None:
+            on_batch(summary['processed'] + summary['rejected'] + summary['failed'], summary)
+
+    return summary
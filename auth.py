@@ -1,31 +1,138 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import bcrypt
 from sqlalchemy.orm import Session
 from models import User
 from datetime import datetime
 
+# bcrypt work factor for new hashes; existing hashes are upgraded on login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# bcrypt releases the GIL, so a small thread pool caps the CPU it can take
+AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', 2))
+# Hash jobs allowed to wait for a worker before new logins are turned away
+AUTH_QUEUE_LIMIT = int(os.getenv('AUTH_QUEUE_LIMIT', 16))
+AUTH_QUEUE_TIMEOUT = float(os.getenv('AUTH_QUEUE_TIMEOUT', 10))
+
+LOGIN_MAX_FAILURES = int(os.getenv('LOGIN_MAX_FAILURES', 5))
+LOGIN_FAILURE_WINDOW = int(os.getenv('LOGIN_FAILURE_WINDOW', 300))
+LOGIN_LOCKOUT_SECONDS = int(os.getenv('LOGIN_LOCKOUT_SECONDS', 60))
+
+_hash_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="bcrypt")
+_hash_slots = threading.BoundedSemaphore(AUTH_WORKERS + AUTH_QUEUE_LIMIT)
+
+
+class AuthBusyError(RuntimeError):
+    """Raised when the hashing pool is saturated"""
+
+
+def _run_hash_job(fn, *args):
+    """Run a bcrypt call on the worker pool and wait for its result"""
+    if not _hash_slots.acquire(timeout=AUTH_QUEUE_TIMEOUT):
+        raise AuthBusyError("Authentication service is busy, please try again")
+    try:
+        return _hash_pool.submit(fn, *args).result()
+    finally:
+        _hash_slots.release()
+
+
+class LoginThrottle:
+    """Per-username failed-login counter with a temporary lockout"""
+
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, window=LOGIN_FAILURE_WINDOW,
+                 lockout=LOGIN_LOCKOUT_SECONDS):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self._failures = {}
+        self._locked_until = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, username: str) -> int:
+        """Seconds until the username may try again (0 if not locked)"""
+        key = username.lower()
+        with self._lock:
+            until = self._locked_until.get(key)
+            if until is None:
+                return 0
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                del self._locked_until[key]
+                return 0
+            return int(remaining) + 1
+
+    def record_failure(self, username: str):
+        key = username.lower()
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.setdefault(key, deque())
+            failures.append(now)
+            while failures and now - failures[0] > self.window:
+                failures.popleft()
+            if len(failures) >= self.max_failures:
+                self._locked_until[key] = now + self.lockout
+                failures.clear()
+            self._prune(now)
+
+    def record_success(self, username: str):
+        key = username.lower()
+        with self._lock:
+            self._failures.pop(key, None)
+            self._locked_until.pop(key, None)
+
+    def _prune(self, now):
+        # Keep memory bounded when many distinct usernames are tried
+        if len(self._failures) > 10000:
+            for key in [k for k, q in self._failures.items() if not q or now - q[-1] > self.window]:
+                del self._failures[key]
+        if len(self._locked_until) > 10000:
+            for key in [k for k, until in self._locked_until.items() if until <= now]:
+                del self._locked_until[key]
+
+
+login_throttle = LoginThrottle()
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    return _run_hash_job(_hash, password.encode('utf-8'), BCRYPT_ROUNDS).decode('utf-8')
 
 def verify_password(password: str, password_hash: str) -> bool:
     """Verify a password against its hash"""
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    return _run_hash_job(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """True if the hash was made with a different work factor than BCRYPT_ROUNDS"""
+    # bcrypt hashes look like $2b$12$<salt+digest>
+    parts = password_hash.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return True
+    return int(parts[2]) != BCRYPT_ROUNDS
 
 def create_user(db: Session, username: str, email: str, password: str, full_name: str = None):
     """Create a new user"""
     existing_user = db.query(User).filter(
         (User.username == username) | (User.email == email)
     ).first()
-    
+
     if existing_user:
         if existing_user.username == username:
             return None, "Username already exists"
         else:
             return None, "Email already exists"
-    
-    password_hash = hash_password(password)
-    
+
+    try:
+        password_hash = hash_password(password)
+    except AuthBusyError as e:
+        return None, str(e)
+
     new_user = User(
         username=username,
         email=email,
@@ -33,23 +140,44 @@ def create_user(db: Session, username: str, email: str, password: str, full_name
         full_name=full_name,
         created_at=datetime.utcnow()
     )
-    
+
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
-    
+
     return new_user, None
 
 def authenticate_user(db: Session, username: str, password: str):
     """Authenticate a user"""
+    retry_after = login_throttle.retry_after(username)
+    if retry_after:
+        return None, f"Too many failed attempts. Try again in {retry_after} seconds."
+
     user = db.query(User).filter(User.username == username).first()
-    
+
     if not user:
+        login_throttle.record_failure(username)
         return None, "Invalid username or password"
-    
-    if not verify_password(password, user.password_hash):
+
+    try:
+        valid = verify_password(password, user.password_hash)
+    except AuthBusyError as e:
+        return None, str(e)
+
+    if not valid:
+        login_throttle.record_failure(username)
         return None, "Invalid username or password"
-    
+
+    login_throttle.record_success(username)
+
+    # Transparently move the stored hash to the configured work factor
+    if password_needs_rehash(user.password_hash):
+        try:
+            user.password_hash = hash_password(password)
+            db.commit()
+        except AuthBusyError:
+            pass  # keep the old hash; we'll upgrade on a later login
+
     return user, None
 
 def get_user_by_id(db: Session, user_id: int):
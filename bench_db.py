@@ -0,0 +1,149 @@
+"""Concurrency benchmark for the database engine profiles.
+
+Simulates many app sessions saving detections and reading history/stats
+against a throwaway SQLite file, once per engine profile.
+
+    python bench_db.py --sessions 32 --ops 200
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, create_app_engine
+from models import User
+from detection_utils import save_detection, get_user_detections, get_user_stats
+
+CLASSES = [
+    "Tomato_Early_blight",
+    "Tomato_healthy",
+    "Potato___Late_blight",
+    "Pepper__bell___Bacterial_spot",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of samples"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _session_worker(Session, user_id, ops, read_ratio, latencies, errors, lock):
+    """One simulated user: a mix of history writes and dashboard reads"""
+    rng = random.Random(user_id)
+    local_writes, local_reads = [], []
+    for _ in range(ops):
+        db = Session()
+        start = time.perf_counter()
+        try:
+            if rng.random() < read_ratio:
+                get_user_detections(db, user_id, limit=50)
+                get_user_stats(db, user_id)
+                local_reads.append(time.perf_counter() - start)
+            else:
+                predicted = rng.choice(CLASSES)
+                save_detection(
+                    db=db,
+                    user_id=user_id,
+                    image_name=f"bench_{rng.randint(0, 10**6)}.jpg",
+                    predicted_class=predicted,
+                    confidence=rng.random(),
+                    top_3_predictions=[{'class': predicted, 'confidence': 0.9}],
+                )
+                local_writes.append(time.perf_counter() - start)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            db.close()
+
+    with lock:
+        latencies['write'].extend(local_writes)
+        latencies['read'].extend(local_reads)
+
+
+def run_profile(profile, sessions, ops, read_ratio):
+    """Benchmark one engine profile on a fresh database file"""
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        bench_engine = create_app_engine(url, profile=profile)
+        Base.metadata.create_all(bind=bench_engine)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=bench_engine)
+
+        db = Session()
+        try:
+            users = [
+                User(username=f"bench{i}", email=f"bench{i}@example.com", password_hash="x")
+                for i in range(sessions)
+            ]
+            db.add_all(users)
+            db.commit()
+            user_ids = [u.id for u in users]
+        finally:
+            db.close()
+
+        latencies = {'write': [], 'read': []}
+        errors = []
+        lock = threading.Lock()
+        threads = [
+            threading.Thread(
+                target=_session_worker,
+                args=(Session, uid, ops, read_ratio, latencies, errors, lock),
+            )
+            for uid in user_ids
+        ]
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        bench_engine.dispose()
+
+    total = len(latencies['write']) + len(latencies['read'])
+    return {
+        'profile': profile,
+        'elapsed_s': elapsed,
+        'ops_per_s': total / elapsed if elapsed else 0.0,
+        'write_p50_ms': percentile(latencies['write'], 50) * 1000,
+        'write_p95_ms': percentile(latencies['write'], 95) * 1000,
+        'read_p50_ms': percentile(latencies['read'], 50) * 1000,
+        'read_p95_ms': percentile(latencies['read'], 95) * 1000,
+        'read_mean_ms': (statistics.mean(latencies['read']) * 1000) if latencies['read'] else 0.0,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent history read/write benchmark")
+    parser.add_argument("--sessions", type=int, default=16, help="simulated concurrent users")
+    parser.add_argument("--ops", type=int, default=100, help="operations per user")
+    parser.add_argument("--read-ratio", type=float, default=0.5, help="fraction of ops that are reads")
+    parser.add_argument("--profiles", nargs="+", default=["default", "sqlite"])
+    args = parser.parse_args()
+
+    print(f"🚀 {args.sessions} sessions x {args.ops} ops, read ratio {args.read_ratio}")
+    for profile in args.profiles:
+        r = run_profile(profile, args.sessions, args.ops, args.read_ratio)
+        print(
+            f"[{r['profile']:>8}] {r['ops_per_s']:8.1f} ops/s | "
+            f"write p50 {r['write_p50_ms']:6.2f} ms p95 {r['write_p95_ms']:7.2f} ms | "
+            f"read p50 {r['read_p50_ms']:6.2f} ms p95 {r['read_p95_ms']:7.2f} ms | "
+            f"errors {r['errors']}"
+        )
+        if r['first_error']:
+            print(f"    ⚠️ {r['first_error']}")
+
+
+if __name__ == "__main__":
+    main()
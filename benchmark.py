@@ -0,0 +1,347 @@
+"""End-to-end benchmark suite for the detection pipeline.
+
+Runs fully offline against the bundled dataset/valid images and either the
+trained model (if present) or a randomly initialized one. Measures per-stage
+latency (decode, preprocess, raw forward pass and the full predict_batch()
+serving path by batch size, DB insert, stats query) and throughput scaling
+across threads and processes, writes the results as JSON and compares them
+with a stored baseline.
+
+    python benchmark.py                         # run and compare
+    python benchmark.py --save-baseline         # record a new baseline
+    python benchmark.py --fail-on-regression    # exit 1 if anything regressed
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+VALID_DIR = "dataset/valid"
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def _summarize(samples, scale=1000.0):
+    """p50/p95/mean of a list of durations in seconds, in ms by default"""
+    if not samples:
+        return {'p50': 0.0, 'p95': 0.0, 'mean': 0.0}
+    # Nearest-rank, like bench_db.percentile; importing bench_db would open the app database
+    p50, p95 = np.percentile(samples, [50, 95], method='nearest')
+    return {
+        'p50': float(p50) * scale,
+        'p95': float(p95) * scale,
+        'mean': statistics.mean(samples) * scale,
+    }
+
+
+def load_sample_bytes(valid_dir, count, seed):
+    """Read a reproducible sample of image files into memory"""
+    paths = []
+    for root, _, files in os.walk(valid_dir):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise FileNotFoundError(f"❌ No images found under {valid_dir}")
+    paths.sort()
+    random.Random(seed).shuffle(paths)
+    sample = []
+    for path in paths[:count]:
+        with open(path, "rb") as f:
+            sample.append(f.read())
+    return sample
+
+
+def get_benchmark_model(random_model):
+    """Trained model if available, otherwise a randomly initialized one"""
+    from model import PlantDiseaseModel
+    import tensorflow as tf
+
+    plant_model = PlantDiseaseModel()
+    if random_model or not plant_model.load_model():
+        tf.random.set_seed(0)
+        plant_model.build_model(weights=None)
+        return plant_model, "random"
+    return plant_model, "trained"
+
+
+def bench_decode(sample):
+    times = []
+    images = []
+    for data in sample:
+        start = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        times.append(time.perf_counter() - start)
+        images.append(img)
+    return images, _summarize(times)
+
+
+def bench_preprocess(plant_model, images):
+    times = []
+    for img in images:
+        start = time.perf_counter()
+        plant_model.preprocess_image(img)
+        times.append(time.perf_counter() - start)
+    return _summarize(times)
+
+
+def bench_inference(plant_model, images, batch_sizes, repeat):
+    """Per-image latency and throughput of the forward pass by batch size"""
+    batch = plant_model.preprocess_batch(images)
+    results = {}
+    for bs in batch_sizes:
+        x = batch[:bs] if len(batch) >= bs else np.repeat(batch, -(-bs // len(batch)), axis=0)[:bs]
+        plant_model.model.predict(x, batch_size=bs, verbose=0)  # warm-up / graph trace
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            plant_model.model.predict(x, batch_size=bs, verbose=0)
+            times.append(time.perf_counter() - start)
+        summary = _summarize(times)
+        results[bs] = {
+            'batch_p50_ms': summary['p50'],
+            'per_image_ms': summary['p50'] / bs,
+            'images_per_s': bs / (summary['p50'] / 1000) if summary['p50'] else 0.0,
+        }
+    return results
+
+
+def bench_pipeline(plant_model, images, batch_sizes, repeat):
+    """Per-image latency and throughput of predict_batch(), the path the app and workers serve.
+
+    Unlike bench_inference this includes preprocessing, the feature-model
+    forward, hashing, OOD scoring, crop routing and result building (TTA off).
+    """
+    results = {}
+    for bs in batch_sizes:
+        batch = [images[i % len(images)] for i in range(bs)]
+        plant_model.predict_batch(batch, batch_size=bs, tta='off')  # warm-up / graph trace
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            plant_model.predict_batch(batch, batch_size=bs, tta='off')
+            times.append(time.perf_counter() - start)
+        summary = _summarize(times)
+        results[bs] = {
+            'per_image_ms': summary['p50'] / bs,
+            'images_per_s': bs / (summary['p50'] / 1000) if summary['p50'] else 0.0,
+        }
+    return results
+
+
+def bench_database(operations):
+    """Latency of save_detection and the dashboard stats/history queries"""
+    from sqlalchemy.orm import sessionmaker
+    from database import Base, create_app_engine
+    from models import User
+    from detection_utils import save_detection, get_user_detections, get_user_stats
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_engine = create_app_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=bench_engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=bench_engine)()
+        try:
+            user = User(username="bench", email="bench@example.com", password_hash="x")
+            db.add(user)
+            db.commit()
+
+            insert_times = []
+            for i in range(operations):
+                start = time.perf_counter()
+                save_detection(
+                    db=db,
+                    user_id=user.id,
+                    image_name=f"bench_{i}.jpg",
+                    predicted_class="Tomato_Early_blight",
+                    confidence=0.87,
+                    top_3_predictions=[{'class': "Tomato_Early_blight", 'confidence': 0.87}],
+                )
+                insert_times.append(time.perf_counter() - start)
+
+            stats_times = []
+            for _ in range(max(1, operations // 10)):
+                start = time.perf_counter()
+                get_user_stats(db, user.id)
+                get_user_detections(db, user.id, limit=50)
+                stats_times.append(time.perf_counter() - start)
+        finally:
+            db.close()
+            bench_engine.dispose()
+
+    return _summarize(insert_times), _summarize(stats_times)
+
+
+_worker_model = None
+
+
+def _decode_preprocess(data):
+    """Worker task: decode one image and preprocess it for the model"""
+    global _worker_model
+    if _worker_model is None:
+        from model import PlantDiseaseModel
+        _worker_model = PlantDiseaseModel()
+    img = Image.open(io.BytesIO(data))
+    return _worker_model.preprocess_image(img).shape
+
+
+def _scaling_run(executor, sample):
+    list(executor.map(_decode_preprocess, sample[:2]))  # warm up workers
+    start = time.perf_counter()
+    list(executor.map(_decode_preprocess, sample))
+    elapsed = time.perf_counter() - start
+    return len(sample) / elapsed if elapsed else 0.0
+
+
+def bench_scaling(sample, thread_counts, process_counts):
+    """Decode+preprocess throughput (images/s) by worker count"""
+    results = {'threads': {}, 'processes': {}}
+    for n in thread_counts:
+        with ThreadPoolExecutor(max_workers=n) as ex:
+            results['threads'][n] = _scaling_run(ex, sample)
+    # spawn so workers don't inherit TensorFlow's threads from this process
+    ctx = multiprocessing.get_context("spawn")
+    for n in process_counts:
+        with ProcessPoolExecutor(max_workers=n, mp_context=ctx) as ex:
+            results['processes'][n] = _scaling_run(ex, sample)
+    return results
+
+
+def run_suite(args):
+    metrics = {}
+
+    def record(name, value, unit, better="lower"):
+        metrics[name] = {'value': value, 'unit': unit, 'better': better}
+
+    print(f"📂 Loading {args.images} images from {args.valid_dir}")
+    sample = load_sample_bytes(args.valid_dir, args.images, args.seed)
+
+    images, decode = bench_decode(sample)
+    record("decode.p50_ms", decode['p50'], "ms")
+    record("decode.p95_ms", decode['p95'], "ms")
+
+    plant_model, model_kind = get_benchmark_model(args.random_model)
+    preprocess = bench_preprocess(plant_model, images)
+    record("preprocess.p50_ms", preprocess['p50'], "ms")
+    record("preprocess.p95_ms", preprocess['p95'], "ms")
+
+    for bs, r in bench_inference(plant_model, images, args.batch_sizes, args.repeat).items():
+        record(f"inference.bs{bs}.per_image_ms", r['per_image_ms'], "ms")
+        record(f"inference.bs{bs}.images_per_s", r['images_per_s'], "img/s", better="higher")
+
+    for bs, r in bench_pipeline(plant_model, images, args.batch_sizes, args.repeat).items():
+        record(f"inference.pipeline.bs{bs}.per_image_ms", r['per_image_ms'], "ms")
+        record(f"inference.pipeline.bs{bs}.images_per_s", r['images_per_s'], "img/s", better="higher")
+
+    insert, stats = bench_database(args.db_ops)
+    record("db.insert.p50_ms", insert['p50'], "ms")
+    record("db.insert.p95_ms", insert['p95'], "ms")
+    record("db.stats_query.p50_ms", stats['p50'], "ms")
+
+    scaling = bench_scaling(sample, args.threads, args.processes)
+    for kind, by_count in scaling.items():
+        for n, ips in by_count.items():
+            record(f"scaling.{kind}{n}.images_per_s", ips, "img/s", better="higher")
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec="seconds"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'model': model_kind,
+            'images': len(sample),
+            'seed': args.seed,
+        },
+        'metrics': metrics,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return (name, baseline, current, relative change, regressed) per shared metric"""
+    rows = []
+    for name, current in results['metrics'].items():
+        base = baseline.get('metrics', {}).get(name)
+        if not base or not base['value']:
+            continue
+        change = (current['value'] - base['value']) / base['value']
+        worse = change > tolerance if current['better'] == "lower" else change < -tolerance
+        rows.append((name, base['value'], current['value'], change, worse))
+    return rows
+
+
+def print_results(results, rows):
+    print(f"\n📊 Results ({results['meta']['model']} model, {results['meta']['images']} images)")
+    compared = {r[0]: r for r in rows}
+    for name, m in results['metrics'].items():
+        line = f"  {name:<36} {m['value']:>10.2f} {m['unit']}"
+        if name in compared:
+            _, base, _, change, worse = compared[name]
+            flag = "  ⚠️ REGRESSION" if worse else ""
+            line += f"   (baseline {base:.2f}, {change * 100:+.1f}%){flag}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detection pipeline benchmark suite")
+    parser.add_argument("--valid-dir", default=VALID_DIR)
+    parser.add_argument("--images", type=int, default=64, help="images sampled from the valid set")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per batch size")
+    parser.add_argument("--db-ops", type=int, default=200, help="detections inserted in the DB stage")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--random-model", action="store_true", help="ignore the trained model file")
+    parser.add_argument("--out", default=RESULTS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown")
+    parser.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+
+    rows = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('model') != results['meta']['model']:
+            print(f"⚠️ Baseline was recorded with a {baseline['meta'].get('model')} model")
+        rows = compare(results, baseline, args.tolerance)
+    results['comparison'] = [
+        {'metric': name, 'baseline': base, 'current': cur, 'change': change, 'regressed': worse}
+        for name, base, cur, change, worse in rows
+    ]
+
+    print_results(results, rows)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✅ Results written to {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Baseline saved to {args.baseline}")
+
+    regressions = [r for r in rows if r[4]]
+    if regressions:
+        print(f"⚠️ {len(regressions)} metric(s) regressed beyond {args.tolerance * 100:.0f}%")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
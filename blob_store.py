@@ -0,0 +1,146 @@
+"""Content-addressed storage for uploaded photos and their thumbnails.
+
+Files are named by the SHA-256 of the uploaded bytes and sharded two levels
+deep, so identical uploads are stored once no matter who sent them:
+
+    blobs/originals/3f/a2/3fa2...e9       original upload bytes
+    blobs/thumbs/3f/a2/3fa2...e9.webp     THUMBNAIL_SIDE px WebP preview
+
+Blobs are shared and never deleted with a detection; reclaim unreferenced
+ones with:
+
+    python blob_store.py gc
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+BLOB_DIR = os.getenv('BLOB_DIR', 'blobs')
+THUMBNAIL_SIDE = int(os.getenv('THUMBNAIL_SIDE', 256))
+THUMBNAIL_QUALITY = 70
+
+
+class BlobStore:
+    """SHA-256 addressed originals plus WebP thumbnails under one root directory"""
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+
+    def _sharded(self, kind, sha256, suffix=""):
+        return os.path.join(self.root, kind, sha256[:2], sha256[2:4], sha256 + suffix)
+
+    def original_path(self, sha256):
+        return self._sharded("originals", sha256)
+
+    def thumbnail_path(self, sha256):
+        return self._sharded("thumbs", sha256, ".webp")
+
+    def _write_atomic(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, data, image=None):
+        """Store upload bytes (and a thumbnail from the already-decoded image); returns the hash"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.original_path(sha256)
+        if os.path.exists(path):
+            os.utime(path)  # counts as fresh for gc until the new reference is committed
+        else:
+            self._write_atomic(path, lambda f: f.write(data))
+        if image is not None and not os.path.exists(self.thumbnail_path(sha256)):
+            self.put_thumbnail(sha256, image)
+        return sha256
+
+    def put_thumbnail(self, sha256, image):
+        thumb = image.convert('RGB') if image.mode not in ('RGB', 'RGBA') else image
+        scale = THUMBNAIL_SIDE / max(thumb.size)
+        if scale < 1:
+            thumb = thumb.resize((max(1, round(thumb.width * scale)), max(1, round(thumb.height * scale))),
+                                 Image.BILINEAR, reducing_gap=2.0)
+        self._write_atomic(self.thumbnail_path(sha256),
+                           lambda f: thumb.save(f, format="WEBP", quality=THUMBNAIL_QUALITY))
+
+    def read(self, sha256):
+        with open(self.original_path(sha256), "rb") as f:
+            return f.read()
+
+    def read_thumbnail(self, sha256):
+        """Thumbnail bytes, or None if the blob has none"""
+        path = self.thumbnail_path(sha256)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def iter_hashes(self):
+        originals = os.path.join(self.root, "originals")
+        for dirpath, _, files in os.walk(originals):
+            for name in files:
+                if not name.startswith(".tmp-"):
+                    yield name
+
+    def delete(self, sha256):
+        for path in (self.original_path(sha256), self.thumbnail_path(sha256)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def collect_garbage(store, db, min_age_seconds=3600):
+    """Delete blobs no detection references; returns how many were removed.
+
+    Recent blobs are kept: their detection may not be committed yet.
+    """
+    from models import DetectionHistory
+
+    referenced = {
+        sha for (sha,) in db.query(DetectionHistory.image_sha256).filter(
+            DetectionHistory.image_sha256.isnot(None)
+        ).distinct()
+    }
+    cutoff = time.time() - min_age_seconds
+    removed = 0
+    for sha256 in list(store.iter_hashes()):
+        if sha256 not in referenced and os.path.getmtime(store.original_path(sha256)) < cutoff:
+            store.delete(sha256)
+            removed += 1
+    return removed
+
+
+def main():
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Image blob store tools")
+    parser.add_argument("--dir", default=BLOB_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("gc", help="delete blobs no detection references")
+    sub.add_parser("stats", help="count blobs and their size")
+    args = parser.parse_args()
+
+    store = BlobStore(args.dir)
+    if args.command == "gc":
+        init_db()
+        db = SessionLocal()
+        try:
+            print(f"🧹 Removed {collect_garbage(store, db)} unreferenced blob(s)")
+        finally:
+            db.close()
+    else:
+        hashes = list(store.iter_hashes())
+        size = sum(os.path.getsize(store.original_path(h)) for h in hashes)
+        print(f"📦 {len(hashes)} blob(s), {size / 1024 / 1024:.1f} MB in {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
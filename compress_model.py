@@ -0,0 +1,399 @@
+"""Shrink a trained model with structured pruning, magnitude pruning and weight clustering.
+
+The stages run in this order on the Keras model:
+
+1. Channel pruning removes the least important channels from each MobileNetV2
+   inverted-residual expansion and from the hidden Dense layers of the
+   classifier head. The expansions are internal to their blocks, so no skip
+   connection changes width. The smaller model is rebuilt and the surviving
+   weights are copied across. This reduces file size, memory, load time and
+   latency.
+2. Fine-tuning on dataset/train (quarantine honored) ramps up unstructured
+   magnitude sparsity at the same time.
+3. Weight clustering snaps each kernel's non-zero weights to a few shared
+   values, and a second fine-tune trains the shared values.
+
+Sparsity and clustering help the compressed (gzip) size rather than the
+in-memory size. Masks and cluster assignments live in training callbacks,
+so the exported model is plain Keras layers that PlantDiseaseModel loads
+directly. A report compares the compressed model with the baseline.
+
+    python compress_model.py --model plant_disease_model.h5 --out plant_disease_model_small.keras
+    python compress_model.py --channel-ratio 0.3 --sparsity 0.6 --clusters 16 --publish
+"""
+import argparse
+import gzip
+import json
+import math
+import os
+import time
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from dataset_scan import image_frame
+
+COMPRESS_REPORT_PATH = "compression_report.json"
+# Kernels smaller than this are left dense and unclustered
+MIN_COMPRESS_PARAMS = 1024
+CHANNEL_MULTIPLE = 8  # kept channel counts are rounded up to this for vectorized kernels
+
+
+def iter_layers(model):
+    """Leaf layers of a (possibly nested) functional model, in graph order"""
+    for layer in model.layers:
+        if isinstance(layer, keras.Model):
+            yield from iter_layers(layer)
+        else:
+            yield layer
+
+
+def _keep_top(scores, ratio):
+    """Sorted indices of the channels to keep: the top (1 - ratio), at least CHANNEL_MULTIPLE"""
+    n = len(scores)
+    keep = min(n, max(CHANNEL_MULTIPLE, math.ceil(n * (1 - ratio) / CHANNEL_MULTIPLE) * CHANNEL_MULTIPLE))
+    return np.sort(np.argsort(scores)[::-1][:keep])
+
+
+def plan_channel_pruning(model, ratio):
+    """{layer name: (input channels to keep, output channels to keep)}; None means all"""
+    by_name = {layer.name: layer for layer in iter_layers(model)}
+    plan = {}
+
+    def update(name, in_keep=None, out_keep=None):
+        old_in, old_out = plan.get(name, (None, None))
+        plan[name] = (in_keep if in_keep is not None else old_in, out_keep if out_keep is not None else old_out)
+
+    # Inverted-residual expansions: a channel matters as much as its depthwise scale
+    # times its weight into the projection
+    for name in by_name:
+        if not (name.startswith('block_') and name.endswith('_expand')):
+            continue
+        prefix = name[:-len('expand')]
+        gamma = np.abs(by_name[prefix + 'depthwise_BN'].gamma.numpy())
+        project = np.abs(by_name[prefix + 'project'].kernel.numpy()).sum(axis=(0, 1, 3))
+        keep = _keep_top(gamma * project, ratio)
+        update(name, out_keep=keep)
+        for suffix in ('expand_BN', 'depthwise', 'depthwise_BN', 'project'):
+            update(prefix + suffix, in_keep=keep)
+
+    # Hidden Dense units of the head, by weight magnitude in and out
+    ordered = list(iter_layers(model))
+    dense = [layer for layer in ordered if isinstance(layer, layers.Dense)]
+    for layer, following in zip(dense[:-1], dense[1:]):
+        scores = np.abs(layer.kernel.numpy()).sum(axis=0) * np.abs(following.kernel.numpy()).sum(axis=1)
+        keep = _keep_top(scores, ratio)
+        update(layer.name, out_keep=keep)
+        update(following.name, in_keep=keep)
+        for between in ordered[ordered.index(layer) + 1:ordered.index(following)]:
+            if isinstance(between, layers.BatchNormalization):
+                update(between.name, in_keep=keep)
+    return plan
+
+
+def _slice_weights(layer, weights, in_keep, out_keep):
+    if isinstance(layer, layers.BatchNormalization):
+        return [w[in_keep] for w in weights]
+    if isinstance(layer, layers.DepthwiseConv2D):
+        return [weights[0][:, :, in_keep, :]] + [b[in_keep] for b in weights[1:]]
+    kernel = weights[0]
+    if in_keep is not None:
+        kernel = np.take(kernel, in_keep, axis=-2)
+    if out_keep is not None:
+        kernel = np.take(kernel, out_keep, axis=-1)
+        return [kernel] + [b[out_keep] for b in weights[1:]]
+    return [kernel] + weights[1:]
+
+
+def prune_channels(model, ratio):
+    """A narrower copy of the model holding the surviving weights"""
+    plan = plan_channel_pruning(model, ratio)
+
+    def narrower(layer):
+        config = layer.get_config()
+        out_keep = plan.get(layer.name, (None, None))[1]
+        if out_keep is not None:
+            config['units' if isinstance(layer, layers.Dense) else 'filters'] = len(out_keep)
+        return layer.__class__.from_config(config)
+
+    pruned = keras.models.clone_model(model, clone_function=narrower, recursive=True)
+    new_layers = {layer.name: layer for layer in iter_layers(pruned)}
+    for layer in iter_layers(model):
+        weights = layer.get_weights()
+        if not weights:
+            continue
+        if layer.name in plan:
+            weights = _slice_weights(layer, weights, *plan[layer.name])
+        new_layers[layer.name].set_weights(weights)
+    return pruned
+
+
+def compressible_kernels(model):
+    """Conv/Dense kernels worth sparsifying and clustering (not depthwise, not the classifier)"""
+    dense = [layer for layer in iter_layers(model) if isinstance(layer, layers.Dense)]
+    classifier = dense[-1] if dense else None
+    return [
+        layer.kernel for layer in iter_layers(model)
+        if isinstance(layer, (layers.Conv2D, layers.Dense))
+        and not isinstance(layer, layers.DepthwiseConv2D)
+        and layer is not classifier
+        and int(np.prod(layer.kernel.shape)) >= MIN_COMPRESS_PARAMS
+    ]
+
+
+class MagnitudePruning(keras.callbacks.Callback):
+    """Zero the smallest weights of each kernel, ramping sparsity polynomially to `target`"""
+
+    def __init__(self, kernels, target, ramp_steps, frequency=10):
+        super().__init__()
+        self.kernels = kernels
+        self.target = target
+        self.ramp_steps = max(1, ramp_steps)
+        self.frequency = frequency
+        self.step = 0
+        self.masks = None
+
+    def sparsity(self):
+        progress = min(1.0, self.step / self.ramp_steps)
+        return self.target * (1 - (1 - progress) ** 3)
+
+    def _update_masks(self):
+        sparsity = self.sparsity()
+        self.masks = []
+        for kernel in self.kernels:
+            magnitude = np.abs(kernel.numpy())
+            self.masks.append(magnitude > np.quantile(magnitude, sparsity) if sparsity > 0 else np.ones_like(magnitude, bool))
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.masks is None or (self.step % self.frequency == 0 and self.step <= self.ramp_steps):
+            self._update_masks()
+        for kernel, mask in zip(self.kernels, self.masks):
+            kernel.assign(kernel.numpy() * mask)
+        self.step += 1
+
+    def on_train_end(self, logs=None):
+        self.step = self.ramp_steps
+        self._update_masks()
+        self.on_train_batch_end(None)
+
+
+def cluster_values(values, clusters, iterations=15):
+    """(centroids, assignment) of a 1-D k-means with linearly spaced initial centroids"""
+    centroids = np.linspace(values.min(), values.max(), clusters)
+    for _ in range(iterations):
+        assignment = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+        counts = np.bincount(assignment, minlength=clusters)
+        sums = np.bincount(assignment, weights=values, minlength=clusters)
+        centroids = np.sort(np.where(counts > 0, sums / np.maximum(counts, 1), centroids))
+    return centroids, np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+
+
+class WeightClustering(keras.callbacks.Callback):
+    """Keep each kernel's non-zero weights on `clusters` shared values while fine-tuning.
+
+    After every batch each shared value moves to the mean of its members'
+    updated weights (the averaged gradient step), and zeros stay zero.
+    """
+
+    def __init__(self, kernels, clusters):
+        super().__init__()
+        self.kernels = kernels
+        self.clusters = clusters
+        self.state = []
+        for kernel in kernels:
+            weights = kernel.numpy().ravel()
+            nonzero = np.flatnonzero(weights)
+            _, assignment = cluster_values(weights[nonzero], clusters)
+            self.state.append((nonzero, assignment))
+        self._snap()
+
+    def _snap(self):
+        for kernel, (nonzero, assignment) in zip(self.kernels, self.state):
+            weights = kernel.numpy().ravel()
+            counts = np.bincount(assignment, minlength=self.clusters)
+            centroids = np.bincount(assignment, weights=weights[nonzero], minlength=self.clusters) / np.maximum(counts, 1)
+            snapped = np.zeros_like(weights)
+            snapped[nonzero] = centroids[assignment]
+            kernel.assign(snapped.reshape(kernel.shape))
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._snap()
+
+
+def strip(model):
+    """An uncompiled copy with the same weights, so no optimizer state is exported"""
+    stripped = keras.models.clone_model(model, recursive=True)
+    stripped.set_weights(model.get_weights())
+    return stripped
+
+
+def _generator(split_dir, class_names, batch_size, training, limit=None):
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    frame, _ = image_frame(split_dir)
+    frame = frame[frame['class'].isin(class_names)]
+    if limit and len(frame) > limit:
+        frame = frame.sample(n=limit, random_state=0)
+    # Same scaling as PlantDiseaseModel.preprocess_image
+    datagen = ImageDataGenerator(rescale=1./255, horizontal_flip=training)
+    return datagen.flow_from_dataframe(
+        frame, x_col="filename", y_col="class", classes=list(class_names),
+        target_size=(224, 224), batch_size=batch_size, class_mode="categorical",
+        shuffle=training, validate_filenames=False
+    )
+
+
+def _compile(model, learning_rate=1e-4):
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate), loss="categorical_crossentropy", metrics=["accuracy"])
+
+
+def fine_tune(model, train_gen, steps, epochs, callbacks, learning_rate=1e-4):
+    """Train every layer except BatchNorm (statistics stay frozen)"""
+    model.trainable = True
+    for layer in iter_layers(model):
+        if isinstance(layer, layers.BatchNormalization):
+            layer.trainable = False
+    _compile(model, learning_rate)
+    steps = min(steps, len(train_gen))
+    model.fit(train_gen, epochs=epochs, steps_per_epoch=steps, callbacks=callbacks, verbose=2)
+
+
+def _gzip_size(path):
+    with open(path, "rb") as f:
+        return len(gzip.compress(f.read(), compresslevel=6))
+
+
+def measure_model(model_path, class_names_path, valid_dir, eval_limit=500, batch_size=32):
+    """Size, load time, latency and validation accuracy of a saved model as PlantDiseaseModel serves it"""
+    from model import PlantDiseaseModel
+
+    plant_model = PlantDiseaseModel(model_path=model_path, class_names_path=class_names_path, hierarchy_dir=None)
+    start = time.perf_counter()
+    plant_model.load_model()
+    load_seconds = time.perf_counter() - start
+    plant_model.warmup()
+
+    latencies = {}
+    for batch in (1, batch_size):
+        inputs = np.random.rand(batch, plant_model.img_height, plant_model.img_width, 3).astype(np.float32)
+        plant_model._forward(inputs, batch)
+        samples = []
+        for _ in range(20 if batch == 1 else 5):
+            start = time.perf_counter()
+            plant_model._forward(inputs, batch)
+            samples.append(time.perf_counter() - start)
+        latencies[batch] = float(np.median(samples)) * 1000
+
+    accuracy = None
+    if valid_dir and os.path.isdir(valid_dir):
+        valid_gen = _generator(valid_dir, plant_model.class_names, batch_size, training=False, limit=eval_limit)
+        _compile(plant_model.model)
+        accuracy = float(plant_model.model.evaluate(valid_gen, verbose=0)[1])
+
+    return {
+        'file_mb': round(os.path.getsize(model_path) / 1e6, 3),
+        'gzip_mb': round(_gzip_size(model_path) / 1e6, 3),
+        'params': int(plant_model.model.count_params()),
+        'weights_mb': round(sum(int(np.prod(w.shape)) * w.dtype.itemsize for w in plant_model.model.get_weights()) / 1e6, 3),
+        'load_seconds': round(load_seconds, 3),
+        'latency_ms_batch1': round(latencies[1], 2),
+        f'latency_ms_batch{batch_size}': round(latencies[batch_size], 2),
+        'accuracy': None if accuracy is None else round(accuracy, 4),
+    }
+
+
+def compress(model_path, out_path, class_names_path="class_names_from_training.json",
+             train_dir="dataset/train", valid_dir="dataset/valid", channel_ratio=0.5, sparsity=0.5,
+             clusters=16, epochs=1, steps=200, batch_size=32, eval_limit=500):
+    """Run every stage and export to out_path; returns the comparison report"""
+    from model import PlantDiseaseModel
+
+    plant_model = PlantDiseaseModel(model_path=model_path, class_names_path=class_names_path, hierarchy_dir=None)
+    if not plant_model.load_model():
+        raise FileNotFoundError(f"❌ Model file not found: {model_path}")
+    model = plant_model.model
+    train_gen = _generator(train_dir, plant_model.class_names, batch_size, training=True)
+
+    if channel_ratio > 0:
+        before = model.count_params()
+        model = prune_channels(model, channel_ratio)
+        print(f"✂️ Channel pruning: {before:,} -> {model.count_params():,} parameters")
+
+    if sparsity > 0 or channel_ratio > 0:
+        total_steps = epochs * min(steps, len(train_gen))
+        callbacks = []
+        if sparsity > 0:
+            callbacks.append(MagnitudePruning(compressible_kernels(model), sparsity, ramp_steps=int(total_steps * 0.7)))
+        print(f"🏋️ Fine-tuning after pruning (target sparsity {sparsity:.0%})")
+        fine_tune(model, train_gen, steps, epochs, callbacks)
+
+    if clusters > 0:
+        print(f"🎯 Clustering weights into {clusters} shared values per kernel")
+        fine_tune(model, train_gen, steps, epochs, [WeightClustering(compressible_kernels(model), clusters)],
+                  learning_rate=2e-5)
+
+    strip(model).save(out_path)
+    print(f"💾 Saved compressed model to {out_path}")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': os.path.abspath(model_path),
+        'output': os.path.abspath(out_path),
+        'settings': {'channel_ratio': channel_ratio, 'sparsity': sparsity, 'clusters': clusters,
+                     'epochs': epochs, 'steps': steps, 'eval_images': eval_limit},
+        'baseline': measure_model(model_path, class_names_path, valid_dir, eval_limit, batch_size),
+        'compressed': measure_model(out_path, class_names_path, valid_dir, eval_limit, batch_size),
+    }
+    return report
+
+
+def print_report(report):
+    baseline, compressed = report['baseline'], report['compressed']
+    print(f"\n{'metric':<22}{'baseline':>12}{'compressed':>12}{'change':>10}")
+    for key, before in baseline.items():
+        after = compressed[key]
+        change = f"{(after - before) / before:+.0%}" if before and after is not None else ""
+        print(f"{key:<22}{str(before):>12}{str(after):>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune, cluster and fine-tune the model into a smaller one")
+    parser.add_argument("--model", default="plant_disease_model.h5")
+    parser.add_argument("--classes", default="class_names_from_training.json")
+    parser.add_argument("--out", default="plant_disease_model_small.keras")
+    parser.add_argument("--train", default="dataset/train")
+    parser.add_argument("--valid", default="dataset/valid")
+    parser.add_argument("--channel-ratio", type=float, default=0.5, help="fraction of prunable channels to remove")
+    parser.add_argument("--sparsity", type=float, default=0.5, help="final magnitude sparsity of large kernels")
+    parser.add_argument("--clusters", type=int, default=16, help="shared values per kernel (0: no clustering)")
+    parser.add_argument("--epochs", type=int, default=1, help="fine-tune epochs per stage")
+    parser.add_argument("--steps", type=int, default=200, help="max batches per fine-tune epoch")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--eval-images", type=int, default=500, help="validation images for the accuracy comparison")
+    parser.add_argument("--report", default=COMPRESS_REPORT_PATH)
+    parser.add_argument("--publish", action="store_true", help="publish the result to the model registry (not activated)")
+    args = parser.parse_args()
+
+    report = compress(args.model, args.out, args.classes, args.train, args.valid, args.channel_ratio,
+                      args.sparsity, args.clusters, args.epochs, args.steps, args.batch_size, args.eval_images)
+    print_report(report)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📝 Report written to {args.report}")
+
+    if args.publish:
+        from model_registry import publish
+
+        summary = report['compressed']
+        # No OOD calibration is bundled: the thresholds belong to the baseline's logits
+        meta = publish(args.out, args.classes, notes=(
+            f"compressed from {os.path.basename(args.model)}: channels -{args.channel_ratio:.0%}, "
+            f"sparsity {args.sparsity:.0%}, {args.clusters} clusters, accuracy {summary['accuracy']}"
+        ))
+        print(f"✅ Published {meta['version']}; recalibrate OOD, then activate it with: "
+              f"python model_registry.py activate {meta['version']}")
+
+
+if __name__ == "__main__":
+    main()
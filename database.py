@@ -1,5 +1,8 @@
 import os
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import streamlit as st
@@ -8,12 +11,172 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
     DATABASE_URL = "sqlite:///./app.db"  # local SQLite database file
 
+# Engine profile: "auto" picks one from the URL, "default" disables all tuning
+DB_PROFILE = os.getenv('DB_PROFILE', 'auto')
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Applied on every new SQLite connection (see _apply_sqlite_pragmas)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': -int(os.getenv('SQLITE_CACHE_KB', 64 * 1024)),  # negative = KiB
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+}
+
+POSTGRES_POOL = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    'statement_timeout_ms': int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000)),
+}
+
+ENGINE_PROFILES = ('default', 'sqlite', 'postgres')
+
+
+def resolve_profile(url: str, profile: str = None) -> str:
+    """Pick the engine profile for a database URL"""
+    profile = profile or DB_PROFILE
+    if profile not in ('auto',) + ENGINE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE '{profile}', expected one of: auto, {', '.join(ENGINE_PROFILES)}")
+    if profile != 'auto':
+        return profile
+
+    backend = make_url(url).get_backend_name()
+    if backend == 'sqlite':
+        return 'sqlite'
+    if backend == 'postgresql':
+        return 'postgres'
+    return 'default'
+
+
+def get_engine_options(url: str, profile: str = None) -> dict:
+    """Keyword arguments for create_engine() under the given profile"""
+    profile = resolve_profile(url, profile)
+
+    if profile == 'sqlite':
+        # Local file: no network to drop connections, so no pre-ping round trip
+        return {}
+
+    if profile == 'postgres':
+        return {
+            'pool_pre_ping': True,
+            'pool_size': POSTGRES_POOL['pool_size'],
+            'max_overflow': POSTGRES_POOL['max_overflow'],
+            'pool_recycle': POSTGRES_POOL['pool_recycle'],
+            'connect_args': {
+                'options': f"-c statement_timeout={POSTGRES_POOL['statement_timeout_ms']}"
+            },
+        }
+
+    return {'pool_pre_ping': True}
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Connect-event hook that tunes each new SQLite connection"""
+    # The sqlite3 driver opens an implicit transaction before some statements;
+    # journal_mode cannot change inside one, so use a raw cursor up front.
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+    finally:
+        cursor.close()
+
+
+def create_app_engine(url: str = None, profile: str = None):
+    """Create an engine configured for the selected profile"""
+    url = url or DATABASE_URL
+    profile = resolve_profile(url, profile)
+    new_engine = create_engine(url, **get_engine_options(url, profile))
+
+    if profile == 'sqlite':
+        event.listen(new_engine, 'connect', _apply_sqlite_pragmas)
+
+    return new_engine
+
+
+engine = create_app_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Print per-rerun connection/query counts and show them in the sidebar
+DB_STATS_ENABLED = os.getenv('DB_STATS', '0') == '1'
+
+
+class RequestScope:
+    """Database state for one Streamlit rerun"""
+
+    def __init__(self):
+        self.connection = None
+        self.session = None
+        self.connections_opened = 0
+        self.checkouts = 0
+        self.queries = 0
+
+    def stats(self):
+        return {
+            'connections_opened': self.connections_opened,
+            'checkouts': self.checkouts,
+            'queries': self.queries,
+        }
+
+
+_current_scope = ContextVar('db_request_scope', default=None)
+
+
+@event.listens_for(engine, 'connect')
+def _count_connect(dbapi_connection, connection_record):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.connections_opened += 1
+
+
+@event.listens_for(engine, 'checkout')
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.checkouts += 1
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.queries += 1
+
+
+@contextmanager
+def request_scope():
+    """Share one connection and session across every DB call in a rerun"""
+    scope = RequestScope()
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        if scope.session is not None:
+            scope.session.close()
+        if scope.connection is not None:
+            scope.connection.close()
+        _current_scope.reset(token)
+        if DB_STATS_ENABLED and scope.checkouts:
+            print(
+                f"🗄️ rerun db: {scope.connections_opened} new connection(s), "
+                f"{scope.checkouts} checkout(s), {scope.queries} queries"
+            )
+
+
+def get_request_db():
+    """Session for the current rerun, opened lazily on first use"""
+    scope = _current_scope.get()
+    if scope is None:
+        raise RuntimeError("get_request_db() called outside request_scope()")
+    if scope.session is None:
+        scope.connection = engine.connect()
+        scope.session = SessionLocal(bind=scope.connection)
+    return scope.session
+
+
 def get_db():
     """Get database session"""
     db = SessionLocal()
@@ -24,8 +187,10 @@ def get_db():
 
 def init_db():
     """Initialize database tables"""
-    from models import User, DetectionHistory
+    from models import User, DetectionHistory, Job, JobItem
+    from migrations import run_migrations
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
 
 @st.cache_resource
 def get_database_engine():
@@ -0,0 +1,293 @@
+"""Integrity scan of the image dataset: corrupt files, duplicates and label leaks.
+
+Every image under the dataset root is fully decoded, SHA-256 hashed and
+perceptually hashed in a process pool. Results are cached by
+(size, mtime), so later runs only read new or changed files.
+
+Files that are exact or near copies of each other (pHash Hamming distance up
+to --distance) are grouped, and files are quarantined when:
+
+- they don't decode (truncated, corrupt or empty);
+- their group spans more than one class, so the label is ambiguous;
+- their group has a member in train/ but they are in another split, so they
+  would leak into validation;
+- they are byte-identical extra copies within one split.
+
+The quarantine list is written next to the data, with paths relative to it.
+train_model.py, OOD calibration and the reference index build skip those
+files.
+
+    python dataset_scan.py
+    python dataset_scan.py --root dataset --workers 4 --distance 3
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from image_hash import hamming, phash
+
+DATASET_DIR = os.getenv('DATASET_DIR', 'dataset')
+QUARANTINE_FILE = "quarantine.json"
+SCAN_CACHE_FILE = ".scan_cache.json"
+QUARANTINE_PATH = os.getenv('DATASET_QUARANTINE', os.path.join(DATASET_DIR, QUARANTINE_FILE))
+# Max pHash Hamming distance for two dataset images to count as the same photo
+SCAN_NEAR_DISTANCE = int(os.getenv('SCAN_NEAR_DISTANCE', 2))
+TRAIN_SPLIT = "train"
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+HASH_SIDE = 224
+CACHE_SAVE_EVERY = 2000
+
+
+def find_dataset_images(root):
+    """Image paths under root, relative to it, in a stable order"""
+    paths = []
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.'):
+                paths.append(os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, '/'))
+    return paths
+
+
+def scan_file(root, rel_path):
+    """Cache entry for one file: stat signature, hashes and decode status"""
+    path = os.path.join(root, rel_path)
+    stat = os.stat(path)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': None, 'phash': None, 'error': None}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        entry['sha256'] = hashlib.sha256(data).hexdigest()
+        with Image.open(path) as image:
+            image.load()  # a full decode: truncated JPEGs only fail here
+            pixels = np.asarray(image.convert('RGB').resize((HASH_SIDE, HASH_SIDE), Image.BILINEAR),
+                                dtype=np.float32) / 255.0
+        entry['phash'] = f"{phash(pixels):016x}"
+    except Exception as e:
+        entry['error'] = f"{type(e).__name__}: {e}"
+    return rel_path, entry
+
+
+def _scan_chunk(args):
+    root, rel_paths = args
+    return [scan_file(root, p) for p in rel_paths]
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_scan_cache(root):
+    try:
+        with open(os.path.join(root, SCAN_CACHE_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def scan_dataset(root=DATASET_DIR, workers=None, rescan=False):
+    """Cache entries for every image under root, decoding only new or changed files"""
+    cache = {} if rescan else load_scan_cache(root)
+    paths = find_dataset_images(root)
+    entries, todo = {}, []
+    for rel_path in paths:
+        cached = cache.get(rel_path)
+        stat = os.stat(os.path.join(root, rel_path))
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            entries[rel_path] = cached
+        else:
+            todo.append(rel_path)
+    print(f"📂 {len(paths)} images, {len(entries)} unchanged since the last scan, {len(todo)} to scan")
+
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        chunk_size = 64
+        chunks = [(root, todo[i:i + chunk_size]) for i in range(0, len(todo), chunk_size)]
+        start = time.perf_counter()
+        done = 0
+        cache_path = os.path.join(root, SCAN_CACHE_FILE)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for results in pool.map(_scan_chunk, chunks):
+                entries.update(results)
+                done += len(results)
+                # Checkpoint so an interrupted first scan doesn't start over
+                if done % CACHE_SAVE_EVERY < chunk_size:
+                    _write_json_atomic(cache_path, entries)
+                    print(f"  {done}/{len(todo)} · {done / (time.perf_counter() - start):.0f} files/sec")
+        _write_json_atomic(cache_path, entries)
+    return entries
+
+
+def _split_and_label(rel_path):
+    parts = rel_path.split('/')
+    return parts[0], parts[-2] if len(parts) >= 3 else None
+
+
+def near_hash_pairs(hashes, max_distance):
+    """Pairs of distinct 64-bit hashes within max_distance bits.
+
+    Pigeonhole: split into max_distance + 1 bit ranges; any close pair agrees
+    exactly on at least one, so only same-bucket hashes are compared.
+    """
+    if max_distance <= 0:
+        return set()
+    bounds = [int(b) for b in np.linspace(0, 64, max_distance + 2)]
+    pairs = set()
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = ((1 << (hi - lo)) - 1) << lo
+        buckets = defaultdict(list)
+        for value in hashes:
+            buckets[value & mask].append(value)
+        for bucket in buckets.values():
+            for i, a in enumerate(bucket):
+                for b in bucket[i + 1:]:
+                    if hamming(a, b) <= max_distance:
+                        pairs.add((a, b) if a < b else (b, a))
+    return pairs
+
+
+def find_duplicate_groups(entries, max_distance=SCAN_NEAR_DISTANCE):
+    """Groups (sorted path lists) of exact or near-identical images, largest first"""
+    parent = {}
+
+    def find(p):
+        while parent[p] != p:
+            parent[p] = parent[parent[p]]
+            p = parent[p]
+        return p
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    by_sha = defaultdict(list)
+    by_phash = defaultdict(list)
+    for rel_path, entry in entries.items():
+        if entry['error'] is None:
+            parent[rel_path] = rel_path
+            by_sha[entry['sha256']].append(rel_path)
+            by_phash[int(entry['phash'], 16)].append(rel_path)
+    for same in list(by_sha.values()) + list(by_phash.values()):
+        for other in same[1:]:
+            union(same[0], other)
+
+    for a, b in near_hash_pairs(list(by_phash), max_distance):
+        union(by_phash[a][0], by_phash[b][0])
+
+    groups = defaultdict(list)
+    for rel_path in parent:
+        groups[find(rel_path)].append(rel_path)
+    return sorted((sorted(g) for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+
+def build_quarantine(entries, groups):
+    """{path: reason} for every file training should skip"""
+    quarantine = {path: f"unreadable: {entry['error']}" for path, entry in entries.items() if entry['error']}
+    for group in groups:
+        labels = sorted({_split_and_label(p)[1] for p in group})
+        if len(labels) > 1:
+            for path in group:
+                quarantine[path] = f"same image under several classes: {', '.join(labels)}"
+            continue
+        splits = {_split_and_label(p)[0] for p in group}
+        home = TRAIN_SPLIT if TRAIN_SPLIT in splits else _split_and_label(group[0])[0]
+        kept = [p for p in group if _split_and_label(p)[0] == home]
+        for path in group:
+            if _split_and_label(path)[0] != home:
+                quarantine[path] = f"duplicate of {home}/ image {kept[0]}"
+        seen = {}
+        for path in kept:
+            sha256 = entries[path]['sha256']
+            if sha256 in seen:
+                quarantine[path] = f"exact copy of {seen[sha256]}"
+            else:
+                seen[sha256] = path
+    return dict(sorted(quarantine.items()))
+
+
+def write_quarantine(quarantine, path):
+    _write_json_atomic(path, {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'files': quarantine,
+    })
+
+
+def load_quarantine(path=QUARANTINE_PATH):
+    """Absolute paths of quarantined files (empty if the dataset was never scanned)"""
+    try:
+        with open(path) as f:
+            files = json.load(f)['files']
+    except FileNotFoundError:
+        return frozenset()
+    base = os.path.dirname(os.path.abspath(path))
+    return frozenset(os.path.normpath(os.path.join(base, rel_path)) for rel_path in files)
+
+
+def is_quarantined(path, quarantine):
+    return os.path.normpath(os.path.abspath(path)) in quarantine
+
+
+def image_frame(split_dir, quarantine_path=QUARANTINE_PATH):
+    """(DataFrame of filename/class for a split, class names) minus quarantined files.
+
+    Class names are every class folder in sorted order, like flow_from_directory.
+    """
+    import pandas as pd
+
+    quarantine = load_quarantine(quarantine_path)
+    classes = sorted(d for d in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, d)))
+    rows, skipped = [], 0
+    for cls in classes:
+        cls_dir = os.path.join(split_dir, cls)
+        for name in sorted(os.listdir(cls_dir)):
+            path = os.path.join(cls_dir, name)
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if is_quarantined(path, quarantine):
+                skipped += 1
+                continue
+            rows.append((path, cls))
+    if skipped:
+        print(f"🚧 Skipping {skipped} quarantined image(s) in {split_dir}")
+    return pd.DataFrame(rows, columns=['filename', 'class']), classes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan the dataset for corrupt, duplicate and leaked images")
+    parser.add_argument("--root", default=DATASET_DIR)
+    parser.add_argument("--workers", type=int, help="scan processes (default: all cores)")
+    parser.add_argument("--distance", type=int, default=SCAN_NEAR_DISTANCE,
+                        help="max pHash Hamming distance for near-duplicates (0: exact only)")
+    parser.add_argument("--rescan", action="store_true", help="ignore the cache and read every file")
+    parser.add_argument("--out", help=f"quarantine list (default: <root>/{QUARANTINE_FILE})")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        raise SystemExit(f"❌ Not a directory: {args.root}")
+    entries = scan_dataset(args.root, args.workers, args.rescan)
+    groups = find_duplicate_groups(entries, args.distance)
+    quarantine = build_quarantine(entries, groups)
+    out_path = args.out or os.path.join(args.root, QUARANTINE_FILE)
+    write_quarantine(quarantine, out_path)
+
+    corrupt = sum(1 for e in entries.values() if e['error'])
+    conflicts = sum(1 for g in groups if len({_split_and_label(p)[1] for p in g}) > 1)
+    leaks = sum(1 for g in groups if len({_split_and_label(p)[0] for p in g}) > 1)
+    print(f"🔎 {corrupt} unreadable, {len(groups)} duplicate group(s): "
+          f"{leaks} across splits, {conflicts} with conflicting labels")
+    print(f"🚧 {len(quarantine)} file(s) quarantined -> {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,58 @@
 import json
+import numpy as np
 from sqlalchemy.orm import Session
 from models import DetectionHistory
 from datetime import datetime
-from disease_info import parse_disease_name
+from disease_info import label_for_class
+from metrics import stage_timer
+from image_hash import to_signed64
+from model_registry import class_names_for_version
 
-def save_detection(
-    db: Session,
+def encode_probabilities(probabilities):
+    """Pack a softmax vector into a little-endian float16 blob (2 bytes per class)"""
+    return np.asarray(probabilities, dtype='<f2').tobytes()
+
+def decode_probabilities(blob):
+    return np.frombuffer(blob, dtype='<f2').astype(np.float32)
+
+def detection_top_k(detection, k: int = 3):
+    """Top-k [{'class', 'confidence'}] of a history row, from its probability blob or legacy JSON"""
+    if detection.probabilities is not None:
+        probs = decode_probabilities(detection.probabilities)
+        class_names = class_names_for_version(detection.model_version)
+        top = np.argsort(probs)[::-1][:k]
+        return [
+            # A class list that lost track of an index still shows the score, unnamed
+            {'class': class_names[i] if i < len(class_names) else f"Unknown class #{i}",
+             'confidence': round(float(probs[i]), 4)}
+            for i in top if probs[i] > 0
+        ]
+    if detection.top_3_predictions:
+        try:
+            return json.loads(detection.top_3_predictions)[:k]
+        except (ValueError, TypeError):
+            return []
+    return []
+
+def _build_detection(
     user_id: int,
     image_name: str,
     predicted_class: str,
     confidence: float,
     top_3_predictions: list,
-    notes: str = None
+    notes: str = None,
+    image_hash: int = None,
+    model_version: str = None,
+    probabilities=None,
+    image_sha256: str = None
 ):
-    """Save a detection result to the database"""
-    crop_type, disease_name = parse_disease_name(predicted_class)
+    label = label_for_class(predicted_class)
+    crop_type, disease_name = label.crop, label.disease
     
-    top_3_json = json.dumps(top_3_predictions)
+    # With the full softmax stored, top-k is derived on read instead of kept as JSON
+    top_3_json = json.dumps(top_3_predictions) if probabilities is None else None
     
-    detection = DetectionHistory(
+    return DetectionHistory(
         user_id=user_id,
         image_name=image_name,
         predicted_class=predicted_class,
@@ -27,15 +61,68 @@ def save_detection(
         disease_name=disease_name,
         top_3_predictions=top_3_json,
         detection_date=datetime.utcnow(),
-        notes=notes
+        notes=notes,
+        image_phash=to_signed64(image_hash) if image_hash is not None else None,
+        model_version=model_version,
+        probabilities=encode_probabilities(probabilities) if probabilities is not None else None,
+        image_sha256=image_sha256
+    )
+
+def save_detection(
+    db: Session,
+    user_id: int,
+    image_name: str,
+    predicted_class: str,
+    confidence: float,
+    top_3_predictions: list,
+    notes: str = None,
+    image_hash: int = None,
+    model_version: str = None,
+    probabilities=None,
+    image_sha256: str = None
+):
+    """Save a detection result to the database"""
+    detection = _build_detection(
+        user_id, image_name, predicted_class, confidence, top_3_predictions, notes, image_hash, model_version,
+        probabilities, image_sha256
     )
     
-    db.add(detection)
-    db.commit()
-    db.refresh(detection)
+    with stage_timer("db_write"):
+        db.add(detection)
+        db.commit()
+        db.refresh(detection)
     
     return detection
 
+def save_detections(db: Session, user_id: int, items: list, commit: bool = True):
+    """Save several (image_name, prediction result) pairs in one commit; returns their ids
+
+    commit=False only flushes, so the caller can commit other changes atomically with them.
+    """
+    detections = [
+        _build_detection(
+            user_id,
+            image_name,
+            result['predicted_class'],
+            result['confidence'],
+            result['top_3_predictions'],
+            image_hash=result.get('image_hash'),
+            model_version=result.get('model_version'),
+            probabilities=result.get('all_predictions'),
+            image_sha256=result.get('image_sha256')
+        )
+        for image_name, result in items
+    ]
+    
+    with stage_timer("db_write"):
+        db.add_all(detections)
+        db.flush()
+        detection_ids = [d.id for d in detections]
+        if commit:
+            db.commit()
+    
+    return detection_ids
+
 def get_user_detections(db: Session, user_id: int, limit: int = 50):
     """Get detection history for a user"""
     return db.query(DetectionHistory).filter(
@@ -44,6 +131,39 @@ def get_user_detections(db: Session, user_id: int, limit: int = 50):
         DetectionHistory.detection_date.desc()
     ).limit(limit).all()
 
+def get_detections_by_ids(db: Session, user_id: int, detection_ids: list):
+    """Fetch a user's detections by id, preserving the given order"""
+    if not detection_ids:
+        return []
+    rows = db.query(DetectionHistory).filter(
+        DetectionHistory.user_id == user_id,
+        DetectionHistory.id.in_(detection_ids)
+    ).all()
+    by_id = {row.id: row for row in rows}
+    return [by_id[i] for i in detection_ids if i in by_id]
+
+def result_from_detection(detection):
+    """Rebuild a prediction result from a saved detection (None if its class is no longer known)"""
+    label = label_for_class(detection.predicted_class)
+    if label.index is None:
+        return None
+    top_3_predictions = []
+    for pred in detection_top_k(detection, 3):
+        # Indexes refer to the current label table, not the version that made the prediction
+        index = label_for_class(pred['class']).index
+        if index is None:
+            continue
+        top_3_predictions.append({'class': pred['class'], 'index': index, 'confidence': pred['confidence']})
+    return {
+        'predicted_class': detection.predicted_class,
+        'class_index': label.index,
+        'confidence': detection.confidence,
+        'top_3_predictions': top_3_predictions,
+        'tta': False,
+        'is_ood': False,
+        'model_version': detection.model_version
+    }
+
 def get_user_stats(db: Session, user_id: int):
     """Get statistics for a user's detections"""
     detections = db.query(DetectionHistory).filter(
@@ -1,5 +1,13 @@
 # ✅ disease_info.py
 # This file provides details for all detected plant diseases matching your model’s class names.
+import json
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+from metrics import register_collector
 
 disease_database = {
     # 🌶️ Pepper (Bell)
@@ -312,41 +320,114 @@ disease_database = {
 }
 
 
+UNKNOWN_DISEASE = MappingProxyType({
+    "name": "Unknown Disease",
+    "crop": "Unknown",
+    "pathogen": "Unknown",
+    "symptoms": ("Information not available",),
+    "treatment": ("Consult an agricultural expert",),
+    "prevention": ("Follow general plant health practices",)
+})
+
+
+def _canonical_key(class_name: str) -> str:
+    # Training folders mix "_", "__" and "___" separators ("Tomato__Target_Spot",
+    # "Potato___Early_blight"); collapse them so either spelling matches.
+    return re.sub(r"_+", "_", class_name.strip()).lower()
+
+
+def _freeze(info: dict):
+    return MappingProxyType({k: tuple(v) if isinstance(v, list) else v for k, v in info.items()})
+
+
+_info_by_key = {_canonical_key(k): _freeze(v) for k, v in disease_database.items()}
+
+
 # ✅ Function to get disease details safely
+@lru_cache(maxsize=None)
 def get_disease_info(predicted_class: str):
     if not predicted_class:
-        return {
-            "name": "Unknown Disease",
-            "crop": "Unknown",
-            "pathogen": "Unknown",
-            "symptoms": ["Information not available"],
-            "treatment": ["Consult an agricultural expert"],
-            "prevention": ["Follow general plant health practices"]
-        }
-
-    info = disease_database.get(predicted_class)
-    if info:
-        return info
-
-    # fallback normalization
-    normalized = predicted_class.replace("__", "___")
-    return disease_database.get(normalized, {
-        "name": "Unknown Disease",
-        "crop": "Unknown",
-        "pathogen": "Unknown",
-        "symptoms": ["Information not available"],
-        "treatment": ["Consult an agricultural expert"],
-        "prevention": ["Follow general plant health practices"]
-    })
+        return UNKNOWN_DISEASE
+    return _info_by_key.get(_canonical_key(predicted_class), UNKNOWN_DISEASE)
 
 
 # ✅ Function to extract readable names
 def parse_disease_name(predicted_class: str):
     if not predicted_class or not isinstance(predicted_class, str):
         return ("Unknown", "Unknown")
+    return _parse_disease_name(predicted_class)
+
 
+@lru_cache(maxsize=None)
+def _parse_disease_name(predicted_class: str):
     name = predicted_class.replace("___", " ").replace("__", " ").replace("_", " ")
     parts = name.split()
     if len(parts) > 1:
         return (parts[0].capitalize(), " ".join(parts[1:]).capitalize())
     return ("Unknown", name.capitalize())
+
+
+# ✅ Precomputed per-class metadata, resolved by class index in O(1)
+LabelInfo = namedtuple("LabelInfo", ["index", "class_name", "crop", "disease", "info", "is_healthy"])
+
+CLASS_NAMES_PATH = "class_names_from_training.json"
+
+
+@lru_cache(maxsize=1024)
+def _make_label(index, class_name):
+    crop, disease = parse_disease_name(class_name)
+    return LabelInfo(
+        index=index,
+        class_name=class_name,
+        crop=crop,
+        disease=disease,
+        info=get_disease_info(class_name),
+        is_healthy="healthy" in disease.lower()
+    )
+
+
+def build_label_table(class_names):
+    """Immutable table of LabelInfo, indexed by model class index"""
+    return tuple(_make_label(idx, name) for idx, name in enumerate(class_names))
+
+
+@lru_cache(maxsize=None)
+def get_label_table(class_names_path: str = CLASS_NAMES_PATH):
+    """Label table for a class-names JSON file, built once per path"""
+    with open(class_names_path, "r") as f:
+        return build_label_table(json.load(f))
+
+
+@lru_cache(maxsize=None)
+def _labels_by_name():
+    from hierarchical import extend_class_names
+
+    if not os.path.exists(CLASS_NAMES_PATH):
+        return MappingProxyType({})
+    with open(CLASS_NAMES_PATH, "r") as f:
+        # Same indices as a model with crop heads, which may add classes (e.g. a new crop)
+        class_names = extend_class_names(json.load(f))
+    return MappingProxyType({label.class_name: label for label in build_label_table(class_names)})
+
+
+def label_for_class(class_name: str):
+    """LabelInfo for a stored class name (e.g. from detection history)"""
+    label = _labels_by_name().get(class_name)
+    if label is None:
+        label = _make_label(None, class_name)
+    return label
+
+
+@register_collector
+def _label_cache_metrics():
+    """Hit/miss counts of the label lookup caches, read at scrape time"""
+    lines = [
+        "# HELP plant_label_cache_total Label/disease-info cache lookups by cache and result",
+        "# TYPE plant_label_cache_total counter",
+    ]
+    for name, fn in (("disease_info", get_disease_info), ("parse_disease_name", _parse_disease_name),
+                     ("label", _make_label)):
+        info = fn.cache_info()
+        lines.append(f'plant_label_cache_total{{cache="{name}",result="hit"}} {info.hits}')
+        lines.append(f'plant_label_cache_total{{cache="{name}",result="miss"}} {info.misses}')
+    return lines
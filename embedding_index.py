@@ -0,0 +1,238 @@
+"""Nearest-neighbor search over model embeddings.
+
+Embeddings (the model's penultimate-layer output) are L2-normalized and
+stored as float16 rows in an append-only side file next to an int64 key
+file, so 100k+ vectors take a few tens of MB and are searched through a
+memory map with chunked brute-force matrix products.
+
+Two indexes live under EMBEDDING_DIR:
+    detections/  keyed by (detection id, user id), appended by the app
+    reference/   keyed by (row in paths.json, -1), built from the dataset
+
+Embeddings from different models are not comparable, so each registry
+version gets its own pair under versions/<version>/; the top-level pair
+belongs to the unversioned model file.
+
+    python embedding_index.py build-reference --data dataset/train --per-class 200
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within one process
+    fcntl = None
+
+EMBEDDING_DIR = os.getenv('EMBEDDING_DIR', 'embeddings')
+SEARCH_CHUNK_ROWS = 65536
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class VectorIndex:
+    """Append-only float16 vector store with cosine top-k search"""
+
+    def __init__(self, directory, dim=None):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.keys_path = os.path.join(directory, "keys.i64")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._keys = None
+        self._rows = -1
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)['dim']
+            if dim is not None and dim != self.dim:
+                raise ValueError(f"Index at {directory} has dim {self.dim}, model gives {dim}")
+        else:
+            self.dim = dim
+
+    def __len__(self):
+        if self.dim is None or not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return 0
+        return min(os.path.getsize(self.vectors_path) // (2 * self.dim), os.path.getsize(self.keys_path) // 16)
+
+    def _lock_file(self):
+        """Exclusive cross-process lock on the index files; close the returned file to release"""
+        lock_file = open(os.path.join(self.directory, ".lock"), "w")
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _truncate_to_pairs(self):
+        """Drop the unpaired tail an interrupted append left behind (hold _lock_file)"""
+        rows = len(self)
+        for path, row_bytes in ((self.vectors_path, 2 * self.dim), (self.keys_path, 16)):
+            if os.path.exists(path) and os.path.getsize(path) != rows * row_bytes:
+                print(f"⚠️ Truncating {path} to {rows} rows after an interrupted append")
+                os.truncate(path, rows * row_bytes)
+
+    def add(self, vectors, item_ids, owner_ids=None):
+        """Append vectors with their (item id, owner id) keys"""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        item_ids = np.atleast_1d(np.asarray(item_ids, dtype=np.int64))
+        owner_ids = (np.full(len(item_ids), -1, dtype=np.int64) if owner_ids is None
+                     else np.atleast_1d(np.asarray(owner_ids, dtype=np.int64)))
+        if len(vectors) != len(item_ids) or len(item_ids) != len(owner_ids):
+            raise ValueError("vectors, item_ids and owner_ids must have the same length")
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({'dim': self.dim}, f)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-d vectors, got {vectors.shape[1]}-d")
+
+            normalized = _normalize(vectors).astype(np.float16)
+            keys = np.stack([item_ids, owner_ids], axis=1)
+            # Job workers append from other processes; keep vector and key rows paired
+            with self._lock_file():
+                # A reader sizes the index by the shorter file, so a torn append stays invisible;
+                # drop its tail before appending or the files would stay misaligned
+                self._truncate_to_pairs()
+                with open(self.vectors_path, "ab") as f:
+                    f.write(normalized.tobytes())
+                with open(self.keys_path, "ab") as f:
+                    f.write(keys.tobytes())
+
+    def _refresh(self):
+        rows = len(self)
+        if rows != self._rows:
+            if rows and (os.path.getsize(self.vectors_path) != rows * 2 * self.dim
+                         or os.path.getsize(self.keys_path) != rows * 16):
+                with self._lock_file():
+                    self._truncate_to_pairs()
+                rows = len(self)
+            if rows == 0:
+                self._vectors = np.zeros((0, self.dim or 0), dtype=np.float16)
+                self._keys = np.zeros((0, 2), dtype=np.int64)
+            else:
+                self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(rows, self.dim))
+                self._keys = np.memmap(self.keys_path, dtype=np.int64, mode="r", shape=(rows, 2))
+            self._rows = rows
+        return self._vectors, self._keys
+
+    def search(self, query, k=5, owner_id=None, exclude_ids=()):
+        """Top-k (item_id, owner_id, cosine similarity), best first"""
+        with self._lock:
+            vectors, keys = self._refresh()
+        if len(vectors) == 0:
+            return []
+
+        q = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        # Per-user searches only touch that user's rows
+        rows = np.flatnonzero(keys[:, 1] == owner_id) if owner_id is not None else None
+        if rows is not None:
+            if exclude_ids:
+                rows = rows[~np.isin(keys[rows, 0], list(exclude_ids))]
+            if len(rows) == 0:
+                return []
+
+        total = len(vectors) if rows is None else len(rows)
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, SEARCH_CHUNK_ROWS):
+            block = (vectors[start:start + SEARCH_CHUNK_ROWS] if rows is None
+                     else vectors[rows[start:start + SEARCH_CHUNK_ROWS]])
+            scores[start:start + len(block)] = block.astype(np.float32) @ q
+        if rows is None and exclude_ids:
+            scores[np.isin(keys[:, 0], list(exclude_ids))] = -np.inf
+
+        k = min(k, total)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        positions = top if rows is None else rows[top]
+        return [
+            (int(keys[p, 0]), int(keys[p, 1]), float(scores[t]))
+            for t, p in zip(top, positions) if np.isfinite(scores[t])
+        ]
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def index_dir(name, version=None, root=EMBEDDING_DIR):
+    """Directory of the named index for a model version (None: the unversioned model)"""
+    if version is None:
+        return os.path.join(root, name)
+    return os.path.join(root, "versions", version, name)
+
+
+def get_detection_index(dim=None, root=EMBEDDING_DIR, version=None):
+    return VectorIndex(index_dir("detections", version, root), dim)
+
+
+def get_reference_index(dim=None, root=EMBEDDING_DIR, version=None):
+    return VectorIndex(index_dir("reference", version, root), dim)
+
+
+def load_reference_paths(root=EMBEDDING_DIR, version=None):
+    path = os.path.join(index_dir("reference", version, root), "paths.json")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_reference_index(model, data_dir, per_class=200, batch_size=32, root=EMBEDDING_DIR):
+    """Embed up to per_class images per class folder into a fresh reference index"""
+    from PIL import Image
+    import shutil
+    from dataset_scan import is_quarantined, load_quarantine
+
+    ref_dir = index_dir("reference", model.version, root)
+    shutil.rmtree(ref_dir, ignore_errors=True)
+    index = VectorIndex(ref_dir)
+
+    quarantine = load_quarantine()
+    paths = []
+    for cls in sorted(os.listdir(data_dir)):
+        cls_dir = os.path.join(data_dir, cls)
+        if not os.path.isdir(cls_dir):
+            continue
+        files = sorted(f for f in os.listdir(cls_dir) if f.lower().endswith(IMAGE_EXTENSIONS)
+                       and not is_quarantined(os.path.join(cls_dir, f), quarantine))
+        paths.extend(os.path.join(cls_dir, f) for f in files[:per_class])
+
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        images = [Image.open(p).convert('RGB') for p in chunk]
+        results = model.predict_batch(images, batch_size=batch_size, tta='off')
+        index.add(np.stack([r['embedding'] for r in results]), np.arange(start, start + len(chunk)))
+        print(f"  embedded {start + len(chunk)}/{len(paths)}")
+
+    with open(os.path.join(ref_dir, "paths.json"), "w") as f:
+        json.dump(paths, f)
+    return index
+
+
+def main():
+    from model_registry import ModelManager
+
+    parser = argparse.ArgumentParser(description="Embedding index tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ref = sub.add_parser("build-reference", help="embed dataset images as reference cases")
+    p_ref.add_argument("--data", default="dataset/train")
+    p_ref.add_argument("--per-class", type=int, default=200)
+    p_ref.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    # The active registry version (or the bare model file), so the index lands under its version
+    plant_model = ModelManager().get()
+    if plant_model.model is None:
+        raise SystemExit("❌ A trained model is required to build the reference index.")
+    index = build_reference_index(plant_model, args.data, args.per_class, args.batch_size)
+    print(f"✅ Reference index: {len(index)} vectors ({index.dim}-d) in {index.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Streaming export of a user's detection history to CSV or Parquet.
+
+Rows are read in fixed-size batches (server-side cursor on Postgres,
+lazy cursor on SQLite) and written out as they arrive, so memory stays
+constant regardless of history size.
+
+    python export_utils.py --user alice --format parquet --out alice.parquet
+"""
+import argparse
+import csv
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import DetectionHistory
+from detection_utils import detection_top_k
+
+EXPORT_BATCH_SIZE = 1000
+TOP_K_COLUMNS = 3
+
+BASE_COLUMNS = [
+    'id',
+    'detection_date',
+    'image_name',
+    'predicted_class',
+    'crop_type',
+    'disease_name',
+    'confidence',
+    'notes',
+    'model_version',
+]
+TOP_K_FIELDS = [
+    field
+    for i in range(1, TOP_K_COLUMNS + 1)
+    for field in (f'top{i}_class', f'top{i}_confidence')
+]
+EXPORT_COLUMNS = BASE_COLUMNS + TOP_K_FIELDS
+
+
+def iter_user_detections(db: Session, user_id: int, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield lists of flattened detection dicts, oldest first, batch_size at a time"""
+    stmt = (
+        select(
+            DetectionHistory.id,
+            DetectionHistory.detection_date,
+            DetectionHistory.image_name,
+            DetectionHistory.predicted_class,
+            DetectionHistory.crop_type,
+            DetectionHistory.disease_name,
+            DetectionHistory.confidence,
+            DetectionHistory.notes,
+            DetectionHistory.model_version,
+            DetectionHistory.top_3_predictions,
+            DetectionHistory.probabilities,
+        )
+        .where(DetectionHistory.user_id == user_id)
+        .order_by(DetectionHistory.detection_date, DetectionHistory.id)
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    result = db.execute(stmt)
+    try:
+        for partition in result.partitions():
+            yield [_flatten_row(row) for row in partition]
+    finally:
+        result.close()
+
+
+def _flatten_row(row):
+    """Turn one history row into a flat dict with top-k predictions as columns"""
+    record = {col: getattr(row, col) for col in BASE_COLUMNS}
+    top_k = detection_top_k(row, TOP_K_COLUMNS)
+    for i in range(TOP_K_COLUMNS):
+        pred = top_k[i] if i < len(top_k) else {}
+        record[f'top{i + 1}_class'] = pred.get('class')
+        record[f'top{i + 1}_confidence'] = pred.get('confidence')
+    return record
+
+
+def export_detections_csv(db: Session, user_id: int, fileobj, batch_size: int = EXPORT_BATCH_SIZE):
+    """Write a user's history as CSV to an open text file; returns row count"""
+    writer = csv.DictWriter(fileobj, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    count = 0
+    for batch in iter_user_detections(db, user_id, batch_size):
+        for record in batch:
+            if record['detection_date'] is not None:
+                record['detection_date'] = record['detection_date'].isoformat()
+        writer.writerows(batch)
+        count += len(batch)
+    return count
+
+
+def _parquet_schema(pa):
+    """Schema in EXPORT_COLUMNS order, so Parquet and CSV carry the same columns"""
+    types = {
+        'id': pa.int64(),
+        'detection_date': pa.timestamp('us'),
+        'confidence': pa.float64(),
+    }
+    types.update({f'top{i}_confidence': pa.float64() for i in range(1, TOP_K_COLUMNS + 1)})
+    return pa.schema([pa.field(name, types.get(name, pa.string())) for name in EXPORT_COLUMNS])
+
+
+def export_detections_parquet(db: Session, user_id: int, path: str, batch_size: int = EXPORT_BATCH_SIZE):
+    """Write a user's history as Parquet, one row group per batch; returns row count"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export requires pyarrow (pip install pyarrow)") from e
+
+    schema = _parquet_schema(pa)
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in iter_user_detections(db, user_id, batch_size):
+            columns = {name: [record[name] for record in batch] for name in EXPORT_COLUMNS}
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            count += len(batch)
+    return count
+
+
+def export_detections(db: Session, user_id: int, path: str, fmt: str = 'csv'):
+    """Export to a file path in the given format ('csv' or 'parquet')"""
+    if fmt == 'csv':
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            return export_detections_csv(db, user_id, f)
+    if fmt == 'parquet':
+        return export_detections_parquet(db, user_id, path)
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+def main():
+    from database import SessionLocal
+    from auth import get_user_by_username
+
+    parser = argparse.ArgumentParser(description="Export a user's detection history")
+    parser.add_argument("--user", required=True, help="username to export")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--out", help="output file (default: <user>_history.<format>)")
+    args = parser.parse_args()
+
+    out = args.out or f"{args.user}_history.{args.format}"
+    db = SessionLocal()
+    try:
+        user = get_user_by_username(db, args.user)
+        if user is None:
+            raise SystemExit(f"❌ No such user: {args.user}")
+        count = export_detections(db, user.id, out, args.format)
+    finally:
+        db.close()
+    print(f"✅ Exported {count} detections to {out}")
+
+
+if __name__ == "__main__":
+    main()
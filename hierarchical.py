@@ -0,0 +1,354 @@
+"""Crop-then-disease prediction with small heads over the shared backbone features.
+
+Class names already encode the crop ("Tomato_*", "Potato___*",
+"Pepper__bell___*"), so the flat softmax can be factored as
+P(class) = P(crop) * P(disease | crop).
+
+A crop head and one disease head per crop are softmax layers on the model's
+embedding output, so they reuse the single backbone pass that predict()
+already makes. When the caller knows the crop, the crop stage is skipped and
+only that crop's head runs. PREDICT_MODE=hierarchical sends every
+prediction through the heads. In the default "flat" mode they are only used
+when a crop is given.
+
+Heads train on cached backbone features in seconds. Adding a crop means
+adding its class folders, then retraining the crop head and training the new
+crop's disease head. The backbone and the other heads stay untouched. Classes
+the flat model doesn't know are appended after its class list.
+
+    hierarchy/
+        heads.json          model file SHA-256, class list, crops
+        extra_classes.json  classes added beyond the flat model's, append-only
+        crop.npz            crop head
+        disease_<crop>.npz  one disease head per crop
+        features.npz        feature cache (per file size/mtime)
+
+    python hierarchical.py train --data dataset/train --valid dataset/valid
+    python hierarchical.py train --data dataset/train --crops Corn
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+from PIL import Image
+
+from dataset_scan import image_frame
+from disease_info import parse_disease_name
+
+HIERARCHY_DIR = os.getenv('HIERARCHY_DIR', 'hierarchy')
+# "hierarchical" routes every prediction through the heads; "flat" only uses them when a crop is given
+PREDICT_MODE = os.getenv('PREDICT_MODE', 'flat')
+HEAD_STEPS = int(os.getenv('HEAD_STEPS', 2000))
+
+HEADS_FILE = "heads.json"
+FEATURES_FILE = "features.npz"
+EXTRA_CLASSES_FILE = "extra_classes.json"
+
+
+def crop_of(class_name):
+    return parse_disease_name(class_name)[0]
+
+
+def crop_indices(class_names):
+    """{crop: [class indices]} in class-list order, without the unknown crop"""
+    groups = {}
+    for index, name in enumerate(class_names):
+        crop = crop_of(name)
+        if crop != "Unknown":
+            groups.setdefault(crop, []).append(index)
+    return groups
+
+
+def restrict_to_crop(probs, indices):
+    """Flat softmax rows renormalized over one crop's classes"""
+    restricted = np.zeros_like(probs)
+    restricted[:, indices] = probs[:, indices]
+    return restricted / np.maximum(restricted.sum(axis=1, keepdims=True), 1e-12)
+
+
+def extend_class_names(class_names, directory=HIERARCHY_DIR):
+    """class_names followed by the classes heads have added beyond them, in the order they were added.
+
+    extra_classes.json only ever grows, so an index into a stored probability
+    vector keeps naming the same class after heads are retrained.
+    """
+    try:
+        with open(os.path.join(directory, EXTRA_CLASSES_FILE)) as f:
+            extra = json.load(f)
+    except FileNotFoundError:
+        extra = []
+    return list(class_names) + [name for name in extra if name not in class_names]
+
+
+def _record_extra_classes(directory, names):
+    path = os.path.join(directory, EXTRA_CLASSES_FILE)
+    extra = extend_class_names([], directory)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(extra + [name for name in names if name not in extra], f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def backbone_id(model_path):
+    """SHA-256 of the model file: heads and cached features are only valid for those weights.
+
+    Content rather than path, so a registry copy of the same file keeps its heads.
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def _head_path(directory, crop):
+    return os.path.join(directory, "disease_" + re.sub(r"\W+", "_", crop.lower()) + ".npz")
+
+
+class CropHierarchy:
+    """Crop head plus per-crop disease heads, producing softmaxes over class_names"""
+
+    def __init__(self, class_names, crops, crop_head, disease_heads):
+        self.class_names = list(class_names)
+        self.crops = list(crops)
+        self.crop_head = crop_head  # (kernel, bias) over self.crops
+        self.disease_heads = disease_heads  # crop -> (kernel, bias, class indices)
+
+    @classmethod
+    def load(cls, model_path, directory=HIERARCHY_DIR):
+        """Heads trained for this model file, or None (missing, or trained on another backbone)"""
+        try:
+            with open(os.path.join(directory, HEADS_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta['backbone'] != backbone_id(model_path):
+            print(f"⚠️ Crop heads in {directory} were trained on another model; retrain them with `python hierarchical.py train`")
+            return None
+        crop_head = np.load(os.path.join(directory, "crop.npz"))
+        disease_heads = {}
+        for crop, classes in meta['crops'].items():
+            head = np.load(_head_path(directory, crop))
+            disease_heads[crop] = (head['kernel'], head['bias'], [meta['class_names'].index(c) for c in classes])
+        print(f"✅ Loaded crop heads for {', '.join(meta['crops'])}")
+        return cls(meta['class_names'], list(meta['crops']), (crop_head['kernel'], crop_head['bias']), disease_heads)
+
+    def resolve_crop(self, crop):
+        for known in self.crops:
+            if known.lower() == crop.lower():
+                return known
+        raise ValueError(f"❌ Unknown crop '{crop}'. Known crops: {', '.join(self.crops)}")
+
+    def crop_probabilities(self, features):
+        kernel, bias = self.crop_head
+        return _softmax(features @ kernel + bias)
+
+    def predict(self, features, crop=None):
+        """(N, len(class_names)) softmax; with a known crop only its disease head runs"""
+        features = np.asarray(features, dtype=np.float32)
+        probs = np.zeros((len(features), len(self.class_names)), dtype=np.float32)
+        if crop is not None:
+            kernel, bias, indices = self.disease_heads[self.resolve_crop(crop)]
+            probs[:, indices] = _softmax(features @ kernel + bias)
+            return probs
+        crop_probs = self.crop_probabilities(features)
+        for j, name in enumerate(self.crops):
+            kernel, bias, indices = self.disease_heads[name]
+            probs[:, indices] += crop_probs[:, j:j + 1] * _softmax(features @ kernel + bias)
+        return probs
+
+
+def load_features(plant_model, frame, directory=HIERARCHY_DIR, batch_size=32):
+    """(backbone features, flat softmax) for every frame row, computing only files not already cached"""
+    cache_path = os.path.join(directory, FEATURES_FILE)
+    backbone = backbone_id(plant_model.model_path)
+    cached = {}
+    if os.path.exists(cache_path):
+        stored = np.load(cache_path)
+        if str(stored['backbone']) == backbone:
+            for path, stamp, features, probs in zip(stored['paths'], stored['stamps'], stored['features'], stored['probs']):
+                cached[str(path)] = (str(stamp), features, probs)
+
+    rows = []
+    for path in frame['filename']:
+        stat = os.stat(path)
+        rows.append((path, f"{stat.st_size}:{stat.st_mtime_ns}"))
+    missing = [(path, stamp) for path, stamp in rows if cached.get(path, (None,))[0] != stamp]
+    print(f"🧮 {len(rows) - len(missing)} cached features, {len(missing)} to compute")
+
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        images = []
+        for path, _ in chunk:
+            with Image.open(path) as image:
+                images.append(image.convert('RGB'))
+        probs, embeddings, _ = plant_model.forward_images(images, batch_size)
+        for (path, stamp), features, row in zip(chunk, embeddings.astype(np.float16), probs.astype(np.float16)):
+            cached[path] = (stamp, features, row)
+        if (start // batch_size) % 20 == 0:
+            print(f"  embedded {start + len(chunk)}/{len(missing)}")
+
+    if missing:
+        # The cache keeps every split it has seen; train and valid share one file
+        os.makedirs(directory, exist_ok=True)
+        paths = list(cached)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, backbone=backbone, paths=np.array(paths),
+                 stamps=np.array([cached[p][0] for p in paths]),
+                 features=np.stack([cached[p][1] for p in paths]),
+                 probs=np.stack([cached[p][2] for p in paths]))
+        os.replace(tmp_path, cache_path)
+    features = np.stack([cached[path][1] for path, _ in rows]).astype(np.float32)
+    probs = np.stack([cached[path][2] for path, _ in rows]).astype(np.float32)
+    return features, probs
+
+
+def train_head(features, labels, num_classes, steps=HEAD_STEPS, batch_size=256, learning_rate=0.01, l2=1e-4):
+    """(kernel, bias) of a softmax layer fitted to integer labels with minibatch Adam.
+
+    Trains on standardized features, then folds the scaling into the kernel,
+    so the head applies directly to raw features.
+    """
+    if num_classes == 1:
+        return np.zeros((features.shape[1], 1), np.float32), np.zeros(1, np.float32)
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0) + 1e-6
+    x = ((features - mean) / scale).astype(np.float32)
+    onehot = np.eye(num_classes, dtype=np.float32)[labels]
+
+    rng = np.random.default_rng(0)
+    params = [np.zeros((x.shape[1], num_classes), np.float32), np.zeros(num_classes, np.float32)]
+    moments = [[np.zeros_like(p), np.zeros_like(p)] for p in params]
+    for step in range(1, steps + 1):
+        batch = rng.choice(len(x), min(batch_size, len(x)), replace=False)
+        error = (_softmax(x[batch] @ params[0] + params[1]) - onehot[batch]) / len(batch)
+        grads = [x[batch].T @ error + l2 * params[0], error.sum(axis=0)]
+        for param, grad, moment in zip(params, grads, moments):
+            moment[0] = 0.9 * moment[0] + 0.1 * grad
+            moment[1] = 0.999 * moment[1] + 0.001 * grad ** 2
+            param -= learning_rate * (moment[0] / (1 - 0.9 ** step)) / (np.sqrt(moment[1] / (1 - 0.999 ** step)) + 1e-8)
+
+    kernel = params[0] / scale[:, None]
+    return kernel.astype(np.float32), (params[1] - mean @ kernel).astype(np.float32)
+
+
+def train_hierarchy(plant_model, data_dir, directory=HIERARCHY_DIR, crops=None):
+    """Train the crop head and the disease heads of `crops` (all if None); returns the CropHierarchy.
+
+    Other crops keep their existing heads if those were trained on the same
+    backbone and their class folders haven't changed.
+    """
+    frame, _ = image_frame(data_dir)
+    features, _ = load_features(plant_model, frame, directory)
+
+    existing = CropHierarchy.load(plant_model.model_path, directory)
+    class_names = extend_class_names(plant_model.class_names, directory)
+    new_classes = sorted(set(frame['class']) - set(class_names))
+    if new_classes:
+        # New classes go after the flat list and every class added before them
+        os.makedirs(directory, exist_ok=True)
+        _record_extra_classes(directory, new_classes)
+        class_names += new_classes
+    crop_labels = frame['class'].map(crop_of)
+    known_crops = sorted(set(crop_labels) - {"Unknown"})
+    if crops is None:
+        retrain = set(known_crops)
+    else:
+        retrain = {c for c in known_crops if c.lower() in {x.lower() for x in crops}}
+        if not retrain:
+            raise ValueError(f"❌ No training images for crops {', '.join(crops)} in {data_dir}")
+    for crop in known_crops:
+        # A kept head must exist and still cover exactly the crop's class folders
+        classes = set(frame['class'][crop_labels == crop])
+        if existing is None or crop not in existing.disease_heads or classes != {
+                existing.class_names[i] for i in existing.disease_heads[crop][2]}:
+            retrain.add(crop)
+
+    # The crop head always covers every crop, so it is retrained; its features are cached
+    usable = crop_labels.isin(known_crops).to_numpy()
+    print(f"🎯 Training the crop head on {usable.sum()} images over {len(known_crops)} crops")
+    crop_head = train_head(features[usable], crop_labels[usable].map(known_crops.index).to_numpy(), len(known_crops))
+
+    os.makedirs(directory, exist_ok=True)
+    np.savez(os.path.join(directory, "crop.npz"), kernel=crop_head[0], bias=crop_head[1])
+    crop_classes = {}
+    disease_heads = {}
+    for crop in known_crops:
+        if crop not in retrain:
+            kernel, bias, indices = existing.disease_heads[crop]
+            crop_classes[crop] = [existing.class_names[i] for i in indices]
+            disease_heads[crop] = (kernel, bias, [class_names.index(c) for c in crop_classes[crop]])
+            continue
+        rows = (crop_labels == crop).to_numpy()
+        classes = sorted(set(frame['class'][rows]), key=class_names.index)
+        print(f"🦠 Training the {crop} disease head on {rows.sum()} images over {len(classes)} classes")
+        kernel, bias = train_head(features[rows], frame['class'][rows].map(classes.index).to_numpy(), len(classes))
+        np.savez(_head_path(directory, crop), kernel=kernel, bias=bias)
+        disease_heads[crop] = (kernel, bias, [class_names.index(c) for c in classes])
+        crop_classes[crop] = classes
+
+    with open(os.path.join(directory, HEADS_FILE), "w") as f:
+        json.dump({
+            'backbone': backbone_id(plant_model.model_path),
+            'class_names': class_names,
+            'crops': crop_classes,
+        }, f, indent=2)
+    return CropHierarchy(class_names, known_crops, crop_head, disease_heads)
+
+
+def evaluate(plant_model, hierarchy, data_dir, directory=HIERARCHY_DIR):
+    """Top-1 accuracy on a labeled split: flat model, heads, and heads given the true crop"""
+    frame, _ = image_frame(data_dir)
+    frame = frame[frame['class'].isin(hierarchy.class_names)]
+    features, flat = load_features(plant_model, frame, directory)
+    truth = frame['class'].map(hierarchy.class_names.index).to_numpy()
+
+    accuracy = {
+        'flat': float((flat.argmax(axis=1) == truth).mean()),
+        'hierarchical': float((hierarchy.predict(features).argmax(axis=1) == truth).mean()),
+    }
+    given = np.zeros(len(truth), dtype=bool)
+    for crop in hierarchy.crops:
+        rows = (frame['class'].map(crop_of) == crop).to_numpy()
+        if rows.any():
+            given[rows] = hierarchy.predict(features[rows], crop).argmax(axis=1) == truth[rows]
+    accuracy['crop_given'] = float(given.mean())
+    return accuracy
+
+
+def main():
+    from model import PlantDiseaseModel
+
+    parser = argparse.ArgumentParser(description="Train crop and per-crop disease heads on cached backbone features")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_train = sub.add_parser("train", help="train the crop head and disease heads")
+    p_train.add_argument("--model", default="plant_disease_model.h5")
+    p_train.add_argument("--classes", default="class_names_from_training.json")
+    p_train.add_argument("--data", default="dataset/train")
+    p_train.add_argument("--valid", help="labeled split to report accuracy on")
+    p_train.add_argument("--crops", nargs="+", help="only (re)train these crops' disease heads")
+    p_train.add_argument("--dir", default=HIERARCHY_DIR)
+    args = parser.parse_args()
+
+    plant_model = PlantDiseaseModel(model_path=args.model, class_names_path=args.classes, hierarchy_dir=None)
+    if not plant_model.load_model():
+        raise SystemExit("❌ A trained model is required.")
+    hierarchy = train_hierarchy(plant_model, args.data, args.dir, args.crops)
+    print(f"✅ Crop heads for {', '.join(hierarchy.crops)} saved to {args.dir}")
+    if args.valid:
+        plant_model.hierarchy = hierarchy
+        accuracy = evaluate(plant_model, hierarchy, args.valid, args.dir)
+        print("📊 Validation accuracy: " + ", ".join(f"{k} {v:.2%}" for k, v in accuracy.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Perceptual hashing and near-duplicate lookup.
+
+Hashes are computed from the model's preprocessing buffer (224x224 RGB in
+[0, 1]), so no extra decode or resize is needed. Each user's hashes live in
+a BK-tree, which keeps Hamming-radius queries sublinear as history grows.
+"""
+import os
+import threading
+
+import numpy as np
+
+# Max Hamming distance (out of 64 bits) for two photos to count as near-duplicates
+NEAR_DUPLICATE_DISTANCE = int(os.getenv('NEAR_DUPLICATE_DISTANCE', 6))
+
+_HASH_SIDE = 32
+_DCT_KEEP = 8
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+_DCT = _dct_matrix(_HASH_SIDE)
+
+
+def _gray_thumbnail(image_array, side=_HASH_SIDE):
+    """Grayscale side x side block-mean thumbnail of an (H, W, 3) float array"""
+    arr = np.asarray(image_array, dtype=np.float32)
+    if arr.ndim == 4:
+        arr = arr[0]
+    gray = arr[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    h, w = gray.shape
+    bh, bw = h // side, w // side
+    gray = gray[:bh * side, :bw * side]
+    return gray.reshape(side, bh, side, bw).mean(axis=(1, 3))
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def phash(image_array):
+    """64-bit DCT perceptual hash"""
+    thumb = _gray_thumbnail(image_array)
+    coeffs = (_DCT @ thumb @ _DCT.T)[:_DCT_KEEP, :_DCT_KEEP]
+    flat = coeffs.ravel()
+    median = np.median(flat[1:])  # ignore the DC term
+    return _bits_to_int(coeffs > median)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def to_signed64(value):
+    """Store an unsigned 64-bit hash in a signed BIGINT column"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_signed64(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes with Hamming distance"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """[(distance, item)] within max_distance, closest first"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= max_distance:
+                found.extend((d, item) for item in node[1])
+            # Triangle inequality: only subtrees at distance d±max can match
+            for edge, child in node[2].items():
+                if d - max_distance <= edge <= d + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Per-user BK-trees of detection image hashes.
+
+    Each lookup first pulls the user's rows added since the last sync (by id),
+    so detections saved by other processes, such as job workers, are found too.
+    """
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self._trees = {}  # user_id -> (BKTree, last synced detection id)
+        self._lock = threading.Lock()
+
+    def _sync(self, db, user_id):
+        from models import DetectionHistory
+        tree, last_id = self._trees.get(user_id) or (BKTree(), 0)
+        rows = db.query(DetectionHistory.id, DetectionHistory.image_phash).filter(
+            DetectionHistory.user_id == user_id,
+            DetectionHistory.id > last_id,
+            DetectionHistory.image_phash.isnot(None)
+        ).order_by(DetectionHistory.id).all()
+        for detection_id, value in rows:
+            tree.add(from_signed64(value), detection_id)
+            last_id = detection_id
+        self._trees[user_id] = (tree, last_id)
+        return tree
+
+    def find(self, db, user_id, image_hash, max_distance=None):
+        """[(distance, detection_id)] of earlier uploads within the threshold"""
+        limit = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            return self._sync(db, user_id).search(image_hash, limit)
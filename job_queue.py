@@ -0,0 +1,347 @@
+"""Persistent background queue for long-running batch analyses.
+
+Jobs live in the app database's `jobs` table (SQLite by default), so they
+survive browser reruns, disconnects and app restarts. The app only submits
+jobs and polls them. Separate worker processes claim jobs by priority and
+process them in batches. After every batch they commit progress and results
+atomically with the saved detections.
+
+- Claiming is a conditional UPDATE, so two workers never run the same job.
+- A failed job is retried with exponential backoff up to max_attempts.
+  Retries resume after the last committed batch.
+- A job whose worker stops heartbeating is requeued. Batch commits are
+  conditional on still owning the job, so the old worker can't save twice.
+- Cancellation is checked between batches.
+
+    python job_queue.py worker --processes 2
+    python job_queue.py list
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from PIL import Image
+from sqlalchemy import or_
+
+from metrics import record_error
+
+JOB_BATCH_SIZE = int(os.getenv('JOB_BATCH_SIZE', 16))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 2))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_DELAY_SECONDS = float(os.getenv('JOB_RETRY_DELAY_SECONDS', 10))
+# A running job whose heartbeat is older than this is assumed orphaned
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 300))
+# Batches larger than this default to running in the background
+JOB_INLINE_LIMIT = int(os.getenv('JOB_INLINE_LIMIT', 20))
+
+JOB_PRIORITIES = {'High': 10, 'Normal': 0, 'Low': -10}
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def submit_job(db, user_id, items, options=None, priority=0, max_attempts=JOB_MAX_ATTEMPTS):
+    """Queue a batch analysis of [{'name', 'sha256'}] blob-store images"""
+    from models import Job
+
+    job = Job(
+        user_id=user_id,
+        kind='batch',
+        status='queued',
+        priority=priority,
+        payload=json.dumps({'items': items, 'options': options or {}}),
+        progress_total=len(items),
+        max_attempts=max_attempts,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def list_user_jobs(db, user_id, limit=20):
+    from models import Job
+
+    return db.query(Job).filter(Job.user_id == user_id).order_by(Job.created_at.desc(), Job.id.desc()).limit(limit).all()
+
+
+def job_items(db, job):
+    """Per-item results recorded so far, in submission order"""
+    from models import JobItem
+
+    legacy = json.loads(job.result)['items'] if job.result else []
+    rows = db.query(JobItem.result).filter(JobItem.job_id == job.id).order_by(JobItem.position).all()
+    return legacy + [json.loads(result) for (result,) in rows]
+
+
+def cancel_job(db, job_id, user_id):
+    """Cancel a queued job now, or ask its worker to stop after the current batch"""
+    from models import Job
+
+    job = db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+    if job is None or job.status not in ACTIVE_STATUSES:
+        return False
+    if job.status == 'queued':
+        job.status = 'cancelled'
+        job.finished_at = datetime.utcnow()
+    job.cancel_requested = True
+    db.commit()
+    return True
+
+
+def retry_job(db, job_id, user_id):
+    """Requeue a failed or cancelled job; it resumes after its last finished batch"""
+    from models import Job
+
+    job = db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+    if job is None or job.status not in ('failed', 'cancelled'):
+        return False
+    job.status = 'queued'
+    job.cancel_requested = False
+    job.attempts = 0
+    job.error = None
+    job.run_after = None
+    job.finished_at = None
+    db.commit()
+    return True
+
+
+def _schedule_retry(job, error, now):
+    job.error = error
+    job.worker_id = None
+    if job.attempts < job.max_attempts:
+        job.status = 'queued'
+        job.run_after = now + timedelta(seconds=JOB_RETRY_DELAY_SECONDS * 2 ** max(job.attempts - 1, 0))
+    else:
+        job.status = 'failed'
+        job.finished_at = now
+
+
+def requeue_stale_jobs(db, stale_seconds=JOB_STALE_SECONDS):
+    """Retry (or fail) running jobs whose worker stopped heartbeating"""
+    from models import Job
+
+    now = datetime.utcnow()
+    stale = db.query(Job).filter(
+        Job.status == 'running',
+        Job.heartbeat_at < now - timedelta(seconds=stale_seconds)
+    ).all()
+    for job in stale:
+        _schedule_retry(job, f"Worker {job.worker_id} stopped responding", now)
+    if stale:
+        db.commit()
+    return len(stale)
+
+
+def claim_next_job(db, worker_id):
+    """Atomically move the best queued job to running; None if there is nothing to do"""
+    from models import Job
+
+    now = datetime.utcnow()
+    candidates = db.query(Job.id).filter(
+        Job.status == 'queued',
+        or_(Job.run_after.is_(None), Job.run_after <= now)
+    ).order_by(Job.priority.desc(), Job.created_at, Job.id).limit(5).all()
+    for (job_id,) in candidates:
+        claimed = db.query(Job).filter(Job.id == job_id, Job.status == 'queued').update({
+            Job.status: 'running',
+            Job.worker_id: worker_id,
+            Job.attempts: Job.attempts + 1,
+            Job.started_at: now,
+            Job.heartbeat_at: now,
+        }, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.get(Job, job_id)
+    return None
+
+
+def _still_owned(db, job, worker_id, **values):
+    """Heartbeat (and set values on) a job only if this worker still runs it.
+
+    False once the job was requeued as stale, cancelled or claimed by another
+    worker; the caller must then roll back instead of committing its batch.
+    """
+    from models import Job
+
+    values['heartbeat_at'] = datetime.utcnow()
+    return db.query(Job).filter(
+        Job.id == job.id, Job.worker_id == worker_id, Job.status == 'running'
+    ).update({getattr(Job, k): v for k, v in values.items()}, synchronize_session=False) == 1
+
+
+def _load_image(store, sha256):
+    image = Image.open(io.BytesIO(store.read(sha256)))
+    image.load()
+    image = image.convert('RGB') if image.mode != 'RGB' else image
+    if not os.path.exists(store.thumbnail_path(sha256)):
+        store.put_thumbnail(sha256, image)
+    return image
+
+
+def run_job(db, job, plant_model, store, batch_size=JOB_BATCH_SIZE):
+    """Process a claimed job from its last committed batch to the end.
+
+    Every batch commits only while this worker still owns the job, so a job
+    requeued as stale mid-batch is never saved twice.
+    """
+    from detection_utils import save_detections
+    from embedding_index import get_detection_index
+    from models import JobItem
+
+    worker_id = job.worker_id
+    payload = json.loads(job.payload)
+    items, options = payload['items'], payload['options']
+    # Jobs from before job_items kept their results in job.result
+    done = len(json.loads(job.result)['items']) if job.result else 0
+    done += db.query(JobItem).filter(JobItem.job_id == job.id).count()
+
+    for start in range(done, len(items), batch_size):
+        db.refresh(job)
+        if job.cancel_requested:
+            if _still_owned(db, job, worker_id, status='cancelled', finished_at=datetime.utcnow()):
+                db.commit()
+            else:
+                db.rollback()
+            return
+        if not _still_owned(db, job, worker_id):
+            db.rollback()
+            print(f"⚠️ Job {job.id} was taken over; stopping")
+            return
+        db.commit()
+
+        chunk = items[start:start + batch_size]
+        records = [{'name': item['name'], 'sha256': item['sha256']} for item in chunk]
+        images = {}
+        for i, item in enumerate(chunk):
+            try:
+                images[i] = _load_image(store, item['sha256'])
+            except Exception as e:
+                record_error("job_decode", e)
+                records[i]['error'] = str(e)
+
+        saved = []
+        if images:
+            order = list(images)
+            results = plant_model.predict_batch([images[i] for i in order], batch_size=batch_size,
+                                                tta=options.get('tta', 'off'))
+            for i, result in zip(order, results):
+                result['image_sha256'] = chunk[i]['sha256']
+                records[i].update(
+                    predicted_class=result['predicted_class'],
+                    confidence=result['confidence'],
+                    is_ood=result['is_ood'],
+                )
+                if not result['is_ood']:
+                    saved.append((i, result))
+            detection_ids = save_detections(
+                db, job.user_id, [(chunk[i]['name'], result) for i, result in saved], commit=False
+            ) if saved else []
+            for (i, _), detection_id in zip(saved, detection_ids):
+                records[i]['detection_id'] = detection_id
+
+        # Detections, item results and progress commit together, and only while
+        # this worker still owns the job, so a retry never double-saves
+        db.add_all(JobItem(job_id=job.id, position=start + i, result=json.dumps(record))
+                   for i, record in enumerate(records))
+        if not _still_owned(db, job, worker_id, progress_done=start + len(chunk)):
+            db.rollback()
+            print(f"⚠️ Job {job.id} was taken over during a batch; its results were discarded")
+            return
+        db.commit()
+
+        if saved:
+            try:
+                get_detection_index(version=plant_model.version).add(
+                    [result['embedding'] for _, result in saved], detection_ids, [job.user_id] * len(saved)
+                )
+            except ValueError as e:
+                record_error("embedding_index", e)
+
+    if _still_owned(db, job, worker_id, status='succeeded', error=None, finished_at=datetime.utcnow()):
+        db.commit()
+    else:
+        db.rollback()
+    db.refresh(job)
+
+
+def run_worker(worker_id=None, poll_seconds=JOB_POLL_SECONDS, once=False):
+    """Claim and run jobs until stopped (or until the queue is empty with once=True)"""
+    from blob_store import BlobStore
+    from database import SessionLocal, init_db
+    from model_registry import ModelManager
+    from models import Job
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    init_db()
+    manager = ModelManager()
+    store = BlobStore()
+    print(f"👷 Worker {worker_id} waiting for jobs")
+    while True:
+        db = SessionLocal()
+        try:
+            requeue_stale_jobs(db)
+            job = claim_next_job(db, worker_id)
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_seconds)
+                continue
+            print(f"▶️ Job {job.id} (attempt {job.attempts}/{job.max_attempts}, {job.progress_total} images)")
+            job_id = job.id
+            try:
+                run_job(db, job, manager.get(), store)
+                print(f"✅ Job {job_id} {job.status}")
+            except Exception as e:
+                record_error("job", e)
+                db.rollback()
+                job = db.get(Job, job_id)
+                if job.worker_id != worker_id or job.status != 'running':
+                    print(f"⚠️ Job {job_id} failed after it was taken over: {e}")
+                    continue
+                _schedule_retry(job, f"{type(e).__name__}: {e}", datetime.utcnow())
+                db.commit()
+                print(f"❌ Job {job_id} failed ({job.status}): {e}")
+        finally:
+            db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Background batch job queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_work = sub.add_parser("worker", help="run worker processes")
+    p_work.add_argument("--processes", type=int, default=1, help="worker processes (each loads the model)")
+    p_work.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    sub.add_parser("list", help="show recent jobs")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        if args.processes <= 1:
+            run_worker(once=args.once)
+            return
+        # spawn: each process initializes TensorFlow from scratch
+        ctx = multiprocessing.get_context("spawn")
+        processes = [ctx.Process(target=run_worker, kwargs={'once': args.once}) for _ in range(args.processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+    else:
+        from database import SessionLocal, init_db
+        from models import Job
+
+        init_db()
+        db = SessionLocal()
+        try:
+            for job in db.query(Job).order_by(Job.created_at.desc()).limit(20):
+                print(f"#{job.id:<5} {job.status:<10} p={job.priority:<4} {job.progress_done}/{job.progress_total} "
+                      f"user={job.user_id} attempts={job.attempts} {job.error or ''}")
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
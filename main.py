@@ -1,5 +1,246 @@
+"""Bulk classifier for folders of leaf images (drone / field-survey dumps).
+
+Walks a directory tree and classifies every image with PlantDiseaseModel.
+Decoding and resizing run on a thread pool (PIL releases the GIL) a few
+batches ahead of the batched forward passes. Results are appended to a
+JSONL or CSV file and fsynced after every batch. That file is the
+checkpoint: rerunning the same command skips every path already in it.
+
+    python main.py survey_2025/ --out survey_2025.jsonl
+    python main.py survey_2025/ --out survey_2025.csv --batch-size 64 --tta auto
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from archive_utils import iter_batches
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CSV_COLUMNS = [
+    'path', 'predicted_class', 'crop', 'disease', 'confidence',
+    'top2_class', 'top2_confidence', 'top3_class', 'top3_confidence',
+    'is_ood', 'model_version', 'error'
+]
+
+
+def find_images(root):
+    """Image paths under root, relative to it, in a stable order"""
+    paths = []
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.'):
+                paths.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return paths
+
+
+def _repair_tail(path):
+    """Drop a partially written last line left by an interrupted run"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def load_checkpoint(path, fmt):
+    """Paths already present in an existing results file"""
+    if not os.path.exists(path):
+        return set()
+    _repair_tail(path)
+    done = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            done.update(row['path'] for row in csv.DictReader(f))
+        else:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['path'])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+
+class ResultWriter:
+    """Append-only JSONL/CSV output, flushed to disk after each batch"""
+
+    def __init__(self, path, fmt):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.fmt = fmt
+        self.file = open(path, "a", newline='', encoding='utf-8')
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=CSV_COLUMNS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, records):
+        for record in records:
+            if self.fmt == 'csv':
+                self.writer.writerow(_flatten(record))
+            else:
+                self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def _flatten(record):
+    row = {col: record.get(col) for col in CSV_COLUMNS}
+    for i, pred in enumerate(record.get('top_3') or [], 1):
+        if i > 1:
+            row[f'top{i}_class'] = pred['class']
+            row[f'top{i}_confidence'] = pred['confidence']
+    return row
+
+
+def _record(path, result=None, labels=None, error=None):
+    if error is not None:
+        return {'path': path, 'error': error}
+    label = labels[result['class_index']]
+    return {
+        'path': path,
+        'predicted_class': result['predicted_class'],
+        'crop': label.crop,
+        'disease': label.disease,
+        'confidence': round(result['confidence'], 4),
+        'top_3': [{'class': p['class'], 'confidence': round(p['confidence'], 4)} for p in result['top_3_predictions']],
+        'is_ood': result['is_ood'],
+        'model_version': result.get('model_version'),
+        'error': None,
+    }
+
+
+def _decode(plant_model, path, keep_image):
+    """(preprocessed array, image or None) for one file; runs on the decode pool"""
+    with Image.open(path) as image:
+        # JPEGs decode straight to a reduced size (DCT scaling) when far larger than needed
+        image.draft('RGB', (plant_model.img_width * 2, plant_model.img_height * 2))
+        image = image.convert('RGB')
+    return plant_model.preprocess_image(image)[0], image if keep_image else None
+
+
+def iter_decoded(plant_model, root, paths, pool, prefetch, keep_image=False):
+    """Yield (path, array, image, error) in order, keeping `prefetch` decodes in flight"""
+    pending = deque()
+    remaining = iter(paths)
+
+    def submit(path):
+        pending.append((path, pool.submit(_decode, plant_model, os.path.join(root, path), keep_image)))
+
+    for path in remaining:
+        submit(path)
+        if len(pending) >= prefetch:
+            break
+    while pending:
+        path, future = pending.popleft()
+        next_path = next(remaining, None)
+        if next_path is not None:
+            submit(next_path)
+        try:
+            array, image = future.result()
+            yield path, array, image, None
+        except Exception as e:
+            yield path, None, None, str(e)
+
+
+def classify_tree(plant_model, root, out_path, fmt, batch_size=32, workers=None, tta='off', resume=True):
+    """Classify every image under root into out_path; returns a summary dict"""
+    paths = find_images(root)
+    done = load_checkpoint(out_path, fmt) if resume else set()
+    if not resume and os.path.exists(out_path):
+        os.remove(out_path)
+    todo = [p for p in paths if p not in done]
+    summary = {'found': len(paths), 'skipped': len(paths) - len(todo), 'processed': 0, 'failed': 0, 'ood': 0}
+    print(f"📂 {len(paths)} images found, {summary['skipped']} already done, {len(todo)} to classify")
+    if not todo:
+        return summary
+
+    workers = workers or os.cpu_count() or 4
+    writer = ResultWriter(out_path, fmt)
+    start = last_report = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") as pool:
+            decoded = iter_decoded(plant_model, root, todo, pool, prefetch=batch_size * 2, keep_image=tta != 'off')
+            for batch in iter_batches(decoded, batch_size):
+                good = [i for i, item in enumerate(batch) if item[3] is None]
+                records = [_record(path, error=error) if error else None for path, _, _, error in batch]
+                if good:
+                    results = plant_model.predict_batch(
+                        [batch[i][2] for i in good],
+                        batch_size=batch_size,
+                        tta=tta,
+                        processed=np.stack([batch[i][1] for i in good]),
+                    )
+                    for i, result in zip(good, results):
+                        records[i] = _record(batch[i][0], result, plant_model.labels)
+                        summary['ood'] += int(result['is_ood'])
+                writer.write(records)
+                summary['processed'] += len(good)
+                summary['failed'] += len(batch) - len(good)
+
+                now = time.perf_counter()
+                if now - last_report >= 5:
+                    total = summary['processed'] + summary['failed']
+                    print(f"  {total}/{len(todo)} · {total / (now - start):.1f} images/sec")
+                    last_report = now
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    summary['seconds'] = round(elapsed, 2)
+    summary['images_per_sec'] = round((summary['processed'] + summary['failed']) / max(elapsed, 1e-9), 2)
+    return summary
+
+
+def load_plant_model(version=None):
+    """A registry version, else the active one, else the bare model file"""
+    from model_registry import ModelManager, load_version
+
+    if version:
+        return load_version(version)
+    return ModelManager(poll_seconds=float('inf')).get()
+
+
 def main():
-    print("Hello from repl-nix-workspace!")
+    parser = argparse.ArgumentParser(description="Classify a directory tree of leaf images")
+    parser.add_argument("root", help="folder to scan recursively")
+    parser.add_argument("--out", default="results.jsonl", help="results file (.jsonl or .csv)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="default: from the --out extension")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, help="decode threads (default: all cores)")
+    parser.add_argument("--tta", choices=["off", "auto", "always"], default="off")
+    parser.add_argument("--model-version", help="registry version to use instead of the active one")
+    parser.add_argument("--tf-threads", type=int, help="TensorFlow intra-op threads (default: TF decides)")
+    parser.add_argument("--no-resume", action="store_true", help="start over instead of skipping done files")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        raise SystemExit(f"❌ Not a directory: {args.root}")
+    fmt = args.format or ('csv' if args.out.lower().endswith('.csv') else 'jsonl')
+
+    if args.tf_threads:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(args.tf_threads)
+
+    plant_model = load_plant_model(args.model_version)
+    if plant_model.model is None:
+        raise SystemExit("❌ A trained model is required.")
+
+    summary = classify_tree(plant_model, args.root, args.out, fmt, args.batch_size, args.workers,
+                            args.tta, resume=not args.no_resume)
+    if 'seconds' in summary:
+        print(
+            f"✅ {summary['processed']} classified ({summary['ood']} out-of-distribution), "
+            f"{summary['failed']} failed in {summary['seconds']}s · {summary['images_per_sec']} images/sec -> {args.out}"
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""Schema and data migrations for existing databases.
+
+create_all() only creates missing tables, so columns added to a model later
+are applied here: each missing (nullable) column is added with ALTER TABLE
+and any missing indexes are created. One-off data migrations listed in
+DATA_MIGRATIONS then run once each, tracked in the schema_migrations table.
+Runs on every startup from init_db().
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, bindparam, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from database import Base
+
+MIGRATION_BATCH_SIZE = 1000
+
+_tracking = Table(
+    'schema_migrations', MetaData(),
+    Column('name', String(100), primary_key=True),
+    Column('applied_at', DateTime),
+)
+
+
+def add_missing_columns(engine, metadata=Base.metadata):
+    """Bring existing tables up to the model definitions; returns the columns added"""
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(
+                        f"❌ Cannot add NOT NULL column {table.name}.{column.name} without a server default"
+                    )
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"
+                ))
+                added.append(f"{table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    for name in added:
+        print(f"🛠️ Added column {name}")
+    return added
+
+
+def pack_legacy_top3(conn):
+    """Move top-3 JSON into float16 probability blobs; classes outside the top 3 get 0.
+
+    Rows naming a class the current class list doesn't know keep their JSON.
+    Returns the number of rows converted, or None to retry on a later start.
+    """
+    from detection_utils import encode_probabilities
+    from model_registry import class_names_for_version
+    from models import DetectionHistory
+
+    table = DetectionHistory.__table__
+    stmt = (
+        table.update()
+        .where(table.c.id == bindparam('row_id'))
+        .values(probabilities=bindparam('blob'), top_3_predictions=None)
+    )
+    positions = {}
+    converted = 0
+    last_id = 0
+    while True:
+        # Keyset batches by id: the whole legacy history is never loaded at once
+        rows = conn.execute(
+            select(table.c.id, table.c.model_version, table.c.top_3_predictions)
+            .where(table.c.id > last_id, table.c.probabilities.is_(None), table.c.top_3_predictions.isnot(None))
+            .order_by(table.c.id)
+            .limit(MIGRATION_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return converted
+        last_id = rows[-1].id
+
+        updates = []
+        for detection_id, version, top_3_json in rows:
+            if version not in positions:
+                try:
+                    positions[version] = {name: i for i, name in enumerate(class_names_for_version(version))}
+                except FileNotFoundError:
+                    return None  # no class list yet (fresh checkout); try again next start
+            index = positions[version]
+            try:
+                top_3 = json.loads(top_3_json)
+            except (ValueError, TypeError):
+                continue
+            if not top_3 or any(pred.get('class') not in index for pred in top_3):
+                continue
+            probs = [0.0] * len(index)
+            for pred in top_3:
+                probs[index[pred['class']]] = pred['confidence']
+            updates.append({'row_id': detection_id, 'blob': encode_probabilities(probs)})
+        if updates:
+            conn.execute(stmt, updates)
+            converted += len(updates)
+
+
+# External-content FTS5 index over detection notes and image names (see search.py)
+DETECTION_FTS_TABLE = 'detection_fts'
+DETECTION_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {DETECTION_FTS_TABLE} USING fts5(
+        notes, image_name,
+        content='detection_history', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {DETECTION_FTS_TABLE}_ai AFTER INSERT ON detection_history BEGIN
+        INSERT INTO {DETECTION_FTS_TABLE}(rowid, notes, image_name) VALUES (new.id, new.notes, new.image_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {DETECTION_FTS_TABLE}_ad AFTER DELETE ON detection_history BEGIN
+        INSERT INTO {DETECTION_FTS_TABLE}({DETECTION_FTS_TABLE}, rowid, notes, image_name)
+        VALUES ('delete', old.id, old.notes, old.image_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {DETECTION_FTS_TABLE}_au AFTER UPDATE OF notes, image_name ON detection_history BEGIN
+        INSERT INTO {DETECTION_FTS_TABLE}({DETECTION_FTS_TABLE}, rowid, notes, image_name)
+        VALUES ('delete', old.id, old.notes, old.image_name);
+        INSERT INTO {DETECTION_FTS_TABLE}(rowid, notes, image_name) VALUES (new.id, new.notes, new.image_name);
+    END""",
+]
+
+
+def create_detection_fts(conn):
+    """Create the FTS5 search index and its sync triggers, then index existing rows.
+
+    SQLite only; other backends (and SQLite builds without FTS5) search with LIKE.
+    """
+    if conn.dialect.name != 'sqlite':
+        return 0
+    try:
+        for statement in DETECTION_FTS_DDL:
+            conn.execute(text(statement))
+    except OperationalError as e:
+        print(f"⚠️ SQLite FTS5 unavailable, history search falls back to LIKE: {e}")
+        return None
+    conn.execute(text(f"INSERT INTO {DETECTION_FTS_TABLE}({DETECTION_FTS_TABLE}) VALUES ('rebuild')"))
+    return conn.execute(text("SELECT count(*) FROM detection_history")).scalar()
+
+
+DATA_MIGRATIONS = [
+    ('0001_pack_legacy_top3', pack_legacy_top3),
+    ('0002_detection_fts', create_detection_fts),
+]
+
+
+def run_data_migrations(engine):
+    """Apply each pending DATA_MIGRATIONS entry in its own transaction"""
+    _tracking.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        applied = set(conn.execute(select(_tracking.c.name)).scalars())
+    for name, migrate in DATA_MIGRATIONS:
+        if name in applied:
+            continue
+        with engine.begin() as conn:
+            count = migrate(conn)
+            if count is None:
+                continue
+            conn.execute(_tracking.insert().values(name=name, applied_at=datetime.utcnow()))
+        print(f"🛠️ Data migration {name}: {count} row(s)")
+
+
+def run_migrations(engine):
+    added = add_missing_columns(engine)
+    run_data_migrations(engine)
+    return added
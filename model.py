@@ -5,11 +5,33 @@ from tensorflow.keras.applications import MobileNetV2
 import numpy as np
 import os
 import json
+from disease_info import build_label_table
+from metrics import stage_timer, BATCH_SIZE, PREDICTIONS, METRICS_ENABLED
+from profiling import maybe_profile, tf_trace
+from PIL import Image
+from ood import OODGate, OOD_ENABLED, OOD_CALIBRATION_PATH
+from image_hash import phash
+from tiling import multiscale_tiles, merge_tile_predictions, disease_heatmap, TILE_SCALES, TILE_OVERLAP
+from hierarchical import CropHierarchy, crop_indices, extend_class_names, restrict_to_crop, HIERARCHY_DIR, PREDICT_MODE
+
+# Test-time augmentation: "off", "auto" (only below TTA_THRESHOLD) or "always".
+# Off unless a caller opts in, so plain predict() keeps single-pass cost and outputs.
+TTA_MODE = os.getenv('TTA_MODE', 'off')
+# Same cutoff as the app's low-confidence warning: exactly the results it would flag get re-checked
+TTA_THRESHOLD = float(os.getenv('TTA_THRESHOLD', 0.3))
+TTA_ROTATIONS = (-12, 12)
+TTA_CROP_SCALE = 256 / 224  # views are cropped from a slightly larger resize
 
 
 class PlantDiseaseModel:
-    def __init__(self, model_path="plant_disease_model.h5", class_names_path="class_names_from_training.json"):
+    def __init__(self, model_path="plant_disease_model.h5", class_names_path="class_names_from_training.json",
+                 ood_calibration_path=OOD_CALIBRATION_PATH, version=None, hierarchy_dir=HIERARCHY_DIR):
         self.model = None
+        # Registry version this model was loaded from (None for a bare .h5 file)
+        self.version = version
+        self._feature_model = None
+        self._feature_model_source = None  # self.model the feature model was built from
+        self._classifier_weights = None
         self.model_path = model_path
         self.class_names_path = class_names_path
         self.img_height = 224
@@ -26,13 +48,24 @@ class PlantDiseaseModel:
             )
 
         self.num_classes = len(self.class_names)
+        # Index -> LabelInfo (crop, display name, disease info, healthy flag)
+        self.labels = build_label_table(self.class_names)
+        self.tta_mode = TTA_MODE
+        self.tta_threshold = TTA_THRESHOLD
+        # Out-of-distribution gate; None until `python ood.py calibrate` has been run
+        self.ood_gate = OODGate.load(ood_calibration_path) if OOD_ENABLED else None
+        # Crop and per-crop disease heads; None until `python hierarchical.py train` has been run
+        self.hierarchy_dir = hierarchy_dir
+        self.hierarchy = None
+        self.predict_mode = PREDICT_MODE
 
-    def build_model(self):
+    def build_model(self, weights='imagenet'):
         """Build CNN model using transfer learning with MobileNetV2"""
+        # weights=None gives a randomly initialized backbone (offline benchmarks)
         base_model = MobileNetV2(
             input_shape=(self.img_height, self.img_width, 3),
             include_top=False,
-            weights='imagenet'
+            weights=weights
         )
         base_model.trainable = False
 
@@ -64,14 +97,96 @@ class PlantDiseaseModel:
         if os.path.exists(self.model_path):
             self.model = keras.models.load_model(self.model_path)
             print(f"✅ Loaded model from {self.model_path}")
+            self.load_hierarchy()
             return True
         print("⚠️ Model file not found. You need to train it first.")
         return False
 
+    def load_hierarchy(self):
+        """Load the crop heads trained for this model file, if any"""
+        if self.hierarchy_dir is None:
+            return
+        self.hierarchy = CropHierarchy.load(self.model_path, self.hierarchy_dir)
+        if self.hierarchy is not None:
+            # Heads can add classes (e.g. a new crop) after the flat model's own; stored
+            # probability vectors are decoded with the same list (class_names_for_version)
+            self.class_names = extend_class_names(self.class_names, self.hierarchy_dir)
+            self.num_classes = len(self.class_names)
+            self.labels = build_label_table(self.class_names)
+
+    @property
+    def crops(self):
+        """Crops a prediction can be restricted to"""
+        if self.hierarchy is not None:
+            return self.hierarchy.crops
+        return sorted(crop_indices(self.class_names))
+
+    def _route(self, probs, embeddings, crop=None):
+        """Softmax over self.class_names: from the crop heads, or the flat model's limited to `crop`"""
+        use_heads = self.hierarchy is not None and (crop is not None or self.predict_mode == 'hierarchical')
+        if use_heads:
+            probs = self.hierarchy.predict(embeddings, crop)
+        if probs.shape[1] < self.num_classes:
+            probs = np.pad(probs, ((0, 0), (0, self.num_classes - probs.shape[1])))
+        if use_heads or crop is None:
+            return probs
+        groups = crop_indices(self.class_names)
+        for name, indices in groups.items():
+            if name.lower() == crop.lower():
+                return restrict_to_crop(probs, indices)
+        raise ValueError(f"❌ Unknown crop '{crop}'. Known crops: {', '.join(sorted(groups))}")
+
     def initialize_model(self):
         """Alias for backward compatibility with older app.py"""
         self.load_model()
 
+    def warmup(self):
+        """Trace the forward pass on a blank batch so the first real request isn't slow"""
+        if self.model is None and not self.load_model():
+            raise ValueError("❌ Model not loaded. Train or load the model first.")
+        self._forward(np.zeros((1, self.img_height, self.img_width, 3), dtype=np.float32))
+
+    def embedding_layer(self):
+        """Penultimate feature layer: last Dense before the classifier, else the pooling layer"""
+        for layer in reversed(self.model.layers[:-1]):
+            if isinstance(layer, (layers.Dense, layers.GlobalAveragePooling2D)):
+                return layer
+        return self.model.layers[-2]
+
+    def _get_feature_model(self):
+        """Model with [embedding, classifier input, softmax] outputs sharing one forward pass"""
+        if self._feature_model is None or self._feature_model_source is not self.model:
+            classifier = self.model.layers[-1]
+            self._feature_model = keras.Model(
+                self.model.inputs,
+                [self.embedding_layer().output, classifier.input, self.model.output]
+            )
+            # Logits are recomputed from the softmax layer's weights (a tiny matmul)
+            self._classifier_weights = (
+                classifier.get_weights() if isinstance(classifier, layers.Dense) else None
+            )
+            self._feature_model_source = self.model
+        return self._feature_model
+
+    def _forward(self, batch, batch_size=32):
+        """Softmax outputs, penultimate-layer embeddings and logits for a preprocessed batch"""
+        embeddings, classifier_inputs, probs = self._get_feature_model().predict(
+            batch, batch_size=batch_size, verbose=0
+        )
+        if self._classifier_weights is not None:
+            kernel, bias = self._classifier_weights[:2]
+            logits = classifier_inputs @ kernel + bias
+        else:
+            logits = np.log(np.maximum(probs, 1e-12))
+        return probs, embeddings, logits
+
+    def forward_images(self, images, batch_size=32):
+        """(probs, embeddings, logits) for a list of images, without post-processing"""
+        if self.model is None:
+            if not self.load_model():
+                raise ValueError("❌ Model not loaded. Train or load the model first.")
+        return self._forward(self.preprocess_batch(images), batch_size)
+
     def preprocess_image(self, image):
         """Preprocess image for model input"""
         image = image.resize((self.img_width, self.img_height))
@@ -85,31 +200,181 @@ class PlantDiseaseModel:
 
         return image_array
 
-    def predict(self, image):
+    def preprocess_batch(self, images):
+        """Preprocess a list of images into one (N, H, W, 3) batch"""
+        return np.concatenate([self.preprocess_image(img) for img in images], axis=0)
+
+    def build_tta_views(self, image):
+        """Stack augmented views of one image into a (K, H, W, 3) array.
+
+        Views: full image, its horizontal flip, center crop, four corner crops
+        and two small rotations.
+        """
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        h, w = self.img_height, self.img_width
+        full = image.resize((w, h))
+        large = np.asarray(image.resize((round(w * TTA_CROP_SCALE), round(h * TTA_CROP_SCALE))))
+        full_arr = np.asarray(full)
+
+        dy, dx = large.shape[0] - h, large.shape[1] - w
+        cy, cx = dy // 2, dx // 2
+        views = [
+            full_arr,
+            full_arr[:, ::-1],
+            large[cy:cy + h, cx:cx + w],
+            large[:h, :w],
+            large[:h, dx:],
+            large[dy:, :w],
+            large[dy:, dx:],
+        ]
+        views.extend(np.asarray(full.rotate(angle, resample=Image.BILINEAR)) for angle in TTA_ROTATIONS)
+
+        return np.stack(views).astype(np.float32) / 255.0
+
+    def predict(self, image, tta=None, processed=None, image_hash=None, crop=None):
         """Predict disease from image"""
+        return self.predict_batch([image], tta=tta, processed=processed,
+                                  image_hashes=None if image_hash is None else [image_hash], crop=crop)[0]
+
+    def predict_batch(self, images, batch_size=32, tta=None, processed=None, image_hashes=None, crop=None):
+        """Predict diseases for several images with batched forward passes.
+
+        tta: "off", "auto" or "always" (True/False also accepted); defaults to
+        self.tta_mode. In "auto" mode only results below self.tta_threshold
+        are re-scored with test-time augmentation.
+        processed: the preprocess_batch() output if the caller already has it
+        (the caller then owns the "preprocess" stage timing).
+        image_hashes: phash() of each processed image, if already computed.
+        crop: the crop in the photos, if known; only that crop's diseases are
+        scored and the crop stage is skipped.
+        """
+        if self.model is None:
+            if not self.load_model():
+                raise ValueError("❌ Model not loaded. Train or load the model first.")
+
+        tta = self.tta_mode if tta is None else tta
+        if isinstance(tta, bool):
+            tta = 'always' if tta else 'off'
+
+        with maybe_profile("predict"):
+            if processed is None:
+                with stage_timer("preprocess"):
+                    processed_images = self.preprocess_batch(images)
+            else:
+                processed_images = processed
+            BATCH_SIZE.observe(len(processed_images))
+            with stage_timer("forward"), tf_trace():
+                predictions, embeddings, logits = self._forward(processed_images, batch_size)
+
+            if self.ood_gate is not None:
+                ood_scores, is_ood = self.ood_gate.score(logits, predictions, embeddings)
+            predictions = self._route(predictions, embeddings, crop)
+
+            first_pass = predictions.max(axis=1)
+            if tta == 'always':
+                refine = list(range(len(images)))
+            elif tta == 'auto':
+                refine = [int(i) for i in np.flatnonzero(first_pass < self.tta_threshold)]
+            else:
+                refine = []
+            if refine and self.ood_gate is not None:
+                refine = [i for i in refine if not is_ood[i]]  # no point refining rejected inputs
+            if refine:
+                with stage_timer("tta"):
+                    predictions[refine] = self._tta_predictions([images[i] for i in refine], batch_size, crop)
+
+            with stage_timer("postprocess"):
+                results = [self._format_prediction(row) for row in predictions]
+                for i, (result, embedding) in enumerate(zip(results, embeddings)):
+                    result['embedding'] = embedding
+                    result['image_hash'] = image_hashes[i] if image_hashes is not None else phash(processed_images[i])
+                    result['model_version'] = self.version
+                    result['is_ood'] = False
+                if self.ood_gate is not None:
+                    for result, score, rejected in zip(results, ood_scores, is_ood):
+                        result['ood_score'] = float(score)
+                        result['is_ood'] = bool(rejected)
+            for i in refine:
+                results[i]['tta'] = True
+                results[i]['first_pass_confidence'] = float(first_pass[i])
+        if METRICS_ENABLED:
+            for result in results:
+                PREDICTIONS.inc(predicted_class=result['predicted_class'])
+        return results
+
+    def predict_tiled(self, image, scales=None, overlap=None, batch_size=32, crop=None):
+        """High-resolution prediction from overlapping tiles at several scales.
+
+        Adds 'heatmap' (coarse per-cell disease probability over the photo)
+        and 'tile_count' to the usual result dict.
+        """
         if self.model is None:
             if not self.load_model():
                 raise ValueError("❌ Model not loaded. Train or load the model first.")
 
-        processed_image = self.preprocess_image(image)
-        predictions = self.model.predict(processed_image, verbose=0)
+        with maybe_profile("predict_tiled"):
+            with stage_timer("tiling"):
+                base, tiles, boxes = multiscale_tiles(
+                    image, scales or TILE_SCALES, TILE_OVERLAP if overlap is None else overlap, self.img_height
+                )
+                batch = tiles.astype(np.float32) / 255.0
+            BATCH_SIZE.observe(len(batch))
+            with stage_timer("forward"), tf_trace():
+                probs, embeddings, logits = self._forward(batch, batch_size)
+
+            # Background tiles (soil, sky, pots) are left out when the OOD gate is calibrated
+            keep = np.ones(len(probs), dtype=bool)
+            if self.ood_gate is not None:
+                ood_scores, is_ood = self.ood_gate.score(logits, probs, embeddings)
+                keep = ~is_ood
+            probs = self._route(probs, embeddings, crop)
+
+            with stage_timer("postprocess"):
+                healthy = np.array([label.is_healthy for label in self.labels])
+                merged, disease_prob = merge_tile_predictions(probs, healthy, keep)
+                result = self._format_prediction(merged)
+                result['embedding'] = embeddings[keep].mean(axis=0) if keep.any() else embeddings.mean(axis=0)
+                result['image_hash'] = phash(self.preprocess_image(base))
+                result['model_version'] = self.version
+                result['is_ood'] = not keep.any()
+                if self.ood_gate is not None:
+                    result['ood_score'] = float(ood_scores.max())
+                result['heatmap'] = disease_heatmap(disease_prob, boxes, base.size)
+                result['tile_count'] = len(tiles)
+        if METRICS_ENABLED:
+            PREDICTIONS.inc(predicted_class=result['predicted_class'])
+        return result
+
+    def _tta_predictions(self, images, batch_size=32, crop=None):
+        """Mean softmax over all augmented views, one forward call for every image"""
+        views = np.concatenate([self.build_tta_views(img) for img in images], axis=0)
+        with tf_trace():
+            probs, embeddings, _ = self._forward(views, batch_size)
+        probs = self._route(probs, embeddings, crop)
+        return probs.reshape(len(images), -1, probs.shape[-1]).mean(axis=1)
 
-        predicted_class_idx = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_idx])
+    def _format_prediction(self, probs):
+        """Build the result dict for one softmax vector"""
+        predicted_class_idx = np.argmax(probs)
+        confidence = float(probs[predicted_class_idx])
         predicted_class = self.class_names[predicted_class_idx]
 
-        top_3_indices = np.argsort(predictions[0])[-3:][::-1]
+        top_3_indices = np.argsort(probs)[-3:][::-1]
         top_3_predictions = [
             {
                 'class': self.class_names[idx],
-                'confidence': float(predictions[0][idx])
+                'index': int(idx),
+                'confidence': float(probs[idx])
             }
             for idx in top_3_indices
         ]
 
         return {
             'predicted_class': predicted_class,
+            'class_index': int(predicted_class_idx),
             'confidence': confidence,
             'top_3_predictions': top_3_predictions,
-            'all_predictions': predictions[0].tolist()
+            'all_predictions': probs.tolist(),
+            'tta': False
         }
@@ -0,0 +1,297 @@
+"""Local registry of versioned model bundles with an atomic active pointer.
+
+    model_registry/
+        ACTIVE                  name of the version being served
+        versions/v3/
+            model.h5
+            class_names.json
+            extra_classes.json     classes crop heads had added when published
+            ood_calibration.json   (optional)
+            meta.json
+
+Publishing copies files into a staging folder and renames it into place;
+activating rewrites ACTIVE via os.replace. Running apps notice the new
+pointer, load and warm up the new version in a background thread, then swap
+it in. Requests already holding the old model finish on it.
+
+    python model_registry.py publish --model plant_disease_model.h5 --activate
+    python model_registry.py activate v2
+    python model_registry.py list
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+from disease_info import CLASS_NAMES_PATH
+from hierarchical import EXTRA_CLASSES_FILE, HIERARCHY_DIR, extend_class_names
+from metrics import record_error
+
+REGISTRY_DIR = os.getenv('MODEL_REGISTRY_DIR', 'model_registry')
+# How often a running app checks the ACTIVE pointer
+REGISTRY_POLL_SECONDS = float(os.getenv('MODEL_REGISTRY_POLL_SECONDS', 10))
+
+BUNDLE_CLASS_NAMES = "class_names.json"
+BUNDLE_EXTRA_CLASSES = EXTRA_CLASSES_FILE
+BUNDLE_OOD_CALIBRATION = "ood_calibration.json"
+BUNDLE_META = "meta.json"
+
+
+def _versions_dir(registry_dir):
+    return os.path.join(registry_dir, "versions")
+
+
+def version_dir(version, registry_dir=REGISTRY_DIR):
+    return os.path.join(_versions_dir(registry_dir), version)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_meta(version, registry_dir=REGISTRY_DIR):
+    with open(os.path.join(version_dir(version, registry_dir), BUNDLE_META)) as f:
+        return json.load(f)
+
+
+def list_versions(registry_dir=REGISTRY_DIR):
+    """Metadata of every published version, oldest first"""
+    root = _versions_dir(registry_dir)
+    if not os.path.isdir(root):
+        return []
+    metas = [
+        read_meta(name, registry_dir) for name in os.listdir(root)
+        if not name.startswith('.') and os.path.exists(os.path.join(root, name, BUNDLE_META))
+    ]
+    return sorted(metas, key=lambda m: (m['created_at'], m['version']))
+
+
+def _next_version(registry_dir):
+    numbers = [int(m['version'][1:]) for m in list_versions(registry_dir)
+               if m['version'][:1] == 'v' and m['version'][1:].isdigit()]
+    return f"v{max(numbers, default=0) + 1}"
+
+
+def publish(model_path, class_names_path="class_names_from_training.json", ood_calibration_path=None,
+            version=None, notes=None, activate=False, registry_dir=REGISTRY_DIR):
+    """Copy a trained model into a new immutable version; returns its metadata"""
+    version = version or _next_version(registry_dir)
+    if any(sep in version for sep in ('/', '\\')) or version.startswith('.'):
+        raise ValueError(f"❌ Invalid version name '{version}'")
+    final_dir = version_dir(version, registry_dir)
+    if os.path.exists(final_dir):
+        raise FileExistsError(f"❌ Version {version} already exists")
+
+    staging = os.path.join(_versions_dir(registry_dir), f".staging-{version}-{os.getpid()}")
+    os.makedirs(staging)
+    try:
+        model_file = "model" + os.path.splitext(model_path)[1]
+        shutil.copy2(model_path, os.path.join(staging, model_file))
+        shutil.copy2(class_names_path, os.path.join(staging, BUNDLE_CLASS_NAMES))
+        # Snapshot so the version's stored probabilities decode even without this hierarchy dir
+        with open(os.path.join(staging, BUNDLE_EXTRA_CLASSES), "w") as f:
+            json.dump(extend_class_names([]), f, indent=2)
+        if ood_calibration_path and os.path.exists(ood_calibration_path):
+            shutil.copy2(ood_calibration_path, os.path.join(staging, BUNDLE_OOD_CALIBRATION))
+        meta = {
+            'version': version,
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'model_file': model_file,
+            'source': os.path.abspath(model_path),
+            'sha256': _file_sha256(model_path),
+            'notes': notes,
+        }
+        with open(os.path.join(staging, BUNDLE_META), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.rename(staging, final_dir)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if activate:
+        activate_version(version, registry_dir)
+    return meta
+
+
+def active_version(registry_dir=REGISTRY_DIR):
+    """Name of the active version, or None if nothing has been activated"""
+    try:
+        with open(os.path.join(registry_dir, "ACTIVE")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def activate_version(version, registry_dir=REGISTRY_DIR):
+    """Atomically point ACTIVE at a published version"""
+    if not os.path.exists(os.path.join(version_dir(version, registry_dir), BUNDLE_META)):
+        raise FileNotFoundError(f"❌ Unknown model version '{version}'")
+    tmp_path = os.path.join(registry_dir, f".ACTIVE.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(registry_dir, "ACTIVE"))
+
+
+def class_names_for_version(version, registry_dir=REGISTRY_DIR):
+    """Class names in prediction order for a version (None: the unversioned class-names file)"""
+    # Heads retrained after publishing can append classes, so re-read when the extras file changes
+    try:
+        extras_mtime = os.stat(os.path.join(HIERARCHY_DIR, EXTRA_CLASSES_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        extras_mtime = None
+    return _class_names_for_version(version, registry_dir, extras_mtime)
+
+
+@lru_cache(maxsize=None)
+def _class_names_for_version(version, registry_dir, extras_mtime):
+    path = CLASS_NAMES_PATH
+    bundle_extras = []
+    if version is not None:
+        bundle = version_dir(version, registry_dir)
+        if os.path.exists(os.path.join(bundle, BUNDLE_CLASS_NAMES)):
+            path = os.path.join(bundle, BUNDLE_CLASS_NAMES)
+        # Older bundles predate the snapshot
+        bundle_extras = extend_class_names([], bundle)
+    with open(path) as f:
+        class_names = json.load(f)
+    # Plus classes added by crop heads, which predictions may have scored; both lists
+    # are append-only in the same order, so indices agree
+    return tuple(extend_class_names(class_names + [c for c in bundle_extras if c not in class_names]))
+
+
+def load_version(version, registry_dir=REGISTRY_DIR):
+    """PlantDiseaseModel for a registry version, loaded and warmed up"""
+    from model import PlantDiseaseModel
+
+    bundle = version_dir(version, registry_dir)
+    meta = read_meta(version, registry_dir)
+    plant_model = PlantDiseaseModel(
+        model_path=os.path.join(bundle, meta['model_file']),
+        class_names_path=os.path.join(bundle, BUNDLE_CLASS_NAMES),
+        ood_calibration_path=os.path.join(bundle, BUNDLE_OOD_CALIBRATION),
+        version=version,
+    )
+    if not plant_model.load_model():
+        raise FileNotFoundError(f"❌ Model file missing for version {version}")
+    plant_model.warmup()
+    return plant_model
+
+
+class ModelManager:
+    """Serves the active registry version and hot-swaps when ACTIVE changes.
+
+    Falls back to the bare plant_disease_model.h5 while the registry is empty.
+    """
+
+    def __init__(self, registry_dir=REGISTRY_DIR, poll_seconds=REGISTRY_POLL_SECONDS):
+        self.registry_dir = registry_dir
+        self.poll_seconds = poll_seconds
+        self._current = None
+        self._loading = None
+        self._failed = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self, version):
+        if version is None:
+            from model import PlantDiseaseModel
+            plant_model = PlantDiseaseModel()
+            plant_model.initialize_model()
+            if plant_model.model is not None:
+                plant_model.warmup()
+            return plant_model
+        return load_version(version, self.registry_dir)
+
+    def get(self):
+        """Model to use for this request (keep the reference for the whole request)"""
+        if self._current is None:
+            with self._lock:
+                if self._current is None:
+                    self._current = self._load(active_version(self.registry_dir))
+                    self._last_check = time.monotonic()
+        self._maybe_reload()
+        return self._current
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.poll_seconds:
+            return
+        self._last_check = now
+        version = active_version(self.registry_dir)
+        if version is None or version == self._current.version or version == self._failed:
+            return
+        with self._lock:
+            if self._loading is not None:
+                return
+            self._loading = version
+        threading.Thread(target=self._swap_to, args=(version,), name=f"model-load-{version}", daemon=True).start()
+
+    def _swap_to(self, version):
+        try:
+            plant_model = self._load(version)
+            # A single reference assignment: new requests see either model, never a half-loaded one
+            self._current = plant_model
+            print(f"🔄 Now serving model version {version}")
+        except Exception as e:
+            record_error("model_reload", e)
+            self._failed = version
+            print(f"❌ Failed to load model version {version}: {e}")
+        finally:
+            self._loading = None
+
+    def status(self):
+        return {
+            'version': self._current.version if self._current is not None else None,
+            'loading': self._loading,
+            'failed': self._failed,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model registry tools")
+    parser.add_argument("--registry", default=REGISTRY_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_pub = sub.add_parser("publish", help="add a trained model as a new version")
+    p_pub.add_argument("--model", default="plant_disease_model.h5")
+    p_pub.add_argument("--classes", default="class_names_from_training.json")
+    p_pub.add_argument("--ood", default="ood_calibration.json", help="OOD calibration to bundle, if present")
+    p_pub.add_argument("--version", help="version name (default: next vN)")
+    p_pub.add_argument("--notes")
+    p_pub.add_argument("--activate", action="store_true", help="serve this version right away")
+
+    p_act = sub.add_parser("activate", help="serve a published version")
+    p_act.add_argument("version")
+
+    sub.add_parser("list", help="list published versions")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        meta = publish(args.model, args.classes, args.ood, args.version, args.notes, args.activate, args.registry)
+        print(f"✅ Published {meta['version']} ({meta['sha256'][:12]}){' and activated it' if args.activate else ''}")
+    elif args.command == "activate":
+        activate_version(args.version, args.registry)
+        print(f"✅ Active model version: {args.version}")
+    else:
+        active = active_version(args.registry)
+        versions = list_versions(args.registry)
+        if not versions:
+            print(f"⚠️ No versions published in {args.registry}")
+        for meta in versions:
+            marker = "*" if meta['version'] == active else " "
+            print(f"{marker} {meta['version']:<12} {meta['created_at']}  {meta['sha256'][:12]}  {meta.get('notes') or ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Text, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, Text, ForeignKey, Boolean, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -28,5 +28,53 @@ class DetectionHistory(Base):
     top_3_predictions = Column(Text)
     detection_date = Column(DateTime, default=datetime.utcnow, index=True)
     notes = Column(Text)
+    image_phash = Column(BigInteger)  # 64-bit perceptual hash, stored signed
+    model_version = Column(String(64), index=True)  # registry version that produced the prediction
+    probabilities = Column(LargeBinary)  # full softmax as float16, in that version's class order
+    image_sha256 = Column(String(64), index=True)  # uploaded photo in the blob store
     
     user = relationship("User", back_populates="detections")
+
+    __table_args__ = (
+        # Newest-first history pages
+        Index('ix_detection_history_user_date', 'user_id', 'detection_date'),
+        # Covers the search facet GROUP BY and its range filters (see search.py)
+        Index('ix_detection_history_user_facets', 'user_id', 'crop_type', 'disease_name', 'confidence', 'detection_date'),
+    )
+
+class Job(Base):
+    """A background batch analysis, run by job_queue.py worker processes"""
+    __tablename__ = 'jobs'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    kind = Column(String(30), nullable=False, default='batch')
+    status = Column(String(20), nullable=False, default='queued', index=True)  # queued, running, succeeded, failed, cancelled
+    priority = Column(Integer, nullable=False, default=0)  # higher runs first
+    payload = Column(Text, nullable=False)  # JSON: items to analyze and options
+    result = Column(Text)  # JSON per-item results of jobs from before job_items; new jobs use JobItem
+    error = Column(Text)
+    progress_done = Column(Integer, nullable=False, default=0)
+    progress_total = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    worker_id = Column(String(100))
+    run_after = Column(DateTime)  # retry backoff
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+class JobItem(Base):
+    """Result of one image in a batch job, written with the batch that produced it"""
+    __tablename__ = 'job_items'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('jobs.id', ondelete='CASCADE'), nullable=False)
+    position = Column(Integer, nullable=False)  # index into the job payload's items
+    result = Column(Text, nullable=False)  # JSON: name, sha256 and predicted_class/confidence/is_ood or error
+
+    __table_args__ = (
+        Index('ix_job_items_job_position', 'job_id', 'position', unique=True),
+    )
@@ -0,0 +1,148 @@
+"""Out-of-distribution gate built on cheap post-hoc scores.
+
+All scores come from the normal forward pass (logits and the penultimate
+embedding), so gating costs a few vector ops per image:
+
+    energy      logsumexp(logits)            (negative free energy)
+    max_logit   max(logits)
+    msp         max softmax probability
+    feature     cosine similarity to the nearest class centroid
+
+Higher means "more in-distribution" for every score. Thresholds are
+calibrated on dataset/valid so that OOD_TPR of real leaves are accepted:
+
+    python ood.py calibrate --data dataset/valid --tpr 0.95
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+OOD_ENABLED = os.getenv('OOD_ENABLED', '1') == '1'
+OOD_CALIBRATION_PATH = os.getenv('OOD_CALIBRATION_PATH', 'ood_calibration.json')
+OOD_METHOD = os.getenv('OOD_METHOD', 'energy')
+OOD_TPR = float(os.getenv('OOD_TPR', 0.95))
+OOD_METHODS = ('energy', 'max_logit', 'msp', 'feature')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def _logsumexp(logits):
+    m = logits.max(axis=1, keepdims=True)
+    return (m + np.log(np.exp(logits - m).sum(axis=1, keepdims=True)))[:, 0]
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def compute_scores(logits, probs, embeddings=None, centroids=None):
+    """Dict of per-image in-distribution scores (higher = more familiar)"""
+    scores = {
+        'energy': _logsumexp(logits),
+        'max_logit': logits.max(axis=1),
+        'msp': probs.max(axis=1),
+    }
+    if embeddings is not None and centroids is not None:
+        scores['feature'] = (_normalize(embeddings) @ centroids.T).max(axis=1)
+    return scores
+
+
+class OODGate:
+    """Rejects inputs whose score for the configured method falls below a threshold"""
+
+    def __init__(self, method, thresholds, centroids=None):
+        if method not in OOD_METHODS:
+            raise ValueError(f"Unknown OOD method '{method}', expected one of {OOD_METHODS}")
+        if method not in thresholds:
+            raise ValueError(f"No calibrated threshold for '{method}'")
+        self.method = method
+        self.thresholds = thresholds
+        self.centroids = None if centroids is None else np.asarray(centroids, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path=OOD_CALIBRATION_PATH, method=OOD_METHOD):
+        """Gate from a calibration file, or None if it hasn't been calibrated"""
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            calibration = json.load(f)
+        return cls(method, calibration['thresholds'], calibration.get('centroids'))
+
+    def score(self, logits, probs, embeddings=None):
+        """(scores, is_ood) arrays for a batch"""
+        use_centroids = self.centroids if self.method == 'feature' else None
+        scores = compute_scores(logits, probs, embeddings, use_centroids)[self.method]
+        return scores, scores < self.thresholds[self.method]
+
+
+def calibrate(model, data_dir, tpr=OOD_TPR, batch_size=32, path=OOD_CALIBRATION_PATH):
+    """Score the validation images and store per-method thresholds and centroids"""
+    from PIL import Image
+
+    from dataset_scan import is_quarantined, load_quarantine
+
+    quarantine = load_quarantine()
+    paths = []
+    for root, _, files in os.walk(data_dir):
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+    paths = [p for p in paths if not is_quarantined(p, quarantine)]
+    if not paths:
+        raise FileNotFoundError(f"❌ No images found under {data_dir}")
+
+    logits, probs, embeddings = [], [], []
+    for start in range(0, len(paths), batch_size):
+        images = [Image.open(p).convert('RGB') for p in paths[start:start + batch_size]]
+        batch_probs, batch_embeddings, batch_logits = model.forward_images(images, batch_size)
+        probs.append(batch_probs)
+        embeddings.append(batch_embeddings)
+        logits.append(batch_logits)
+        print(f"  scored {min(start + batch_size, len(paths))}/{len(paths)}")
+    logits, probs, embeddings = np.concatenate(logits), np.concatenate(probs), np.concatenate(embeddings)
+
+    # Class centroids of the normalized embeddings, keyed by predicted class
+    predicted = probs.argmax(axis=1)
+    normalized = _normalize(embeddings)
+    centroids = np.zeros((probs.shape[1], embeddings.shape[1]), dtype=np.float32)
+    for cls in np.unique(predicted):
+        centroids[cls] = normalized[predicted == cls].mean(axis=0)
+    centroids = _normalize(centroids)
+
+    scores = compute_scores(logits, probs, embeddings, centroids)
+    # Accept `tpr` of in-distribution images: threshold at the (1 - tpr) quantile
+    thresholds = {name: float(np.quantile(values, 1 - tpr)) for name, values in scores.items()}
+
+    calibration = {
+        'tpr': tpr,
+        'images': len(paths),
+        'model_path': model.model_path,
+        'thresholds': thresholds,
+        'centroids': centroids.tolist(),
+    }
+    with open(path, "w") as f:
+        json.dump(calibration, f)
+    return calibration
+
+
+def main():
+    from model import PlantDiseaseModel
+
+    parser = argparse.ArgumentParser(description="Out-of-distribution gate tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_cal = sub.add_parser("calibrate", help="calibrate thresholds on in-distribution images")
+    p_cal.add_argument("--data", default="dataset/valid")
+    p_cal.add_argument("--tpr", type=float, default=OOD_TPR, help="fraction of valid images to accept")
+    p_cal.add_argument("--out", default=OOD_CALIBRATION_PATH)
+    args = parser.parse_args()
+
+    plant_model = PlantDiseaseModel()
+    if not plant_model.load_model():
+        raise SystemExit("❌ A trained model is required for calibration.")
+    calibration = calibrate(plant_model, args.data, args.tpr, path=args.out)
+    print(f"✅ Calibrated on {calibration['images']} images (TPR {args.tpr:.0%}) -> {args.out}")
+    for name, value in calibration['thresholds'].items():
+        print(f"   {name:<10} threshold {value:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Sampled request profiling: cProfile plus TensorFlow traces.
+
+Set PROFILE_SAMPLE_RATE (e.g. 0.05) to profile that fraction of
+predictions and batch runs. Each capture is written to its own folder
+under PROFILE_DIR (oldest folders are rotated out beyond
+PROFILE_MAX_CAPTURES):
+
+    profiles/20251107-191018_predict_1234/cprofile.prof
+    profiles/20251107-191018_predict_1234/tf/...      (TensorBoard trace)
+
+Summarize the hottest functions across all captures with:
+
+    python profiling.py summarize --top 25
+"""
+import argparse
+import cProfile
+import glob
+import os
+import pstats
+import random
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_MAX_CAPTURES = int(os.getenv('PROFILE_MAX_CAPTURES', 50))
+PROFILE_TF_TRACE = os.getenv('PROFILE_TF_TRACE', '1') == '1'
+
+# cProfile and the TF profiler are effectively process-wide; one capture at a time
+_capture_lock = threading.Lock()
+_active = threading.local()
+
+
+class ProfileCapture:
+    """One sampled capture: cProfile for the block, TF trace for forward passes"""
+
+    def __init__(self, tag, directory=PROFILE_DIR, trace_tf=PROFILE_TF_TRACE):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(directory, f"{stamp}_{tag}_{os.getpid()}_{threading.get_ident() % 10000}")
+        self.directory = directory
+        self.trace_tf = trace_tf
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        _active.capture = self
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.disable()
+        _active.capture = None
+        self.profiler.dump_stats(os.path.join(self.path, "cprofile.prof"))
+        _rotate(self.directory, PROFILE_MAX_CAPTURES)
+        return False
+
+    @contextmanager
+    def tf_trace(self):
+        if not self.trace_tf:
+            yield
+            return
+        import tensorflow as tf
+        try:
+            tf.profiler.experimental.start(os.path.join(self.path, "tf"))
+        except Exception:
+            # Another trace is running (or the profiler plugin is missing)
+            yield
+            return
+        try:
+            yield
+        finally:
+            tf.profiler.experimental.stop()
+
+
+def _rotate(directory, keep):
+    captures = sorted(
+        (d for d in glob.glob(os.path.join(directory, "*")) if os.path.isdir(d)),
+        key=os.path.getmtime,
+    )
+    for old in captures[:-keep] if keep > 0 else []:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+@contextmanager
+def maybe_profile(tag, sample_rate=None):
+    """Profile the block for a random sample of calls (nested calls join the outer capture)"""
+    rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or getattr(_active, "capture", None) is not None or random.random() >= rate:
+        yield None
+        return
+    if not _capture_lock.acquire(blocking=False):
+        yield None
+        return
+    try:
+        with ProfileCapture(tag) as capture:
+            yield capture
+    finally:
+        _capture_lock.release()
+
+
+@contextmanager
+def tf_trace():
+    """Record a TF profiler trace if the current thread is inside a capture"""
+    capture = getattr(_active, "capture", None)
+    if capture is None:
+        yield
+        return
+    with capture.tf_trace():
+        yield
+
+
+def summarize(directory=PROFILE_DIR, top=25, sort="cumulative", tag=None):
+    """Print the hottest functions aggregated over all cProfile dumps"""
+    pattern = os.path.join(directory, f"*_{tag}_*" if tag else "*", "cprofile.prof")
+    files = sorted(glob.glob(pattern))
+    if not files:
+        print(f"⚠️ No captures found in {directory}")
+        return None
+    stats = pstats.Stats(files[0])
+    for path in files[1:]:
+        stats.add(path)
+    print(f"📊 {len(files)} capture(s) from {directory}, sorted by {sort}")
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiling capture tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_sum = sub.add_parser("summarize", help="top hot functions across captures")
+    p_sum.add_argument("--dir", default=PROFILE_DIR)
+    p_sum.add_argument("--top", type=int, default=25)
+    p_sum.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+    p_sum.add_argument("--tag", help="only captures with this tag (predict, batch)")
+
+    p_list = sub.add_parser("list", help="list captures")
+    p_list.add_argument("--dir", default=PROFILE_DIR)
+
+    args = parser.parse_args()
+    if args.command == "summarize":
+        summarize(args.dir, args.top, args.sort, args.tag)
+    else:
+        for d in sorted(glob.glob(os.path.join(args.dir, "*"))):
+            has_tf = os.path.isdir(os.path.join(d, "tf"))
+            print(f"{os.path.basename(d)}{'  [+tf trace]' if has_tf else ''}")
+
+
+if __name__ == "__main__":
+    main()
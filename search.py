@@ -0,0 +1,127 @@
+"""Full-text and faceted search over a user's detection history.
+
+On SQLite, notes and image names are indexed by the detection_fts FTS5
+table. migrations.py creates it, and triggers keep it in sync with
+detection_history. Other backends, and SQLite builds without FTS5, fall back
+to LIKE matching.
+
+search_detections() returns one page of matching rows plus crop and disease
+facet counts. The counts come from a single GROUP BY over the filtered rows.
+Each facet's counts ignore that facet's own selection, so the other options
+stay visible.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_, func, or_, text
+
+from migrations import DETECTION_FTS_TABLE
+from models import DetectionHistory
+
+_fts_enabled = {}
+
+
+def fts_enabled(db):
+    """Whether the FTS5 index exists on this session's database"""
+    bind = db.get_bind()
+    engine = getattr(bind, 'engine', bind)
+    key = str(engine.url)
+    if key not in _fts_enabled:
+        _fts_enabled[key] = engine.dialect.name == 'sqlite' and db.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': DETECTION_FTS_TABLE}
+        ).first() is not None
+    return _fts_enabled[key]
+
+
+def fts_query(query):
+    """FTS5 MATCH expression: every word must appear, each as a prefix"""
+    words = [w.replace('"', '""') for w in query.split() if any(c.isalnum() for c in w)]
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def _like_pattern(word):
+    return "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def text_filter(db, query):
+    """Filter clause matching notes or image name, or None if the query has no words"""
+    if fts_enabled(db):
+        match = fts_query(query)
+        if not match:
+            return None
+        matching_ids = text(
+            f"SELECT rowid FROM {DETECTION_FTS_TABLE} WHERE {DETECTION_FTS_TABLE} MATCH :fts_match"
+        ).bindparams(fts_match=match).columns(DetectionHistory.id)
+        return DetectionHistory.id.in_(matching_ids)
+    words = query.split()
+    if not words:
+        return None
+    return and_(*[
+        or_(DetectionHistory.notes.ilike(_like_pattern(w), escape="\\"),
+            DetectionHistory.image_name.ilike(_like_pattern(w), escape="\\"))
+        for w in words
+    ])
+
+
+def _as_datetime(value, end=False):
+    """Datetimes pass through; a date becomes the start of that day (of the next day if end)"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.combine(value + timedelta(days=1) if end else value, time.min)
+
+
+def search_detections(db, user_id, query=None, crops=(), diseases=(), min_confidence=None, max_confidence=None,
+                      date_from=None, date_to=None, limit=50, offset=0):
+    """Matching detections (newest first), their total, and crop/disease facet counts.
+
+    date_from/date_to may be dates (inclusive days) or datetimes (date_to exclusive).
+    """
+    filters = [DetectionHistory.user_id == user_id]
+    if query:
+        clause = text_filter(db, query)
+        if clause is not None:
+            filters.append(clause)
+    if min_confidence is not None:
+        filters.append(DetectionHistory.confidence >= min_confidence)
+    if max_confidence is not None:
+        filters.append(DetectionHistory.confidence <= max_confidence)
+    if date_from is not None:
+        filters.append(DetectionHistory.detection_date >= _as_datetime(date_from))
+    if date_to is not None:
+        filters.append(DetectionHistory.detection_date < _as_datetime(date_to, end=True))
+
+    groups = db.query(
+        DetectionHistory.crop_type, DetectionHistory.disease_name, func.count()
+    ).filter(*filters).group_by(DetectionHistory.crop_type, DetectionHistory.disease_name).all()
+
+    crops, diseases = set(crops or ()), set(diseases or ())
+    crop_counts, disease_counts, total = Counter(), Counter(), 0
+    for crop, disease, count in groups:
+        crop_selected = not crops or crop in crops
+        disease_selected = not diseases or disease in diseases
+        if disease_selected:
+            crop_counts[crop] += count
+        if crop_selected:
+            disease_counts[disease] += count
+        if crop_selected and disease_selected:
+            total += count
+
+    rows = []
+    if total:
+        if crops:
+            filters.append(DetectionHistory.crop_type.in_(crops))
+        if diseases:
+            filters.append(DetectionHistory.disease_name.in_(diseases))
+        rows = db.query(DetectionHistory).filter(*filters).order_by(
+            DetectionHistory.detection_date.desc(), DetectionHistory.id.desc()
+        ).limit(limit).offset(offset).all()
+
+    return {
+        'total': total,
+        'rows': rows,
+        'facets': {
+            'crop_type': dict(crop_counts.most_common()),
+            'disease_name': dict(disease_counts.most_common()),
+        },
+    }
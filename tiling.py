@@ -0,0 +1,110 @@
+"""High-resolution analysis with overlapping 224x224 tiles.
+
+The photo is limited to TILE_MAX_SIDE on its long side, then tiled at each
+scale in TILE_SCALES with TILE_OVERLAP between neighbouring tiles. Tiles are
+gathered from a sliding_window_view over the pixel array, so only the model
+batch itself is materialized.
+
+Tile softmaxes are merged into one prediction. If any tile is confidently
+diseased, those lesion tiles decide the class, so small spots aren't averaged
+away by healthy leaf area. A coarse heatmap of per-tile disease probability
+is also produced.
+"""
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+TILE_SIZE = 224
+TILE_SCALES = tuple(float(s) for s in os.getenv('TILE_SCALES', '1.0,0.5').split(','))
+TILE_OVERLAP = float(os.getenv('TILE_OVERLAP', 0.25))
+TILE_MAX_SIDE = int(os.getenv('TILE_MAX_SIDE', 1344))
+# A tile counts as showing disease above this summed diseased-class probability
+TILE_DISEASE_THRESHOLD = float(os.getenv('TILE_DISEASE_THRESHOLD', 0.5))
+HEATMAP_CELL = 32  # heatmap cell size in working-image pixels
+
+
+def working_image(image, max_side=TILE_MAX_SIDE):
+    """RGB copy of the image with its long side limited to max_side"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    factor = max_side / max(image.size)
+    if factor < 1:
+        image = image.resize((round(image.width * factor), round(image.height * factor)), Image.BILINEAR)
+    return image
+
+
+def _positions(length, tile, stride):
+    """Window offsets covering [0, length), the last one flush with the far edge"""
+    starts = np.arange(0, length - tile + 1, stride)
+    if starts[-1] != length - tile:
+        starts = np.append(starts, length - tile)
+    return starts
+
+
+def extract_tiles(pixels, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """(tiles, boxes) for an (H, W, 3) array at least one tile in each dimension.
+
+    tiles: (N, tile, tile, 3) gathered in one step from a strided window view
+    boxes: (N, 4) as y0, x0, y1, x1
+    """
+    stride = max(1, int(round(tile * (1 - overlap))))
+    windows = np.lib.stride_tricks.sliding_window_view(pixels, (tile, tile, 3))[:, :, 0]
+    ys = _positions(pixels.shape[0], tile, stride)
+    xs = _positions(pixels.shape[1], tile, stride)
+    tiles = windows[ys[:, None], xs[None, :]].reshape(-1, tile, tile, 3)
+    yy, xx = np.meshgrid(ys, xs, indexing='ij')
+    boxes = np.stack([yy.ravel(), xx.ravel(), yy.ravel() + tile, xx.ravel() + tile], axis=1)
+    return tiles, boxes
+
+
+def multiscale_tiles(image, scales=TILE_SCALES, overlap=TILE_OVERLAP, tile=TILE_SIZE):
+    """(working image, tiles, boxes) over all scales; boxes are in working-image pixels"""
+    base = working_image(image)
+    # Scales that would leave the image smaller than one tile are clamped (and deduplicated)
+    min_factor = tile / min(base.size)
+    factors = sorted({max(scale, min_factor) for scale in scales}, reverse=True)
+
+    all_tiles, all_boxes = [], []
+    for factor in factors:
+        size = (max(tile, round(base.width * factor)), max(tile, round(base.height * factor)))
+        scaled = base if size == base.size else base.resize(size, Image.BILINEAR)
+        tiles, boxes = extract_tiles(np.asarray(scaled), tile, overlap)
+        all_tiles.append(tiles)
+        all_boxes.append(boxes / factor)
+    return base, np.concatenate(all_tiles), np.concatenate(all_boxes)
+
+
+def merge_tile_predictions(probs, healthy_mask, keep=None, threshold=TILE_DISEASE_THRESHOLD):
+    """(merged softmax, per-tile disease probability) for a stack of tile predictions.
+
+    keep: boolean mask of tiles to use (e.g. not out-of-distribution); all if None.
+    """
+    disease_prob = probs[:, ~healthy_mask].sum(axis=1)
+    keep = np.ones(len(probs), dtype=bool) if keep is None or not keep.any() else keep
+    use = keep & (disease_prob >= threshold)
+    if not use.any():
+        use = keep
+    weights = probs[use].max(axis=1)
+    merged = (probs[use] * weights[:, None]).sum(axis=0) / weights.sum()
+    return merged / merged.sum(), np.where(keep, disease_prob, 0.0)
+
+
+def disease_heatmap(values, boxes, size, cell=HEATMAP_CELL):
+    """Mean per-tile value over each cell of a (ceil(H/cell), ceil(W/cell)) grid"""
+    width, height = size
+    total = np.zeros((math.ceil(height / cell), math.ceil(width / cell)), dtype=np.float32)
+    count = np.zeros_like(total)
+    for value, (y0, x0, y1, x1) in zip(values, boxes / cell):
+        region = (slice(int(y0), math.ceil(y1)), slice(int(x0), math.ceil(x1)))
+        total[region] += value
+        count[region] += 1
+    return total / np.maximum(count, 1)
+
+
+def heatmap_overlay(image, heatmap, max_side=800, alpha=0.5):
+    """The photo with disease probability tinted red"""
+    base = working_image(image, max_side)
+    heat = Image.fromarray(np.uint8(np.clip(heatmap, 0, 1) * 255 * alpha)).resize(base.size, Image.BILINEAR)
+    return Image.composite(Image.new('RGB', base.size, (220, 30, 30)), base, heat)
@@ -6,6 +6,8 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping
 
+from dataset_scan import image_frame
+
 # ✅ Configuration
 IMG_SIZE = 224
 BATCH_SIZE = 32
@@ -18,6 +20,10 @@ MODEL_PATH = "plant_disease_model.h5"
 if not os.path.exists(DATA_DIR) or not os.path.exists(VAL_DIR):
     raise FileNotFoundError("❌ Dataset folders not found! Make sure dataset/train and dataset/valid exist.")
 
+# ✅ File lists, minus anything dataset_scan.py quarantined (corrupt, leaked or conflicting labels)
+train_df, class_names = image_frame(DATA_DIR)
+val_df, _ = image_frame(VAL_DIR)
+
 # ✅ Data generators
 train_gen = ImageDataGenerator(
     rescale=1./255,
@@ -25,18 +31,26 @@ train_gen = ImageDataGenerator(
     width_shift_range=0.2,
     height_shift_range=0.2,
     horizontal_flip=True
-).flow_from_directory(
-    DATA_DIR,
+).flow_from_dataframe(
+    train_df,
+    x_col="filename",
+    y_col="class",
+    classes=class_names,  # every class folder, in flow_from_directory order
     target_size=(IMG_SIZE, IMG_SIZE),
     batch_size=BATCH_SIZE,
-    class_mode="categorical"
+    class_mode="categorical",
+    validate_filenames=False
 )
 
-val_gen = ImageDataGenerator(rescale=1./255).flow_from_directory(
-    VAL_DIR,
+val_gen = ImageDataGenerator(rescale=1./255).flow_from_dataframe(
+    val_df,
+    x_col="filename",
+    y_col="class",
+    classes=class_names,
     target_size=(IMG_SIZE, IMG_SIZE),
     batch_size=BATCH_SIZE,
-    class_mode="categorical"
+    class_mode="categorical",
+    validate_filenames=False
 )
 
 num_classes = len(train_gen.class_indices)